@@ -1,10 +1,25 @@
 # This file contains the Schedule and Route classes, which load data from our
-# database and provide methods and variables to help access it
+# database and provide methods and variables to help access it.
+# It also contains the PathIndex class, used to project bus locations onto
+# a route path
 
+import os
+import sys
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import psycopg2 as pg
 from scipy import stats
+from scipy.spatial import cKDTree
+
+# versions.py is packaged next to this file in the deployed zip, and is in
+# the parent folder in the repository
+try:
+    from versions import apply_delta
+except ImportError:
+    sys.path.append(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    from versions import apply_delta
 
 # Schedule class definition
 # (has some extra methods that are not all used in this notebook)
@@ -58,6 +73,11 @@ class Schedule:
         self.mean_interval, self.common_interval = get_common_intervals(
                                     [self.inbound_table, self.outbound_table])
 
+        # sorted scheduled times for each stop, used for interval lookups
+        self.stop_times = get_stop_times(self.inbound_table,
+                                         self.outbound_table)
+        self._build_lookup()
+
     def list_stops(self):
         """
         returns the list of all stops used by this schedule
@@ -71,6 +91,70 @@ class Schedule:
         # then back to list for the correct output type
         return list(set(inbound + outbound))
 
+    def get_headway_table(self, bucket=10):
+        """
+        Returns the scheduled headway, in minutes, at each stop for each
+        time bucket of the day, so thresholds can be looked up with one
+        array index per interval
+
+        The schedule only lists some stops, so any other stop uses the
+        median headway of the scheduled stops in that time bucket.  If
+        there is still no value, common_interval is used.
+
+        Parameters:
+
+        bucket (int, optional)
+            - the number of minutes in each time bucket (default 10)
+
+        Returns stops (pd.Index of stop tags) and headways (np.ndarray):
+            - one row per stop in the same order as stops, plus a last row
+              for stops not in the schedule
+            - one column per time bucket, starting at midnight
+        """
+
+        stops = pd.Index(sorted(self.list_stops()))
+        n_buckets = int(np.ceil(24 * 60 / bucket))
+
+        # look up the headway in the middle of every bucket for every stop
+        middle = pd.to_datetime((np.arange(n_buckets) + .5) * bucket * 60,
+                                unit='s')
+        headways = self.get_intervals(np.repeat(stops, n_buckets),
+                                      np.tile(middle, len(stops))) \
+            .reshape(len(stops), n_buckets)
+
+        # route wide headway for each bucket
+        fallback = pd.DataFrame(headways).median().to_numpy()
+        fallback = np.where(np.isnan(fallback), self.common_interval,
+                            fallback)
+
+        headways = np.vstack([headways, fallback])
+        headways = np.where(np.isnan(headways), fallback, headways)
+
+        return stops, headways
+
+    def _build_lookup(self):
+        """
+        Flattens stop_times into one sorted array for get_intervals()
+
+        Each stop's times are offset by a different number of days (its row
+        number), so the whole array stays sorted and one binary search can
+        answer queries for every stop at once.
+        """
+
+        self._offset = 2 * 24 * 60 * 60
+        self._rows = {}
+        arrays = []
+        for direction in ['inbound', 'outbound']:
+            tags = list(self.stop_times[direction].keys())
+            self._rows[direction] = (pd.Index(tags), len(arrays))
+            for tag in tags:
+                arrays.append(self.stop_times[direction][tag] +
+                              len(arrays) * self._offset)
+
+        self._count = np.array([len(a) for a in arrays], dtype=int)
+        self._start = np.cumsum(self._count) - self._count
+        self._flat = np.concatenate(arrays) if arrays else np.empty(0)
+
     def get_specific_interval(self, stop, time, inbound=True):
         """
         Returns the expected interval, in minutes, for a given stop and
@@ -92,48 +176,93 @@ class Schedule:
 
         # ensure correct parameter types
         stop = str(stop)
-        time = pd.to_datetime(time)
-
-        # check which route to use, and extract the column for the given stop
-        if (stop in self.inbound_table.columns and
-                stop in self.outbound_table.columns):
-            # stop exists in both, use inbound parameter to decide
-            if inbound:
-                sched = self.inbound_table[stop]
-            else:
-                sched = self.outbound_table[stop]
-        elif (stop in self.inbound_table.columns):
-            # stop is in the inbound schedule, use that
-            sched = self.inbound_table[stop]
-        elif (stop in self.outbound_table.columns):
-            # stop is in the outbound schedule, use that
-            sched = self.outbound_table[stop]
-        else:
+
+        if (stop not in self.inbound_table.columns and
+                stop not in self.outbound_table.columns):
             # stop doesn't exist in either, throw an error
-            raise ValueError(f"Stop id '{stop}' doesn't exist in either",
-                             "inbound or outbound schedules")
+            raise ValueError(f"Stop id '{stop}' doesn't exist "
+                             f"in either inbound or outbound schedules")
+
+        direction = 'inbound' if inbound else 'outbound'
+        return self.get_intervals([stop], [time], direction)[0]
+
+    def get_intervals(self, stops, times, direction='inbound'):
+        """
+        Returns the expected interval, in minutes, for many (stop, time)
+        pairs at once.  Works the same as get_specific_interval(), but uses
+        the sorted stop_times arrays so every query is one binary search.
+
+        Parameters:
+
+        stops (array-like of str or int)
+            - the stop tag/id of each query
+
+        times (array-like of str or pandas.Timestamp)
+            - the time of day of each query, only the time portion is used
+
+        direction (str or array-like of str, optional)
+            - 'inbound' or 'outbound', for all queries or one per query
+            - ignored unless the given stop is in both inbound and outbound
 
-        # 1: convert schedule to datetime for comparison statements
-        # 2: drop any NaN values
-        # 3: convert to list since pd.Series threw errors on i indexing
-        sched = list(pd.to_datetime(sched).dropna())
+        Returns a numpy array of intervals, NaN for stops that are not in the
+        schedule or only have one scheduled time
+        """
 
-        # reset the date portion of the time parameter to
-        # ensure we are checking the schedule correctly
-        time = time.replace(year=self.date.year, month=self.date.month,
-                            day=self.date.day)
+        stops = pd.Index(np.asarray(stops).astype(str))
+        times = pd.Series(pd.to_datetime(times))
+        seconds = (times - times.dt.normalize()).dt.total_seconds().to_numpy()
+        inbound = np.char.lower(np.broadcast_to(
+            np.asarray(direction, dtype=str), len(stops))) == 'inbound'
+
+        # find the row for each stop, preferring the requested direction
+        rows = {}
+        for key, (index, first_row) in self._rows.items():
+            rows[key] = index.get_indexer(stops)
+            rows[key] = np.where(rows[key] >= 0, rows[key] + first_row, -1)
+        row_in, row_out = rows['inbound'], rows['outbound']
+        row = np.where(inbound,
+                       np.where(row_in >= 0, row_in, row_out),
+                       np.where(row_out >= 0, row_out, row_in))
+
+        result = np.full(len(stops), np.nan)
+        if len(self._count) == 0:
+            return result
+        found = (row >= 0) & (self._count[np.maximum(row, 0)] > 1)
+        row = row[found]
+        start = self._start[row]
+
+        # every stop's times are offset by a different number of days, so
+        # one search of the flat array covers all stops
+        position = np.searchsorted(self._flat,
+                                   seconds[found] + row * self._offset,
+                                   side='right') - start
+
+        # use the first scheduled time after the given time, or the last
+        # available interval if the time is after all entries
+        position = np.clip(position, 1, self._count[row] - 1)
+        result[found] = (self._flat[start + position] -
+                         self._flat[start + position - 1]) / 60
+
+        return result
+
+
+def get_stop_times(inbound_table, outbound_table):
+    """
+    converts schedule tables to sorted arrays of scheduled times for each stop
+
+    returns a dict keyed by direction ('inbound' or 'outbound'), values are
+    dicts of stop tag -> sorted numpy array of seconds after midnight
+    """
 
-        # iterate through that list to find where the time parameter fits
-        for i in range(1, len(sched)):
-            # start at 1 and move forward,
-            # is the time parameter before this schedule entry?
-            if(time < sched[i]):
-                # return the difference between this entry and the previous one
-                return (sched[i] - sched[i-1]).seconds / 60
+    stop_times = {}
+    for direction, table in [('inbound', inbound_table),
+                             ('outbound', outbound_table)]:
+        stop_times[direction] = {}
+        for stop in table.columns:
+            seconds = pd.to_timedelta(table[stop].dropna()).dt.total_seconds()
+            stop_times[direction][str(stop)] = np.sort(seconds.to_numpy())
 
-        # can only reach this point if the time parameter is after all entries
-        # in the schedule, return the last available interval
-        return (sched[len(sched)-1] - sched[len(sched)-2]).seconds / 60
+    return stop_times
 
 
 def load_schedule(route, date, connection):
@@ -158,12 +287,15 @@ def load_schedule(route, date, connection):
     cursor = connection.cursor()
 
     # build selection query
+    # only the id, the content comes from read_schedule() and its cache
     query = """
-        SELECT content
+        SELECT id
         FROM schedules
         WHERE rid = %s AND
             begin_date <= %s::TIMESTAMP AND
-            (end_date IS NULL OR end_date >= %s::TIMESTAMP);
+            (end_date IS NULL OR end_date >= %s::TIMESTAMP)
+        ORDER BY begin_date DESC, id DESC
+        LIMIT 1;
     """
 
     # execute query and save the route data to a local variable
@@ -172,7 +304,7 @@ def load_schedule(route, date, connection):
         raise Exception(f"No schedule data found for route {route}",
                         f"on {date.date()}")
 
-    data = cursor.fetchone()[0]['route']
+    data = read_schedule(cursor.fetchone()[0], cursor)['route']
 
     # pd.Timestamp.dayofweek returns 0 for monday and 6 for Sunday
     # the actual serviceClass strings are defined by Nextbus
@@ -200,6 +332,56 @@ def load_schedule(route, date, connection):
     return result
 
 
+# cache of schedule contents, keyed by schedule row id, least recently
+# used first.  Module level so it is reused while the process (or Lambda
+# container) lives, e.g. by report jobs over several days.  Each entry is a
+# whole schedule: set SCHEDULE_CACHE_SIZE to about the number of routes for
+# a cache hit on every route after the first day, if memory allows.
+# Versions stored as deltas share their unchanged parts with their keyframe.
+_schedule_cache = OrderedDict()
+SCHEDULE_CACHE_SIZE = int(os.environ.get('SCHEDULE_CACHE_SIZE', 16))
+
+
+def read_schedule(version, cursor):
+    """
+    Returns the content of a schedule row, from the cache if possible
+
+    Rows stored as deltas (see schedule_collector) are rebuilt from their
+    keyframe, which is read through the cache too, so the versions of a
+    route only read their keyframe's multi-MB content once.
+
+    Parameters:
+
+        version (int)
+            - the id of the schedule row
+
+        cursor (psycopg2 cursor)
+            - cursor to query with
+    """
+
+    if version in _schedule_cache:
+        _schedule_cache.move_to_end(version)
+        return _schedule_cache[version]
+
+    cursor.execute("""
+        SELECT content, base_id, delta
+        FROM schedules
+        WHERE id = %s;
+    """, (version,))
+    content, base_id, delta = cursor.fetchone()
+
+    # rows with a base are deltas, even when the delta itself is empty, and
+    # their base is always a full version (see AWS_Lambda/versions.py)
+    if base_id is not None:
+        content = apply_delta(read_schedule(base_id, cursor), delta)
+
+    _schedule_cache[version] = content
+    while len(_schedule_cache) > SCHEDULE_CACHE_SIZE:
+        _schedule_cache.popitem(last=False)
+
+    return content
+
+
 def extract_schedule_tables(route_data):
     """
     converts raw schedule data to two pandas dataframes
@@ -326,19 +508,21 @@ class Route:
     Attributes:
         route_id (str): the id of the route loaded
         date (pd.Timestamp): the date of the route definition loaded
+        version (int): the id of the route definition loaded
         route_data (dict): the raw route data
         route_type (str): the type of route loaded
         route_name (str): the name of the route loaded
+        stops (StopModel): the stops on this route, see StopModel
         stops_table (pd.DataFrame): a table of all stops on this route
-        inbound (list): a list of stop tags in the order they appear on the
-                        inbound route
-        outbound (list): a list of stop tags in the order they appear on the
-                         outbound route
-
-        Not fully implemented:
-        path_coords (list): a list of (lat,lon) tuples describing the route
-                            path.  These are stored as an unordered collection
-                            of sub-paths in the raw data.
+        inbound (np.ndarray): int stop tags in the order they appear on the
+                              inbound route
+        outbound (np.ndarray): int stop tags in the order they appear on the
+                               outbound route
+        path_coords (dict): the ordered path for each direction tag, as
+                            arrays of (lat, lon).  These are stored as an
+                            unordered collection of sub-paths in the raw data.
+        directions (dict): map matching info for each direction tag,
+                           see locate_stops()
     """
 
     def __init__(self, route_id, date, connection):
@@ -363,17 +547,48 @@ class Route:
         self.date = pd.to_datetime(date)
 
         # load the route data
-        self.route_data, self.route_type, self.route_name = \
+        self.version, self.route_data, self.route_type, self.route_name = \
             load_route(self.route_id, self.date, connection)
 
-        # extract stops table
-        self.stops_table, self.inbound, self.outbound = \
-            extract_stops(self.route_data)
+        # everything below only depends on the route version, so it is
+        # built once per version and cached
+
+        # extract stops info
+        self.stops = from_cache(self.route_id, self.version, 'stops',
+                                StopModel, self.route_data)
+        self.stops_table = self.stops.table
+        self.inbound = self.stops.inbound
+        self.outbound = self.stops.outbound
+
+        # extract the route path for each direction, arrays of (lat, lon)
+        self.path_coords = from_cache(self.route_id, self.version, 'paths',
+                                      extract_paths, self.route_data)
+
+        # index each path and find where each stop is along it, so location
+        # reports can be map matched in each direction
+        self.directions = from_cache(self.route_id, self.version,
+                                     'directions', locate_directions,
+                                     self.path_coords, self.stops)
+
+    def get_direction(self, tag):
+        """
+        Returns the map matching info (see locate_stops) for a direction tag
+        from the location data, or None if it can't be matched
+
+        Falls back to another branch in the same direction if the tag itself
+        is not in the route definition
+        """
+
+        if tag in self.directions:
+            return self.directions[tag]
 
-        # The extract_path method is not complete
+        for code in ['_I_', '_O_']:
+            if code in tag:
+                for key in self.directions.keys():
+                    if code in key:
+                        return self.directions[key]
 
-        # extract route path, list of (lat, lon) pairs
-        # self.path_coords = extract_path(self.route_data)
+        return None
 
 
 def load_route(route, date, connection):
@@ -389,7 +604,8 @@ def load_route(route, date, connection):
             - Which date to load
             - Converted with pandas.to_datetime so many formats are acceptable
 
-    Returns route_data (dict), route_type (str), route_name (str)
+    Returns version (int), route_data (dict), route_type (str),
+    route_name (str)
     """
 
     # ensure correct parameter types
@@ -401,7 +617,7 @@ def load_route(route, date, connection):
 
     # build selection query
     query = """
-        SELECT route_name, route_type, content
+        SELECT id, route_name, route_type, content
         FROM routes
         WHERE rid = %s AND
             begin_date <= %s::TIMESTAMP AND
@@ -415,120 +631,556 @@ def load_route(route, date, connection):
                         f"on {date.date()}")
 
     result = cursor.fetchone()
-    return result[2]['route'], result[1], result[0]
+    return result[0], result[3]['route'], result[2], result[1]
+
+
+# cache of data built from each route version, keyed by
+# (route id, route version id, name)
+# module level so it is reused while the process (or Lambda container) lives
+_version_cache = {}
+VERSION_CACHE_SIZE = 256
+
+
+def from_cache(route_id, version, name, build, *args):
+    """
+    Returns build(*args), cached per route version
+
+    A route version never changes once it is stored, so anything built only
+    from its data needs to be built once for each one.
+
+    Arguments:
+        route_id (str): the route id
+        version (int): the id of the route definition row in the database
+        name (str): what is being built, so one version can cache several
+        build (function): builds the value if it is not cached
+        args: passed to build
+    """
+
+    key = (str(route_id), version, name)
+    if key not in _version_cache:
+        # drop the oldest entry when the cache is full
+        if len(_version_cache) >= VERSION_CACHE_SIZE:
+            _version_cache.pop(next(iter(_version_cache)))
+        _version_cache[key] = build(*args)
 
+    return _version_cache[key]
 
-def extract_path(route_data):
+
+def as_list(value):
+    """
+    The raw Nextbus data uses a single object instead of a list when there
+    is only one item, this always returns a list
     """
-    Extracts the list of path coordinates for a route.
 
-    The raw data stores this as an unordered list of sub-routes, so this
-    function deciphers the order they should go in and returns a single list.
+    return value if isinstance(value, list) else [value]
+
+
+def extract_paths(route_data, snap=.03, join=.015):
     """
+    Extracts an ordered path for each direction (and branch) of a route.
+
+    The raw data stores the path as an unordered list of sub-paths that meet
+    at shared end points.  This indexes the sub-paths by their first point
+    in a dict, then chains them end to start for each direction: where the
+    path branches, it takes the sub-path that serves the direction's next
+    stop.  Routes that split into branches (route 24 for example) get one
+    path per branch.
 
-    # KNOWN BUG
-    # this approach assumed all routes were either a line or a loop.
-    # routes that have multiple sub-paths meeting at a point break this,
-    # route 24 is a current example.
-    # I'm committing this now to get the rest of the code out there
+    Each sub-path is added at most once per direction, so the chaining is
+    linear in the number of sub-paths and stops.
 
-    # this part is also not currently used in the daily report generation
+    Arguments:
+        route_data (dict): the raw route data
+        snap (float): sub-paths within this many km of the closest one to a
+                      stop are also considered to serve it (default .03)
+        join (float): end points closer than this many km are treated as
+                      the same point, the raw data is not always exact
+                      (default .015)
+
+    Returns a dict, keys are direction tags and values are (n, 2) numpy
+    arrays of (lat, lon) coordinates in the order a bus travels them
+    """
 
-    # extract the list of subpaths as just (lat,lon) coordinates
+    # extract each sub-path as an array of (lat, lon) coordinates
     # also converts from string to float (raw data has strings)
-    path = []
-    for sub_path in route_data['path']:
-        path.append([(float(p['lat']), float(p['lon']))
-                     for p in sub_path['point']])
-
-    # start with the first element, remove it from path
-    final = path[0]
-    path.pop(0)
-
-    # loop until the first and last coordinates in final match
-    counter = len(path)
-    done = True
-    while final[0] != final[-1]:
-        # loop through the sub-paths that we haven't yet moved to final
-        for i in range(len(path)):
-            # check if the last coordinate in final matches the first
-            # coordinate of another sub-path
-            if final[-1] == path[i][0]:
-                # match found, move it to final
-                # leave out the first coordinate to avoid duplicates
-                final = final + path[i][1:]
-                path.pop(i)
-                break  # break the for loop
-
-        # protection against infinite loops, if the path never closes
-        counter -= 1
-        if counter < 0:
-            done = False
-            break
-
-    if not done:
-        # route did not connect in a loop, perform same steps backwards
-        # to get the rest of the line
-        for _ in range(len(path)):
-            # loop through the sub-paths that we haven't yet moved to final
-            for i in range(len(path)):
-                # check if the first coordinate in final matches the last
-                # coordinate of another sub-path
-                if final[0] == path[i][-1]:
-                    # match found, move it to final
-                    # leave out the last coordinate to avoid duplicates
-                    final = path[i][:-1] + final
-                    path.pop(i)
-                    break  # break the for loop
-
-    # some routes may have un-used sub-paths
-    # Route 1 for example has two sub-paths that are almost identical, with the
-    # same start and end points
-    # if len(path) > 0:
-    #     print(f"WARNING: {len(path)} unused sub-paths")
-
-    # return the final result
-    return final
-
-
-def extract_stops(route_data):
-    """
-    Extracts a dataframe of stops info
-
-    Returns the main stops dataframe, and a list of inbound and outbound stops
-    in the order they are intended to be on the route
-    """
-
-    stops = pd.DataFrame(route_data['stop'])
-    directions = pd.DataFrame(route_data['direction'])
-
-    # Change stop arrays to just the list of numbers
-    for i in range(len(directions)):
-        directions.at[i, 'stop'] = [s['tag'] for s in directions.at[i, 'stop']]
-
-    # Find which stops are inbound or outbound
-    inbound = []
-    for stop_list in directions[directions['name'] == "Inbound"]['stop']:
-        for stop in stop_list:
-            if stop not in inbound:
-                inbound.append(stop)
-
-    outbound = []
-    for stop_list in directions[directions['name'] == "Outbound"]['stop']:
-        for stop in stop_list:
-            if stop not in inbound:
-                outbound.append(stop)
-
-    # Label each stop as inbound or outbound
-    stops['direction'] = ['none'] * len(stops)
-    for i in range(len(stops)):
-        if stops.at[i, 'tag'] in inbound:
-            stops.at[i, 'direction'] = 'inbound'
-        elif stops.at[i, 'tag'] in outbound:
-            stops.at[i, 'direction'] = 'outbound'
-
-    # Convert from string to float
-    stops['lat'] = stops['lat'].astype(float)
-    stops['lon'] = stops['lon'].astype(float)
-
-    return stops, inbound, outbound
+    sub_paths = []
+    for sub_path in as_list(route_data['path']):
+        points = np.array([(float(p['lat']), float(p['lon']))
+                           for p in as_list(sub_path['point'])])
+        if len(points) >= 2:
+            sub_paths.append(points)
+    n_paths = len(sub_paths)
+
+    if n_paths == 0:
+        return {}
+
+    # project onto a flat plane in km, so distances are easy to calculate
+    center = np.concatenate(sub_paths).mean(axis=0)
+    scale = np.array([111.13, 111.41 * np.cos(np.radians(center[0]))])
+    flat = [(p - center) * scale for p in sub_paths]
+
+    # number the end points so the ones within join km of each other share
+    # a number: first points are 0 to n-1 and last points n to 2n-1, close
+    # pairs come from a KD-tree and are merged with a small union-find
+    ends = np.array([p[0] for p in flat] + [p[-1] for p in flat])
+    parent = list(range(len(ends)))
+
+    def node(i):
+        """ returns the number shared by end point i and those joined to it """
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in cKDTree(ends).query_pairs(join):
+        parent[node(i)] = node(j)
+
+    # sub-paths indexed by their first point, so the sub-paths continuing
+    # from another one are a dict lookup
+    starts_at = {}
+    for i in range(n_paths):
+        starts_at.setdefault(node(i), []).append(i)
+    end_node = [node(n_paths + i) for i in range(n_paths)]
+
+    # points every snap km along each sub-path, labelled with the sub-path,
+    # so the sub-paths near a stop are a KD-tree lookup even where the raw
+    # points are far apart
+    dense, owner = [], []
+    for i, p in enumerate(flat):
+        vectors = np.diff(p, axis=0)
+        steps = np.maximum(np.ceil(np.hypot(vectors[:, 0], vectors[:, 1]) /
+                                   snap), 1).astype(int)
+        segment = np.repeat(np.arange(len(vectors)), steps)
+        t = ((np.arange(steps.sum()) - np.repeat(steps.cumsum() - steps,
+                                                 steps)) /
+             np.repeat(steps, steps))
+        dense.append(p[segment] + t[:, None] * vectors[segment])
+        owner.append(np.full(len(segment), i))
+    dense = np.concatenate(dense + [np.array([p[-1] for p in flat])])
+    owner = np.concatenate(owner + [np.arange(n_paths)])
+    tree = cKDTree(dense)
+
+    # stop locations in the same flat plane
+    stops = {s['tag']: ((float(s['lat']), float(s['lon'])) - center) * scale
+             for s in as_list(route_data['stop'])}
+
+    def distance(i, location):
+        """ distance from a location to the closest point of sub-path i """
+        return np.linalg.norm(flat[i] - location, axis=1).min()
+
+    def chain(start, serves, locations):
+        """
+        Chains sub-paths from start through the stops, returns the list of
+        sub-paths and how many times it had to jump between sub-paths that
+        don't connect
+        """
+        order, used = [start], {start}
+        jumps = 0
+        k = 0
+        while True:
+            # move past the stops served by the sub-path just added, and
+            # stops whose sub-paths have all been used (a loop closing)
+            while k < len(serves) and (order[-1] in serves[k] or
+                                       serves[k] <= used):
+                k += 1
+            if k == len(serves):
+                return order, jumps
+
+            # continue with a sub-path that serves the next stop, or else
+            # one that ends closer to the next stop than it starts
+            follow = [j for j in starts_at.get(end_node[order[-1]], [])
+                      if j not in used]
+            step = next((j for j in follow if j in serves[k]), None)
+            if step is None and follow:
+                closest = min(follow, key=lambda j: np.linalg.norm(
+                    flat[j][-1] - locations[k]))
+                if (np.linalg.norm(flat[closest][-1] - locations[k]) <
+                        np.linalg.norm(flat[closest][0] - locations[k])):
+                    step = closest
+
+            # no way forward through the graph, jump to the closest unused
+            # sub-path serving the next stop
+            if step is None:
+                step = min(serves[k] - used,
+                           key=lambda j: distance(j, locations[k]))
+                jumps += 1
+
+            order.append(step)
+            used.add(step)
+
+    paths = {}
+    for direction in as_list(route_data['direction']):
+        tags = [s['tag'] for s in as_list(direction['stop'])
+                if s['tag'] in stops]
+        if len(tags) == 0:
+            continue
+        locations = np.array([stops[tag] for tag in tags])
+
+        # the sub-paths within snap km of the closest one to each stop
+        closest, _ = tree.query(locations)
+        serves = [set(owner[hits].tolist()) for hits in
+                  tree.query_ball_point(locations, closest + snap)]
+
+        # start from whichever sub-path at the first stop reaches the
+        # others with the fewest jumps (a street served in both directions
+        # has a sub-path each way)
+        order, _ = min((chain(start, serves, locations)
+                        for start in sorted(serves[0])),
+                       key=lambda result: (result[1], len(result[0])))
+
+        # join the sub-paths, dropping the first point of a sub-path when it
+        # is the end of the one before it
+        pieces = [sub_paths[order[0]]]
+        for i, j in zip(order, order[1:]):
+            if end_node[i] == node(j):
+                pieces.append(sub_paths[j][1:])
+            else:
+                pieces.append(sub_paths[j])
+        paths[direction['tag']] = np.concatenate(pieces)
+
+    return paths
+
+
+class StopModel:
+    """
+    The StopModel class holds the stops on a route in the forms each step of
+    the report needs, so they don't have to be converted or searched again
+
+    Attributes:
+        table (pd.DataFrame): all stops on the route, with float lat/lon and
+                              a direction column ('inbound', 'outbound', or
+                              'none')
+        tags (dict): int stop tags in route order for each direction tag
+        inbound (np.ndarray): int stop tags in the order they appear on the
+                              inbound route (all inbound branches together)
+        outbound (np.ndarray): int stop tags in the order they appear on the
+                               outbound route (all outbound branches together)
+        position (dict): for 'inbound' and 'outbound', a dict of each int
+                         stop tag to its position in that list
+        rows (dict): each int stop tag to its row number in table
+        keys (list): the str tag of every inbound and outbound stop, used as
+                     the keys of the stop_times dict
+    """
+
+    def __init__(self, route_data):
+        """
+        Parameters:
+
+        route_data (dict)
+            - the raw route data
+        """
+
+        stops = pd.DataFrame(as_list(route_data['stop']))
+
+        # Convert from string to float
+        stops['lat'] = stops['lat'].astype(float)
+        stops['lon'] = stops['lon'].astype(float)
+
+        # Change stop arrays to just the arrays of tags
+        self.tags = {}
+        names = {'Inbound': [], 'Outbound': []}
+        for direction in as_list(route_data['direction']):
+            tags = np.array(
+                [int(s['tag']) for s in as_list(direction['stop'])], dtype=int)
+            self.tags[direction['tag']] = tags
+            names.setdefault(direction['name'], []).append(tags)
+
+        # Join the branches of each direction, keeping the first time each
+        # stop appears (pd.unique keeps the order)
+        self.inbound = pd.unique(np.concatenate(names['Inbound'] +
+                                                [np.empty(0, dtype=int)]))
+        self.outbound = pd.unique(np.concatenate(names['Outbound'] +
+                                                 [np.empty(0, dtype=int)]))
+        self.position = {
+            'inbound': {tag: i for i, tag in enumerate(self.inbound)},
+            'outbound': {tag: i for i, tag in enumerate(self.outbound)}
+        }
+
+        # Label each stop as inbound or outbound
+        tags = stops['tag'].astype(int)
+        stops['direction'] = np.select(
+            [tags.isin(self.inbound), tags.isin(self.outbound)],
+            ['inbound', 'outbound'], 'none')
+        self.table = stops
+
+        # row of the first appearance of each tag in the table
+        self.rows = {tag: i for i, tag in reversed(list(enumerate(tags)))}
+
+        self.keys = [str(tag) for tag in pd.unique(
+            np.concatenate([self.inbound, self.outbound]))]
+
+
+def locate_directions(path_coords, stops):
+    """
+    Indexes the path for each direction tag and locates its stops on it
+
+    Arguments:
+        path_coords (dict): the path for each direction tag, from
+                            extract_paths()
+        stops (StopModel): the stops on this route
+
+    Returns a dict, keys are direction tags and values are from
+    locate_stops()
+    """
+
+    directions = {}
+    for tag, coords in path_coords.items():
+        if tag in stops.tags:
+            directions[tag] = locate_stops(PathIndex(coords), stops,
+                                           stops.tags[tag])
+
+    return directions
+
+
+def locate_stops(path, stops, tags):
+    """
+    Finds how far along a direction's path each of its stops is
+
+    Distances are measured from the first stop in the direction.  On a loop
+    the distances wrap around, so buses always move forward along the path.
+
+    Arguments:
+        path (PathIndex): the indexed path for this direction
+        stops (StopModel): the stops on this route
+        tags (np.ndarray): the int stop tags in this direction, in order,
+                           tags not in the route's stop list are skipped
+
+    Returns a dict:
+    {
+    "path": the PathIndex to match this direction against,
+    "origin": distance along the path that this direction starts at (km),
+    "tags": array of int stop tags, sorted by distance,
+    "distances": array of distances from the first stop (km), sorted
+    }
+    """
+
+    # skip tags missing from the route's stop list, like extract_paths()
+    # does, so one bad entry in the feed doesn't stop the whole route
+    tags = [tag for tag in tags if tag in stops.rows]
+
+    # look up each stop's location, in route order
+    rows = [stops.rows[tag] for tag in tags]
+    along = path.project_sequence(stops.table['lat'].to_numpy()[rows],
+                                  stops.table['lon'].to_numpy()[rows])
+
+    origin = along[0] if len(along) else 0
+    distances = path.relative(along, origin)
+
+    order = np.argsort(distances, kind='stable')
+    return {
+        'path': path,
+        'origin': origin,
+        'tags': np.asarray(tags, dtype=int)[order],
+        'distances': distances[order]
+    }
+
+
+class PathIndex:
+    """
+    The PathIndex class prepares a route path for map matching, so any number
+    of lat/lon points can be projected onto it at once
+
+    Coordinates are converted to a flat plane (in kilometers) around the
+    center of the path, using the same FCC formulae as fcc_projection in
+    report_functions.py.  Long segments are split up so the spatial index
+    of segment midpoints always finds the closest segments.
+
+    Attributes:
+        coords (np.ndarray): the (lat, lon) path coordinates
+        starts (np.ndarray): (x, y) start point of each segment
+        vectors (np.ndarray): (dx, dy) of each segment
+        lengths (np.ndarray): length of each segment, in km
+        cumulative (np.ndarray): distance along the path where each segment
+                                 starts, in km
+        bearings (np.ndarray): compass bearing of each segment, in degrees
+        length (float): the total length of the path, in km
+        is_loop (bool): whether the path ends where it started
+        tree (cKDTree): spatial index of the segment midpoints
+    """
+
+    def __init__(self, coords, max_segment=.05):
+        """
+        Parameters:
+
+        coords (list or np.ndarray)
+            - (lat, lon) pairs describing the path, in order
+
+        max_segment (float, optional)
+            - segments longer than this (in km) are split up before indexing
+        """
+
+        self.coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if len(self.coords) < 2:
+            raise ValueError("A path needs at least 2 coordinates")
+
+        self.is_loop = bool((self.coords[0] == self.coords[-1]).all())
+
+        # flat plane projection constants, centered on the path
+        self.center = self.coords.mean(axis=0)
+        mean_lat = np.radians(self.center[0])
+        self.k_lat = (111.13209 - 0.56605*np.cos(2*mean_lat) +
+                      .0012*np.cos(4*mean_lat))
+        self.k_lon = (111.41513*np.cos(mean_lat) - 0.09455*np.cos(3*mean_lat)
+                      + 0.00012*np.cos(5*mean_lat))
+
+        xy = self.to_plane(self.coords[:, 0], self.coords[:, 1])
+
+        # drop repeated points, they would make zero length segments
+        keep = np.ones(len(xy), dtype=bool)
+        keep[1:] = (np.diff(xy, axis=0) != 0).any(axis=1)
+        xy = xy[keep]
+        if len(xy) < 2:
+            raise ValueError("A path needs at least 2 distinct coordinates")
+
+        # split long segments into equal pieces
+        vectors = np.diff(xy, axis=0)
+        pieces = np.maximum(
+            np.ceil(np.hypot(vectors[:, 0], vectors[:, 1]) / max_segment),
+            1).astype(int)
+        step = (np.arange(pieces.sum()) -
+                np.repeat(np.cumsum(pieces) - pieces, pieces))
+        xy = np.vstack([
+            np.repeat(xy[:-1], pieces, axis=0) +
+            np.repeat(vectors / pieces[:, None], pieces, axis=0) *
+            step[:, None],
+            xy[-1:]])
+
+        # segment arrays
+        self.starts = xy[:-1]
+        self.vectors = np.diff(xy, axis=0)
+        self.lengths = np.hypot(self.vectors[:, 0], self.vectors[:, 1])
+        self.cumulative = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+        self.length = float(self.lengths.sum())
+        self.bearings = np.degrees(np.arctan2(self.vectors[:, 0],
+                                              self.vectors[:, 1])) % 360
+
+        # spatial index of segment midpoints
+        self.tree = cKDTree(self.starts + self.vectors / 2)
+
+    def to_plane(self, lat, lon):
+        """
+        converts arrays of lat/lon to an (n, 2) array of x/y in km
+        """
+
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        return np.column_stack([(lon - self.center[1]) * self.k_lon,
+                                (lat - self.center[0]) * self.k_lat])
+
+    def relative(self, along, origin, margin=.2):
+        """
+        Converts distances along the path to distances from origin
+
+        On a loop, distances wrap around the end of the path.  Points up to
+        margin (km) before the origin stay slightly negative instead of
+        wrapping to the end of the loop.
+        """
+
+        along = np.asarray(along, dtype=float) - origin
+        if self.is_loop:
+            along = (along + margin) % self.length - margin
+        return along
+
+    def candidates(self, points, count):
+        """
+        Projects points (already on the flat plane) onto the closest
+        segments found with the spatial index
+
+        Returns three arrays, shape (points, count):
+            seg: index of each candidate segment
+            t: how far along each segment the projection is (0 to 1)
+            offset: the distance from each point to each segment (km)
+        """
+
+        count = min(count, len(self.lengths))
+        _, seg = self.tree.query(points, k=count)
+        seg = seg.reshape(len(points), count)
+
+        starts = self.starts[seg]
+        vectors = self.vectors[seg]
+        t = (((points[:, None, :] - starts) * vectors).sum(axis=2) /
+             self.lengths[seg]**2).clip(0, 1)
+        offset = np.linalg.norm(
+            points[:, None, :] - (starts + t[:, :, None] * vectors), axis=2)
+
+        return seg, t, offset
+
+    def project(self, lat, lon, heading=None, candidates=8,
+                heading_penalty=.05):
+        """
+        Projects points onto the path
+
+        Parameters:
+
+        lat, lon (array-like)
+            - the points to project
+
+        heading (array-like, optional)
+            - compass heading of each point in degrees, negative or NaN if
+              unknown
+            - used to choose the right side of the street where a route
+              travels both ways on the same road
+
+        candidates (int, optional)
+            - how many nearby segments to check for each point
+
+        heading_penalty (float, optional)
+            - distance (km) added to segments that face the wrong way
+
+        Returns two arrays:
+            along: the distance along the path of each projected point (km)
+            offset: the distance from each point to the path (km)
+        """
+
+        points = self.to_plane(lat, lon)
+        if len(points) == 0:
+            return np.empty(0), np.empty(0)
+
+        seg, t, offset = self.candidates(points, candidates)
+
+        # pick the closest segment, preferring ones facing the same way
+        cost = offset
+        if heading is not None:
+            heading = np.asarray(heading, dtype=float)
+            turn = np.abs((heading[:, None] - self.bearings[seg] + 180)
+                          % 360 - 180)
+            wrong_way = (turn > 90) & (heading[:, None] >= 0)
+            cost = offset + heading_penalty * wrong_way
+
+        best = cost.argmin(axis=1)
+        rows = np.arange(len(points))
+        seg = seg[rows, best]
+
+        along = self.cumulative[seg] + t[rows, best] * self.lengths[seg]
+        return along, offset[rows, best]
+
+    def project_sequence(self, lat, lon, candidates=32, snap=.03):
+        """
+        Projects points that are known to be in order along the path, such as
+        a direction's stops
+
+        Where the path passes the same place more than once, each point is
+        matched to the first pass after the point before it.  Candidates
+        within snap (km) of the closest one count as the same place.
+
+        Returns an array of the distance along the path of each point (km)
+        """
+
+        points = self.to_plane(lat, lon)
+        if len(points) == 0:
+            return np.empty(0)
+
+        seg, t, offset = self.candidates(points, candidates)
+        along = self.cumulative[seg] + t * self.lengths[seg]
+
+        result = np.empty(len(points))
+        position = -np.inf
+        for i in range(len(points)):
+            near = offset[i] <= offset[i].min() + snap
+            ahead = near & (along[i] >= position)
+            if not ahead.any():
+                ahead = near
+            result[i] = along[i][ahead].min()
+            position = result[i]
+
+        return result
@@ -3,14 +3,14 @@
 
 from report_classes import Schedule, Route
 import pandas as pd
+import numpy as np
 import psycopg2 as pg
 
 # Used to easily read in bus location data
 import pandas.io.sql as sqlio
 
-# Used to find distances between lat/lon points, and match closest stops
+# Used to find distances between lat/lon points
 from math import sqrt, cos
-from scipy.spatial.distance import cdist
 
 
 def load_locations(date, connection):
@@ -79,27 +79,24 @@ def fcc_projection(loc1, loc2):
     return distance
 
 
-def clean_locations(locations, stops):
+def clean_locations(locations, route):
     """
     1. removes location reports older than 60 seconds
     2. removes location reports with no direction value
     3. shifts timestamps according to the age column, so the lat/lon location
         and timestamp match
-    4. uses the cdist function from scipy to quickly get all distances between
-        each pair of location report and potential stop
-    5. saves the closest stop to each location report
-    6. drops any rows where closest stop is too far away.
-        - This makes sense for longer routes that can go for a few kilometers
-          without a stop, such as route 25 over the golden gate bridge.
-        - Right now we are approximating by saying the closest stop is where
-          the bus actually is at that time.  If we improve that approximation,
-          we should probably stop dropping these rows.
+    4. map matches each location report onto the route path for its
+        direction, see match_locations()
+        - No rows are dropped for being far from a stop.  Longer routes can
+          go for a few kilometers without a stop, such as route 25 over the
+          golden gate bridge, and those reports still tell us how far along
+          the route the bus is.
 
     Arguments:
         locations (DataFrame): a dataframe of bus locations
-        stops (DataFrame): a dataframe of stops for this route
+        route (Route): the Route class object
 
-    Returns the modified locations dataframe with nearest stops added
+    Returns the modified locations dataframe with route distances added
     """
 
     # remove old location reports that would be duplicates
@@ -109,137 +106,190 @@ def clean_locations(locations, stops):
     df = df[~pd.isna(df['direction'])]
 
     # shift timestamps according to the age column
-    df['timestamp'] = df.apply(shift_timestamp, axis=1)
+    df['timestamp'] = df['timestamp'] - pd.to_timedelta(df['age'], unit='s')
 
-    # Make lists of all inbound or outbound stops
-    inbound_stops = stops[stops['direction'] == 'inbound'] \
-        .reset_index(drop=True)
-    outbound_stops = stops[stops['direction'] == 'outbound'] \
-        .reset_index(drop=True)
+    # project every report onto the route path
+    df = match_locations(df, route)
 
-    # Assign closest stops
-    # separate inbound and outbound so we compare the right stops
-    df_in = df[df['direction'].str.contains('_I_')].copy()
-    df_out = df[df['direction'].str.contains('_O_')].copy()
+    return df.sort_values(['timestamp', 'vid']).reset_index(drop=True)
 
-    # use scipy to find the closest stop to each location report
-    closest_in = cdist(df_in[['latitude', 'longitude']].to_numpy(),
-                       inbound_stops[['lat', 'lon']].to_numpy(),
-                       metric=fcc_projection)
-    closest_out = cdist(df_out[['latitude', 'longitude']].to_numpy(),
-                        outbound_stops[['lat', 'lon']].to_numpy(),
-                        metric=fcc_projection)
 
-    # save results back to df
-    df_in['closestStop'] = [closest_in[i].argmin()
-                            for i in range(len(closest_in))]
-    df_in['distance'] = [closest_in[i].min()
-                         for i in range(len(closest_in))]
-    df_out['closestStop'] = [closest_out[i].argmin()
-                             for i in range(len(closest_out))]
-    df_out['distance'] = [closest_out[i].min()
-                          for i in range(len(closest_out))]
+def match_locations(locations, route):
+    """
+    Map matches location reports onto the route path
+
+    Each report is projected onto the path for its direction tag (using the
+    vehicle heading to pick the right side of the street), giving how far
+    along the route the bus was.  Reports with a direction tag that doesn't
+    match the route definition are dropped.
+
+    Adds these columns:
+        route_distance: distance along the route from the first stop in that
+                        direction (km)
+        path_offset: distance from the report to the route path (km)
+        closestStop: the stop tag closest to the bus along the route
+
+    Arguments:
+        locations (DataFrame): a dataframe of bus locations
+        route (Route): the Route class object
+    """
+
+    df = locations.copy()
+    df['route_distance'] = np.nan
+    df['path_offset'] = np.nan
+    df['closestStop'] = 0
 
-    # cdist gives us the index of closestStop, convert it to the stop tag
-    df_in['closestStop'] = df_in['closestStop'].apply(
-        lambda x: int(inbound_stops.at[x, 'tag']))
-    df_out['closestStop'] = df_out['closestStop'].apply(
-        lambda x: int(outbound_stops.at[x, 'tag']))
+    for tag in df['direction'].unique():
+        info = route.get_direction(tag)
+        if info is None or len(info['tags']) == 0:
+            continue
+        mask = (df['direction'] == tag).to_numpy()
 
-    # df_in and df_out back together
-    df = df_in.append(df_out).sort_values(['timestamp', 'vid']) \
-        .reset_index(drop=True)
+        along, offset = info['path'].project(df.loc[mask, 'latitude'],
+                                             df.loc[mask, 'longitude'],
+                                             df.loc[mask, 'heading'])
+        distance = info['path'].relative(along, info['origin'])
 
-    # drop any rows that were more than .5 kilometers away from a stop
-    df = df[df['distance'] < .5]
+        df.loc[mask, 'route_distance'] = distance
+        df.loc[mask, 'path_offset'] = offset
+        df.loc[mask, 'closestStop'] = \
+            info['tags'][nearest_stop(info['distances'], distance)]
 
-    return df
+    return df[~pd.isna(df['route_distance'])]
 
 
-def shift_timestamp(row):
+def nearest_stop(stop_distances, distances):
     """
-    Helper for the cleaning function,
-    subtracts row['age'] from row['timestamp']
+    Helper for map matching, returns the index of the closest stop
+    to each distance
+
+    Arguments:
+        stop_distances (np.ndarray): sorted distances of each stop
+        distances (np.ndarray): distances to find the closest stop to
     """
-    return row['timestamp'] - pd.Timedelta(seconds=row['age'])
+
+    if len(stop_distances) == 1:
+        return np.zeros(len(distances), dtype=int)
+
+    # compare the stops on either side of each distance
+    after = np.searchsorted(stop_distances, distances) \
+        .clip(1, len(stop_distances) - 1)
+    before = after - 1
+    closer = (np.abs(stop_distances[before] - distances) <=
+              np.abs(stop_distances[after] - distances))
+    return np.where(closer, before, after)
 
 
-def get_stop_times(locations, route):
+def get_stop_times(locations, route, stop_radius=.1, restart=1,
+                   max_gap=600):
     """
     Returns a dict, keys are stop tags and values are lists of timestamps
     that describe every time a bus was seen at that stop
 
-    Uses interpolation to fill in times for some stops between each location
-    report.  In practice, this usually adds about 10% more rows.
+    Uses the map matched distance along the route: between each pair of
+    location reports on the same trip, every stop the bus passed gets a time
+    interpolated by distance.  Buses are not allowed to move backwards along
+    the route within a trip, so GPS noise does not count stops twice.
 
-    Interpolation diagram:
-    https://drive.google.com/uc?export=view&id=1lroClIK-i6_mysd5SA3mQCHsNKuy5t_r
+    A trip ends when the vehicle changes direction, jumps back along the
+    route (e.g. to the first stop, for its next trip in the same direction),
+    or stops reporting for a while (out of service, or on layover).
 
     Arguments:
         locations (Dataframe): The dataframe of bus locations.  Expected to be
                                after the cleaning function.
         route (Route): The Route class object
+        stop_radius (float): the first report of a trip counts as a stop time
+                             if the bus is this close past a stop, in km
+                             (default .1)
+        restart (float): a report this many km behind the one before it
+                         starts a new trip (default 1)
+        max_gap (float): a report this many seconds after the one before
+                         it starts a new trip (default 600)
     """
 
     # Initialize the data structure I will store results in
-    stop_times = {}
-    for stop in route.inbound + route.outbound:
-        stop_times[str(stop)] = []
-
-    for vid in locations['vid'].unique():
-        # Process the route one vehicle at a time
-        df = locations[locations['vid'] == vid]
-
-        # process 1st row on its own
-        prev_row = df.loc[df.index[0]]
-        stop_times[str(prev_row['closestStop'])].append(prev_row['timestamp'])
-
-        # loop through the rest of the rows, comparing each to the previous one
-        for i, row in df[1:].iterrows():
-            if row['direction'] != prev_row['direction']:
-                # changed directions, don't compare to previous row
-                stop_times[str(row['closestStop'])].append(row['timestamp'])
-            else:
-                # same direction, compare to previous row
-                if '_I_' in row['direction']:  # get correct stop list
-                    stoplist = route.inbound
-                else:
-                    stoplist = route.outbound
-
-                current = stoplist.index(str(row['closestStop']))
-                previous = stoplist.index(str(prev_row['closestStop']))
-                gap = current - previous
-                if gap > 1:  # need to interpolate
-                    diff = (row['timestamp'] - prev_row['timestamp'])/gap
-                    counter = 1
-                    for stop in stoplist[previous+1:current]:
-                        # save interpolated time
-                        stop_times[str(stop)].append(prev_row['timestamp'] +
-                                                     (counter * diff))
-
-                    # increase counter for the next stop
-                    # example: with 2 interpolated stops, gap would be 3
-                    # 1st diff is 1/3, next is 2/3
-                    counter += 1
-
-                if row['closestStop'] != prev_row['closestStop']:
-                    # only save time if the stop has changed,
-                    # otherwise the bus hasn't moved since last time
-                    stop_times[str(row['closestStop'])] \
-                        .append(row['timestamp'])
-
-            # advance for next row
-            prev_row = row
-
-    # Sort each list before returning
-    for stop in stop_times.keys():
-        stop_times[stop].sort()
+    stop_times = {stop: [] for stop in route.stops.keys}
+
+    # a new trip starts whenever a vehicle changes direction, moves back
+    # along the route by more than GPS noise, or has a gap in its reports
+    df = locations.sort_values(['vid', 'timestamp'])
+    vid = df['vid'].to_numpy()
+    tag = df['direction'].to_numpy()
+    distance = df['route_distance'].to_numpy()
+    seconds = df['timestamp'].to_numpy().astype('datetime64[s]') \
+        .astype(np.int64)
+    new_trip = np.ones(len(df), dtype=bool)
+    new_trip[1:] = ((vid[1:] != vid[:-1]) | (tag[1:] != tag[:-1]) |
+                    (distance[1:] < distance[:-1] - restart) |
+                    (seconds[1:] - seconds[:-1] > max_gap))
+    df = df.assign(trip=np.cumsum(new_trip), new_trip=new_trip)
+
+    found_stops = []
+    found_times = []
+    for tag in df['direction'].unique():
+        info = route.get_direction(tag)
+        if info is None or len(info['tags']) == 0:
+            continue
+        trips = df[df['direction'] == tag]
+
+        stop_distances = info['distances']
+        times = trips['timestamp'].to_numpy().astype('datetime64[ns]') \
+            .astype(np.int64)
+        first = trips['new_trip'].to_numpy()
+
+        # ignore the bus moving backwards along the route
+        distance = trips.groupby('trip')['route_distance'].cummax() \
+            .to_numpy()
+
+        # first report of each trip, save the stop the bus is at
+        at_stop = np.searchsorted(stop_distances, distance[first],
+                                  side='right') - 1
+        valid = at_stop >= 0
+        valid[valid] = (distance[first][valid] -
+                        stop_distances[at_stop[valid]]) <= stop_radius
+        found_stops.append(info['tags'][at_stop[valid]])
+        found_times.append(times[first][valid])
+
+        # each pair of consecutive reports in the same trip
+        pair = ~first[1:]
+        prev_dist, next_dist = distance[:-1][pair], distance[1:][pair]
+        prev_time, next_time = times[:-1][pair], times[1:][pair]
+
+        # find the range of stops passed between the two reports
+        low = np.searchsorted(stop_distances, prev_dist, side='right')
+        high = np.searchsorted(stop_distances, next_dist, side='right')
+        count = high - low
+
+        # one row per stop passed, interpolate its time by distance
+        passed = np.repeat(np.arange(len(low)), count)
+        stop = np.repeat(low, count) + (np.arange(count.sum()) -
+                                        np.repeat(np.cumsum(count) - count,
+                                                  count))
+        fraction = ((stop_distances[stop] - prev_dist[passed]) /
+                    (next_dist[passed] - prev_dist[passed]))
+        elapsed = next_time[passed] - prev_time[passed]
+        found_stops.append(info['tags'][stop])
+        found_times.append(prev_time[passed] +
+                           (fraction * elapsed).astype(np.int64))
+
+    if len(found_stops) == 0:
+        return stop_times
+
+    found = pd.DataFrame({
+        'stop': np.concatenate(found_stops).astype(str),
+        'time': pd.to_datetime(np.concatenate(found_times))
+    })
+
+    # Sort each list of times, then save them
+    for stop, group in found.sort_values('time').groupby('stop'):
+        stop_times[stop] = list(group['time'])
 
     return stop_times
 
 
-def get_bunches_gaps(stop_times, schedule,
-                     bunch_threshold=.2, gap_threshold=1.5):
+def get_bunches_gaps(stop_times, schedule, bunch_threshold=.2,
+                     gap_threshold=1.5, thresholds='common', bucket=10):
     """
     Returns a dataframe of all bunches and gaps found
 
@@ -251,37 +301,61 @@ def get_bunches_gaps(stop_times, schedule,
         schedule (Schedule): the Schedule class object
         bunch_threshold (float): the bunch threshold (default .2)
         gap_threshold (float): the gap threshold (default 1.5)
+        thresholds (str): which scheduled headway to use (default 'common')
+            - 'common': the most common interval for the whole route
+            - 'scheduled': the headway scheduled at that stop and time of
+              day, so peak and off-peak service are judged separately
+        bucket (int): minutes per time bucket for 'scheduled' (default 10)
     """
 
-    # Initialize dataframe for the bunces and gaps
-    problems = pd.DataFrame(columns=['type', 'time', 'duration', 'stop'])
-    counter = 0
-
-    # Set the bunch/gap thresholds (in seconds)
-    bunch_threshold = (schedule.common_interval * 60) * bunch_threshold
-    gap_threshold = (schedule.common_interval * 60) * gap_threshold
-
+    # flatten every interval into arrays
+    # each interval is measured from one time to the next at the same stop
+    stops, starts, ends = [], [], []
     for stop in stop_times.keys():
-        # ensure we have any times at all for this stop
-        if len(stop_times[stop]) == 0:
-            # print(f"Stop {stop} had no recorded times")
-            continue  # go to next stop in the loop
-
-        # save initial time
-        prev_time = stop_times[stop][0]
-
-        # loop through all others, comparing to the previous one
-        for time in stop_times[stop][1:]:
-            diff = (time - prev_time).seconds
-            if diff <= bunch_threshold:
-                # bunch found, save it
-                problems.at[counter] = ['bunch', prev_time, diff, stop]
-                counter += 1
-            elif diff >= gap_threshold:
-                problems.at[counter] = ['gap', prev_time, diff, stop]
-                counter += 1
-
-            prev_time = time
+        # ensure we have at least 2 times for this stop
+        if len(stop_times[stop]) < 2:
+            continue
+
+        times = pd.to_datetime(stop_times[stop]).to_numpy() \
+            .astype('datetime64[ns]').astype(np.int64)
+        stops.append(np.full(len(times) - 1, stop, dtype=object))
+        starts.append(times[:-1])
+        ends.append(times[1:])
+
+    if len(stops) == 0:
+        return pd.DataFrame(columns=['type', 'time', 'duration', 'stop'])
+
+    stops = np.concatenate(stops)
+    starts = np.concatenate(starts)
+    diff = (np.concatenate(ends) - starts) // 10**9
+
+    # Set the scheduled headway for each interval (in seconds)
+    if thresholds == 'scheduled':
+        headway_stops, headways = schedule.get_headway_table(bucket)
+
+        # row for the stop (last row if it's not in the schedule)
+        # and column for the time of day
+        row = headway_stops.get_indexer(stops.astype(str))
+        row[row < 0] = len(headways) - 1
+        column = ((starts // 10**9) % (24 * 60 * 60)) // (bucket * 60)
+        headway = headways[row, np.minimum(column, headways.shape[1] - 1)]
+    elif thresholds == 'common':
+        headway = np.full(len(diff), schedule.common_interval, dtype=float)
+    else:
+        raise ValueError(f"Unknown thresholds '{thresholds}', "
+                         f"expected 'common' or 'scheduled'")
+
+    # Find bunches and gaps
+    bunch = diff <= headway * 60 * bunch_threshold
+    gap = ~bunch & (diff >= headway * 60 * gap_threshold)
+    found = bunch | gap
+
+    problems = pd.DataFrame({
+        'type': np.where(bunch, 'bunch', 'gap')[found],
+        'time': pd.to_datetime(starts[found]),
+        'duration': diff[found],
+        'stop': stops[found]
+    })
 
     return problems
 
@@ -568,14 +642,16 @@ def generate_route_report(rid, date, connection, locations):
     schedule = Schedule(rid, date, connection)
     route = Route(rid, date, connection)
 
-    # Apply cleaning function (this usually takes 1-2 minutes)
-    locations = clean_locations(locations, route.stops_table)
+    # Apply cleaning function and map match locations onto the route
+    locations = clean_locations(locations, route)
 
     # Calculate all times a bus was at each stop
     stop_times = get_stop_times(locations, route)
 
-    # Find all bunches and gaps
-    problems = get_bunches_gaps(stop_times, schedule)
+    # Find all bunches and gaps, judged against the headway scheduled
+    # at each stop and time of day
+    problems = get_bunches_gaps(stop_times, schedule,
+                                thresholds='scheduled')
 
     # Calculate on-time percentage
     on_time, total_scheduled = calculate_ontime(stop_times, schedule)
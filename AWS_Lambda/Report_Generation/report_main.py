@@ -6,53 +6,29 @@ import report_functions as func
 
 # Library imports
 import pandas as pd
-import psycopg2 as pg
 from psycopg2.extras import execute_batch
 import json
-from dotenv import load_dotenv
 import os
+import sys
 import traceback
 
 
-def generate_report(event, context, date='yesterday', new_report=True):
+def build_report(date, connection):
     """
-    Generates the daily report for the given date
+    Builds the report for every active route on the given date, and the
+    aggregate reports, without saving them
 
-    (Before deployment to AWS Lambda, remove date parameter and set it's
-    value automatically to yesterday.  Easier to test this way)
+    Also used by the API to generate reports on demand
 
     Arguments:
-        event, context: keyword arguments required by AWS Lambda, not used
-
-        date (str): the date of the report to generate (default: 'yesterday')
+        date (Timestamp): the date of the report to build
+        connection (postgresql connection): the connection to the database
 
-        new_report (bool): if true, the report is saved to a new row in the
-                           database.  if false, updates the report object on an
-                           existing row with the same date. (default: True)
+    Returns the report, a list with one object per route or aggregate
     """
 
-    if date == 'yesterday':
-        # actually get a timestamp for yesterday
-        date = pd.to_datetime('today') - pd.Timedelta(days=1)
-        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
-    else:
-        date = pd.to_datetime(date)
-
-    print('Generating report for', date)
-
-    # Load credentials and connect to the database
-    load_dotenv()
-    creds = {
-      'user': os.environ.get('USER'),
-      'password': os.environ.get('PASSWORD'),
-      'host': os.environ.get('HOST'),
-      'dbname': os.environ.get('DATABASE')
-    }
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-
     # Load all location info
-    all_locations = func.load_locations(date, cnx)
+    all_locations = func.load_locations(date, connection)
     print("Location reports for the day:", len(all_locations))
 
     # Get list of active routes
@@ -67,7 +43,8 @@ def generate_report(event, context, date='yesterday', new_report=True):
         try:
             print(f"Generating report for route {rid}...")
             loc = all_locations[all_locations['rid'] == rid]
-            all_reports.append(func.generate_route_report(rid, date, cnx, loc))
+            all_reports.append(
+                func.generate_route_report(rid, date, connection, loc))
         except KeyboardInterrupt:
             # if a user wants to stop this early
             print("Keyboard interrupt, quitting")
@@ -83,6 +60,59 @@ def generate_report(event, context, date='yesterday', new_report=True):
     all_reports = func.calculate_aggregate_report(all_reports)
     print("Done generating report for", date)
 
+    return all_reports
+
+
+def get_runtime():
+    """
+    Returns the lambda_runtime module shared by the Lambda functions
+
+    It is packaged next to this file in the deployed zip, and is in the
+    parent folder in the repository.  Imported here rather than at the top
+    so build_report() can be used without it (e.g. by the API's jobs).
+    """
+    try:
+        import lambda_runtime
+    except ImportError:
+        sys.path.append(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        import lambda_runtime
+    return lambda_runtime
+
+
+def generate_report(event, context, date='yesterday', new_report=True):
+    """
+    Generates the daily report for the given date
+
+    (Before deployment to AWS Lambda, remove date parameter and set it's
+    value automatically to yesterday.  Easier to test this way)
+
+    Arguments:
+        event, context: keyword arguments required by AWS Lambda, not used
+
+        date (str): the date of the report to generate (default: 'yesterday')
+
+        new_report (bool): if true, the report is saved to a new row in the
+                           database.  if false, updates the report object on an
+                           existing row with the same date. (default: True)
+    """
+
+    if date == 'yesterday':
+        # actually get a timestamp for yesterday
+        date = pd.to_datetime('today') - pd.Timedelta(days=1)
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    else:
+        date = pd.to_datetime(date)
+
+    print('Generating report for', date)
+
+    # Reuse the database connection of earlier invocations, if any
+    cnx = get_runtime().get_connection()
+    cursor = cnx.cursor()
+
+    # Generate the report for every active route
+    all_reports = build_report(date, cnx)
+
     if new_report:
         # save new report in the database (all one row)
         query = """
@@ -96,7 +126,7 @@ def generate_report(event, context, date='yesterday', new_report=True):
         # Update an existing report in the database
         query = """
             UPDATE reports
-            SET report = %s
+            SET report = %s, updated_at = now()
             WHERE date = %s ::TIMESTAMP;
         """
         cursor.execute(query, (json.dumps(all_reports), date))
@@ -0,0 +1,76 @@
+# Tests for the report pipeline's stop time detection, run from this folder:
+#
+#     python -m unittest test_report_functions
+
+import unittest
+import numpy as np
+import pandas as pd
+from report_functions import get_stop_times
+
+
+class StopList:
+    """ the part of StopModel that get_stop_times() reads """
+    keys = ['1', '2', '3', '4']
+
+
+class OneDirection:
+    """
+    A route with a single direction 'X_I_', four stops 1 km apart
+    """
+    stops = StopList()
+
+    def get_direction(self, tag):
+        return {'tags': np.array([1, 2, 3, 4]),
+                'distances': np.array([0., 1., 2., 3.])}
+
+
+def trip(start, distances, vid='1'):
+    """
+    Returns map matched reports for one trip, one report a minute from
+    start at each distance along the route
+    """
+    return pd.DataFrame({
+        'vid': vid,
+        'direction': 'X_I_',
+        'timestamp': pd.date_range(start, periods=len(distances),
+                                   freq='min'),
+        'route_distance': distances
+    })
+
+
+class TestStopTimes(unittest.TestCase):
+    def test_two_trips_same_direction(self):
+        # the bus runs the route, lays over without a direction tag
+        # (dropped by clean_locations), then runs it again
+        locations = pd.concat([
+            trip('2020-06-01 08:00', [0., 1.5, 3.2]),
+            trip('2020-06-01 09:00', [0., 1.5, 3.2])
+        ])
+        stop_times = get_stop_times(locations, OneDirection())
+
+        for stop in StopList.keys:
+            self.assertEqual(len(stop_times[stop]), 2, stop)
+            self.assertEqual([time.hour for time in stop_times[stop]],
+                             [8, 9])
+
+    def test_back_to_start_without_gap(self):
+        # the second trip starts right after the first, only the
+        # distance going back to the start splits them
+        locations = pd.concat([
+            trip('2020-06-01 08:00', [0., 1.5, 3.2]),
+            trip('2020-06-01 08:03', [0., 1.5, 3.2])
+        ])
+        stop_times = get_stop_times(locations, OneDirection())
+        self.assertEqual(len(stop_times['1']), 2)
+        self.assertEqual(len(stop_times['4']), 2)
+
+    def test_gps_noise(self):
+        # small moves backwards stay in the trip and count stops once
+        locations = trip('2020-06-01 08:00', [0., 1.5, 1.3, 2.5, 2.4, 3.2])
+        stop_times = get_stop_times(locations, OneDirection())
+        self.assertEqual([len(stop_times[stop]) for stop in StopList.keys],
+                         [1, 1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,146 @@
+# Script that measures how long location_collector takes to store one
+# minute's snapshot, with the COPY based ingest and with the execute_batch
+# inserts it used before
+#
+# Runs against any Postgres, e.g. a local one; the tables are created as
+# temporary tables that hide the real ones, so no data is written:
+#     python benchmark_ingest.py --dsn "dbname=sfmta" --vehicles 900
+
+import time
+import random
+import argparse
+import statistics
+from datetime import datetime, timedelta
+import pandas as pd
+import psycopg2 as pg
+from psycopg2.extras import execute_batch
+from location_collector import insert_locations, tile_key
+
+# temporary copies of the tables location_collector writes to
+TABLES = """
+CREATE TEMP TABLE locations (
+    id SERIAL PRIMARY KEY,
+    timestamp TIMESTAMP,
+    rid TEXT,
+    vid TEXT,
+    age INTEGER,
+    kph INTEGER,
+    heading INTEGER,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    direction TEXT,
+    tile INTEGER
+);
+CREATE INDEX ON locations (timestamp, id);
+CREATE TEMP TABLE vehicles (
+    vid TEXT PRIMARY KEY,
+    timestamp TIMESTAMP NOT NULL,
+    rid TEXT,
+    age INTEGER,
+    kph INTEGER,
+    heading INTEGER,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    direction TEXT
+);
+"""
+
+
+def fake_vehicles(count):
+    """ returns a restbus-like vehicles response with count vehicles """
+    return [{
+        'id': str(1000 + i),
+        'routeId': str(i % 80),
+        'directionId': f'{i % 80}____O_F00',
+        'predictable': True,
+        'secsSinceReport': random.randint(0, 60),
+        'kph': random.randint(0, 60),
+        'heading': random.randint(0, 359),
+        'lat': round(random.uniform(37.70, 37.81), 6),
+        'lon': round(random.uniform(-122.51, -122.38), 6),
+        'leadingVehicleId': None,
+        '_links': {}
+    } for i in range(count)]
+
+
+def insert_batch(cursor, vehicles, timestamp):
+    """ the previous ingest: a dataframe, a dict per row, execute_batch """
+    df = pd.DataFrame.from_dict(vehicles)
+    df = df.drop(['_links', 'predictable', 'leadingVehicleId'], axis=1)
+    df['timestamp'] = [pd.to_datetime(timestamp)] * len(df)
+    df.columns = ['vid', 'rid', 'direction', 'age', 'kph', 'heading',
+                  'latitude', 'longitude', 'timestamp']
+    df['tile'] = pd.Series([tile_key(lat, lon) for lat, lon
+                            in zip(df['latitude'], df['longitude'])],
+                           index=df.index, dtype=object)
+    rows = list(df.to_dict('index').values())
+
+    execute_batch(cursor, """
+        INSERT INTO locations(timestamp, rid, vid, age, kph, heading,
+                              latitude, longitude, direction, tile)
+        VALUES (%(timestamp)s, %(rid)s, %(vid)s, %(age)s, %(kph)s,
+                %(heading)s, %(latitude)s, %(longitude)s, %(direction)s,
+                %(tile)s);
+    """, rows)
+    execute_batch(cursor, """
+        INSERT INTO vehicles(vid, timestamp, rid, age, kph, heading,
+                             latitude, longitude, direction)
+        VALUES (%(vid)s, %(timestamp)s, %(rid)s, %(age)s, %(kph)s,
+                %(heading)s, %(latitude)s, %(longitude)s, %(direction)s)
+        ON CONFLICT (vid) DO UPDATE SET
+            timestamp = EXCLUDED.timestamp, rid = EXCLUDED.rid,
+            age = EXCLUDED.age, kph = EXCLUDED.kph,
+            heading = EXCLUDED.heading, latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude, direction = EXCLUDED.direction
+        WHERE vehicles.timestamp <= EXCLUDED.timestamp;
+    """, rows)
+
+
+def measure(cnx, insert, vehicles, runs, start):
+    """
+    Stores runs snapshots a minute apart with insert(), committing each
+
+    Returns the time per snapshot in ms
+    """
+    times = []
+    for run in range(runs):
+        timestamp = start + timedelta(minutes=run)
+        began = time.perf_counter()
+        with cnx.cursor() as cursor:
+            insert(cursor, vehicles, timestamp)
+        cnx.commit()
+        times.append((time.perf_counter() - began) * 1000)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare location ingest time per snapshot')
+    parser.add_argument('--dsn', default='dbname=postgres',
+                        help='libpq connection string')
+    parser.add_argument('--vehicles', type=int, default=900,
+                        help='vehicles per snapshot')
+    parser.add_argument('--runs', type=int, default=20,
+                        help='snapshots stored with each method')
+    args = parser.parse_args()
+
+    vehicles = fake_vehicles(args.vehicles)
+    cnx = pg.connect(args.dsn)
+    with cnx.cursor() as cursor:
+        cursor.execute(TABLES)
+    cnx.commit()
+
+    start = datetime(2020, 6, 1)
+    for name, insert in (('execute_batch', insert_batch),
+                         ('COPY', insert_locations)):
+        times = measure(cnx, insert, vehicles, args.runs, start)
+        start += timedelta(days=1)
+        print(f'{name}: {args.vehicles} vehicles, median '
+              f'{statistics.median(times):.1f}ms, min {min(times):.1f}ms '
+              f'per snapshot')
+
+    cnx.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# Resources shared by the Lambda functions, created on first use and reused
+# by later invocations while the Lambda container stays warm: the database
+# connection, and an HTTP session that keeps its connections open
+#
+# Package this file in each function's zip, next to the handler's script.
+
+import os
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg2 as pg
+from psycopg2 import extensions
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# seconds to wait to connect to an API, and between bytes of its response
+HTTP_TIMEOUT = (5, 30)
+
+# failed requests (connection errors and these statuses) are retried,
+# waiting 0.5s, 1s, 2s... in between
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# connections kept open per host, enough for concurrent fetching
+HTTP_POOL_SIZE = 16
+
+# requests sent at once by get_json_all()
+FETCH_WORKERS = 8
+
+_env_loaded = False
+_creds = None
+_connection = None
+_session = None
+
+
+def get_setting(name, default=None):
+    """
+    Returns an environment variable, after loading the .env file once
+    """
+    global _env_loaded
+    if not _env_loaded:
+        load_dotenv()
+        _env_loaded = True
+    return os.environ.get(name, default)
+
+
+def get_creds():
+    """ returns the credentials for the DB connection, loaded once """
+    global _creds
+    if _creds is None:
+        _creds = {
+          'user': get_setting('USER'),
+          'password': get_setting('PASSWORD'),
+          'host': get_setting('HOST'),
+          'dbname': get_setting('DATABASE')
+        }
+    return _creds
+
+
+def get_connection():
+    """
+    Returns the shared database connection, opening it on first use
+
+    A connection left over from an earlier invocation is checked first:
+    an unfinished transaction is rolled back, and a connection the server
+    dropped while the container was idle is replaced.
+
+    Handlers commit their work but don't close the connection.
+    """
+    global _connection
+    if _connection is not None and not _alive(_connection):
+        close_connection()
+    if _connection is None:
+        _connection = pg.connect(**get_creds())
+    return _connection
+
+
+def close_connection():
+    """ closes the shared database connection, if open """
+    global _connection
+    if _connection is not None:
+        try:
+            _connection.close()
+        except pg.Error:
+            pass
+    _connection = None
+
+
+def _alive(cnx):
+    """
+    Returns True if a connection still answers a trivial query, after
+    rolling back anything an earlier invocation left unfinished
+    """
+    if cnx.closed:
+        return False
+    try:
+        if cnx.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            cnx.rollback()
+        with cnx.cursor() as cursor:
+            cursor.execute('SELECT 1;')
+        cnx.rollback()
+        return True
+    except pg.Error:
+        return False
+
+
+def get_session():
+    """
+    Returns the shared requests.Session, created on first use
+
+    It keeps connections alive between requests and invocations, and
+    retries failed requests with exponential backoff.
+    """
+    global _session
+    if _session is None:
+        retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF,
+                      status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(max_retries=retry,
+                              pool_connections=HTTP_POOL_SIZE,
+                              pool_maxsize=HTTP_POOL_SIZE)
+        _session = requests.Session()
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def get_json(url, timeout=HTTP_TIMEOUT):
+    """
+    Returns the JSON response of a GET request through the shared session
+
+    Raises requests.HTTPError if the response is still an error after the
+    retries
+    """
+    response = get_session().get(url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_json_all(urls, workers=FETCH_WORKERS):
+    """
+    Fetches several URLs with get_json(), up to workers at a time
+
+    Arguments:
+        urls (dict): the URL to fetch for each key
+        workers (int): the most requests sent at once
+
+    Yields (key, response JSON) pairs in the order the responses arrive,
+    so each one can be processed while the others are still downloading.
+    A URL that still fails after the retries yields (key, None), after
+    printing the error.
+    """
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(get_json, url): key
+                   for key, url in urls.items()}
+
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                yield key, future.result()
+            except (requests.RequestException, ValueError) as error:
+                # ValueError is an invalid JSON response
+                print(f"Failed to fetch {urls[key]}: {error}")
+                yield key, None
@@ -1,79 +1,262 @@
 # AWS Lambda script that runs every minute
 # pulls data from Restbus and stores in our database
 
-import requests
-import pandas as pd
-import psycopg2 as pg
-from psycopg2.extras import execute_batch
-from dotenv import load_dotenv
-import os
-import time
+import io
+import csv
+from datetime import datetime, timedelta
+import math
+from psycopg2.extras import execute_values
+from lambda_runtime import get_connection, get_json
 
-def lambda_handler(event, context):
+# restbus vehicle fields we store, and the locations columns they go in
+API_FIELDS = {
+    'id': 'vid',
+    'routeId': 'rid',
+    'directionId': 'direction',
+    'secsSinceReport': 'age',
+    'kph': 'kph',
+    'heading': 'heading',
+    'lat': 'latitude',
+    'lon': 'longitude'
+}
 
-    # credentials for DB connection
-    load_dotenv()
-    creds = {
-      'user': os.environ.get('USER'),
-      'password': os.environ.get('PASSWORD'),
-      'host': os.environ.get('HOST'),
-      'dbname': os.environ.get('DATABASE')
-    }
-    
-    # set up database connection
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-    
-    
-    url = 'http://restbus.info/api/agencies/sf-muni/vehicles'
-    retries = 0
-    df = []
+# columns of each row copied into locations, in order
+COLUMNS = ['timestamp'] + list(API_FIELDS.values()) + ['tile']
+
+# columns of the vehicles table, in the order latest_vehicles() returns them
+VEHICLE_COLUMNS = ['timestamp'] + list(API_FIELDS.values())
+
+# the last stored report of each vehicle, as {vid: (report time, latitude,
+# longitude)}, kept between invocations while the Lambda stays warm and
+# loaded from the vehicles table after a cold start
+_last_seen = {}
+
+# a report is a repeat of the last stored one if it is at the same position
+# and its report time is within this many seconds, the age restbus gives is
+# rounded and measured against its own clock
+REPEAT_TOLERANCE = 2
+
+# locations are filed in a grid of 1/TILES_PER_DEGREE degree tiles, for the
+# API's bounding box queries
+TILES_PER_DEGREE = 100
+
+
+def tile_key(latitude, longitude):
+    """
+    Returns the grid tile of a point, or None if it has no coordinates
+
+    Must match tile_key() in sfmta-api/application/locations/locations.py
+    and the fill in migrations/004_locations_tiles.sql next to it
+    """
+    if latitude is None or longitude is None:
+        return None
+    latitude, longitude = float(latitude), float(longitude)
+    if math.isnan(latitude) or math.isnan(longitude):
+        return None
+    row = math.floor((latitude + 90) * TILES_PER_DEGREE)
+    column = math.floor((longitude + 180) * TILES_PER_DEGREE)
+    return row * 65536 + column
+
+
+def fetch_vehicles(url, retries=5):
+    """ returns the list of vehicle dicts from restbus, empty if none """
 
     # Occasionally the API doesn't respond fast enough and returns an empty
     # JSON response "[]".  This tries again automatically up to 5 times.
-    while len(df) == 0 and retries < 5:
-        retries += 1
-
-        # get the vehicle location data from the API, store it in a dataframe
-        r = requests.get(url)
-        df = pd.DataFrame.from_dict(r.json())
+    vehicles = []
+    for _ in range(retries):
+        vehicles = get_json(url)
+        if len(vehicles) > 0:
+            break
 
-    if len(df) == 0:
+    if len(vehicles) == 0:
         print(f"Empty response from restbus API after {retries} retries")
-    
-    # drop columns we aren't storing
-    df = df.drop(['_links', 'predictable', 'leadingVehicleId'], axis=1)
-    
-    # add a timestamp to each row
-    df['timestamp'] = [pd.to_datetime(time.ctime())] * len(df)
-    
-    # name columns to match the database
-    df.columns = ['vid', 'rid', 'direction', 'age', 'kph', 'heading', 
-                  'latitude', 'longitude', 'timestamp']
-    
-    # format data into a list of dicts, each row becomes a separate dict
-    rows = list(df.to_dict('index').values())
-    
-    # psycopg2.extras.execute_batch
-    # inserts the whole dataframe into the database
-    execute_batch(cursor, """
-        INSERT INTO locations(timestamp, rid, vid, age, kph, heading, 
-                              latitude, longitude, direction) 
-        VALUES (
-            %(timestamp)s,
-            %(rid)s,
-            %(vid)s,
-            %(age)s,
-            %(kph)s,
-            %(heading)s,
-            %(latitude)s,
-            %(longitude)s,
-            %(direction)s
-        );
-    """, rows)
-    
-    print(f"Inserted {len(df)} rows")
-    
+
+    return vehicles
+
+
+def report_time(timestamp, age):
+    """ returns when a vehicle reported, collected at timestamp age s later """
+    return timestamp - timedelta(seconds=float(age))
+
+
+def load_last_seen(cursor):
+    """ fills _last_seen from the vehicles table, after a cold start """
+    cursor.execute("""
+        SELECT vid, timestamp, age, latitude, longitude
+        FROM vehicles
+        WHERE age IS NOT NULL;
+    """)
+    for vid, timestamp, age, latitude, longitude in cursor.fetchall():
+        _last_seen[vid] = (report_time(timestamp, age), latitude, longitude)
+
+
+def new_reports(vehicles, timestamp):
+    """
+    Returns the vehicles whose report isn't a repeat of their last stored
+    report, i.e. restbus had no new report from them since
+
+    Repeats are what clean_locations() in the report generation drops for
+    their age, so they aren't stored at all.
+    """
+    fresh = []
+    for vehicle in vehicles:
+        seen = _last_seen.get(str(vehicle.get('id')))
+        age = vehicle.get('secsSinceReport')
+        if seen is not None and age is not None:
+            last_time, latitude, longitude = seen
+            repeat = (
+                abs((report_time(timestamp, age) - last_time)
+                    .total_seconds()) <= REPEAT_TOLERANCE and
+                vehicle.get('lat') == latitude and
+                vehicle.get('lon') == longitude)
+            if repeat:
+                continue
+        fresh.append(vehicle)
+
+    return fresh
+
+
+def remember(vehicles, timestamp):
+    """ records the stored reports in _last_seen, once committed """
+    for vehicle in vehicles:
+        if vehicle.get('secsSinceReport') is not None:
+            _last_seen[str(vehicle.get('id'))] = (
+                report_time(timestamp, vehicle['secsSinceReport']),
+                vehicle.get('lat'), vehicle.get('lon'))
+
+
+def copy_buffer(snapshots):
+    """
+    Returns snapshots of vehicles as an in-memory CSV file, one row per
+    vehicle in COLUMNS order, for COPY FROM STDIN
+
+    Each snapshot's collection timestamp is formatted once and shared by
+    its rows, missing values are written as empty fields, which COPY reads
+    as NULL.
+
+    Arguments:
+        snapshots (list): (timestamp, vehicles) pairs
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    for timestamp, vehicles in snapshots:
+        stamp = timestamp.isoformat(sep=' ')
+        writer.writerows(
+            [stamp] +
+            [vehicle.get(field) for field in API_FIELDS] +
+            [tile_key(vehicle.get('lat'), vehicle.get('lon'))]
+            for vehicle in vehicles)
+
+    buffer.seek(0)
+    return buffer
+
+
+def latest_vehicles(snapshots):
+    """
+    Returns the latest report of each vehicle in some snapshots, as tuples
+    in VEHICLE_COLUMNS order
+
+    Snapshots are in collection order, so a later one replaces an earlier
+    one with the same timestamp, like the rows COPY inserts after it.
+
+    Arguments:
+        snapshots (list): (timestamp, vehicles) pairs
+    """
+    latest = {}
+    for timestamp, vehicles in snapshots:
+        for vehicle in vehicles:
+            vid = vehicle.get('id')
+            if vid is None:
+                continue
+            if vid not in latest or latest[vid][0] <= timestamp:
+                latest[vid] = ((timestamp,) +
+                               tuple(vehicle.get(field)
+                                     for field in API_FIELDS))
+    return list(latest.values())
+
+
+def insert_locations(cursor, vehicles, timestamp):
+    """
+    Stores a snapshot of vehicle locations, and updates each vehicle's
+    latest report in the vehicles table
+
+    Arguments:
+        cursor (psycopg2 cursor): cursor in the transaction to write in
+        vehicles (list): vehicle dicts from restbus
+        timestamp (datetime): the collection time of the snapshot
+    """
+    insert_snapshots(cursor, [(timestamp, vehicles)])
+
+
+def insert_snapshots(cursor, snapshots):
+    """
+    Stores several snapshots of vehicle locations at once, and updates each
+    vehicle's latest report in the vehicles table
+
+    Arguments:
+        cursor (psycopg2 cursor): cursor in the transaction to write in
+        snapshots (list): (timestamp, vehicles) pairs, vehicles being
+                          vehicle dicts from restbus
+    """
+
+    # COPY streams every snapshot in one round trip, parsed by the
+    # server, instead of an INSERT per row
+    cursor.copy_expert(f"""
+        COPY locations ({', '.join(COLUMNS)})
+        FROM STDIN WITH (FORMAT csv)
+    """, copy_buffer(snapshots))
+
+    # keep the latest report of each vehicle in the vehicles table,
+    # so the real-time endpoints don't need to search the history
+    # built from the snapshots in memory, rather than reading back rows
+    # that another collector may have stored with the same timestamps
+    execute_values(cursor, f"""
+        INSERT INTO vehicles({', '.join(VEHICLE_COLUMNS)})
+        VALUES %s
+        ON CONFLICT (vid) DO UPDATE SET
+            timestamp = EXCLUDED.timestamp,
+            rid = EXCLUDED.rid,
+            age = EXCLUDED.age,
+            kph = EXCLUDED.kph,
+            heading = EXCLUDED.heading,
+            latitude = EXCLUDED.latitude,
+            longitude = EXCLUDED.longitude,
+            direction = EXCLUDED.direction
+        WHERE vehicles.timestamp <= EXCLUDED.timestamp;
+    """, latest_vehicles(snapshots), page_size=1000)
+
+
+def lambda_handler(event, context):
+
+    url = 'http://restbus.info/api/agencies/sf-muni/vehicles'
+    vehicles = fetch_vehicles(url)
+    if len(vehicles) == 0:
+        return
+
+    # one collection time for the whole snapshot, to the second
+    timestamp = datetime.now().replace(microsecond=0)
+
+    # reuse the database connection of earlier invocations, if any
+    cnx = get_connection()
+    cursor = cnx.cursor()
+
+    # skip the reports that were already stored
+    if not _last_seen:
+        load_last_seen(cursor)
+    fresh = new_reports(vehicles, timestamp)
+
+    if fresh:
+        insert_locations(cursor, fresh, timestamp)
+
+        # tell listening APIs to reload their vehicle snapshot,
+        # delivered when the transaction commits
+        cursor.execute("SELECT pg_notify('vehicles', '');")
+    print(f"Inserted {len(fresh)} rows, "
+          f"skipped {len(vehicles) - len(fresh)} repeated reports")
+
     cursor.close()
     cnx.commit()
-    cnx.close()
+
+    remember(fresh, timestamp)
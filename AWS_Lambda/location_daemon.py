@@ -0,0 +1,296 @@
+# Long-running alternative to the location collector Lambda, which can only
+# run once a minute: polls the vehicles feed every few seconds, and writes
+# the snapshots to the database in batches
+#
+#     python location_daemon.py --interval 10
+#
+# Fetching and writing overlap: a snapshot is fetched while the previous
+# batch is being written.  SIGINT or SIGTERM stops the polling, writes what
+# is still buffered, then exits.
+#
+# To try it without the real feed or a database, serve fake vehicles with
+# stub_feed.py and drop the batches instead of writing them:
+#
+#     python stub_feed.py --port 8001
+#     python location_daemon.py --url http://localhost:8001/vehicles --dry-run
+
+import asyncio
+import argparse
+import signal
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import location_collector as collector
+import lambda_runtime
+
+VEHICLES_URL = 'http://restbus.info/api/agencies/sf-muni/vehicles'
+
+
+def write_snapshots(snapshots):
+    """
+    Writes (timestamp, vehicles) snapshots in one transaction, and tells
+    listening APIs to reload their vehicle snapshot
+    """
+    cnx = lambda_runtime.get_connection()
+    with cnx.cursor() as cursor:
+        collector.insert_snapshots(cursor, snapshots)
+        cursor.execute("SELECT pg_notify('vehicles', '');")
+    cnx.commit()
+
+
+def load_last_seen():
+    """
+    Loads each vehicle's last stored report, so reports already stored
+    before a restart are skipped
+    """
+    cnx = lambda_runtime.get_connection()
+    with cnx.cursor() as cursor:
+        collector.load_last_seen(cursor)
+    cnx.rollback()
+
+
+def discard_snapshots(snapshots):
+    """ drops a batch instead of writing it, for --dry-run """
+    pass
+
+
+class LocationDaemon:
+    def __init__(self, url=VEHICLES_URL, interval=10, batch_size=5000,
+                 flush_after=60, max_buffer=200000, write=write_snapshots,
+                 load=load_last_seen):
+        """
+        The LocationDaemon class polls the vehicles feed and buffers the new
+        reports in memory, writing them in batches
+
+        Reports that repeat a vehicle's last report are skipped, as in the
+        location collector Lambda.
+
+        Blocking work runs in threads: fetching in one, writing in another,
+        so a slow write doesn't delay the next poll.
+
+        Parameters:
+
+        url (str)
+            - the vehicles feed, a JSON list of restbus vehicle dicts
+
+        interval (float)
+            - seconds between polls, polls missed while a fetch was slower
+              than this are skipped
+
+        batch_size (int)
+            - buffered rows that trigger a write
+
+        flush_after (float)
+            - seconds between writes when fewer than batch_size rows come in
+
+        max_buffer (int)
+            - rows kept while writes fail, the oldest snapshots are dropped
+              past this
+
+        write (function)
+            - called with a list of (timestamp, vehicles) snapshots to
+              store them, raises to keep them buffered
+
+        load (function)
+            - called once before polling to load the last stored reports,
+              or None
+        """
+        if interval < 1:
+            raise ValueError('interval must be at least 1 second, '
+                             'snapshots are timestamped to the second')
+
+        self.url = url
+        self.interval = interval
+        self.batch_size = batch_size
+        self.flush_after = flush_after
+        self.max_buffer = max_buffer
+        self.write = write
+        self.load = load
+
+        # buffered (timestamp, vehicles) snapshots, oldest first
+        self._buffer = []
+        self._rows = 0
+
+        self._fetcher = ThreadPoolExecutor(1, 'fetch')
+        self._writer = ThreadPoolExecutor(1, 'write')
+
+        # created in run(), in the event loop that uses them
+        self._stopping = None
+        self._full = None
+
+        self.counts = {
+            'polls': 0,
+            'failed_polls': 0,
+            'skipped_polls': 0,
+            'repeats': 0,
+            'flushes': 0,
+            'failed_flushes': 0,
+            'written': 0,
+            'dropped': 0
+        }
+
+    async def run(self):
+        """
+        Polls and writes until stop() is called or the process is sent
+        SIGINT or SIGTERM, then writes the buffered rows
+        """
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._full = asyncio.Event()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        if self.load is not None:
+            await loop.run_in_executor(self._writer, self.load)
+
+        poller = asyncio.ensure_future(self._poll_loop())
+        flusher = asyncio.ensure_future(self._flush_loop())
+
+        # the poll in progress finishes before the last flush
+        await asyncio.gather(poller, flusher)
+        await self.flush()
+
+        self._fetcher.shutdown()
+        self._writer.shutdown()
+
+        if self._rows:
+            print(f"Stopped with {self._rows} rows left unwritten")
+        print('Stopped:', ', '.join(f'{name} {count}' for name, count
+                                    in self.counts.items()))
+
+    def stop(self):
+        """ stops polling, run() returns once the buffer is written """
+        self._stopping.set()
+        self._full.set()
+
+    async def poll(self):
+        """ fetches one snapshot and buffers its new reports """
+        loop = asyncio.get_running_loop()
+        self.counts['polls'] += 1
+
+        # one collection time for the whole snapshot, to the second
+        timestamp = datetime.utcnow().replace(microsecond=0)
+        try:
+            vehicles = await loop.run_in_executor(
+                self._fetcher, lambda_runtime.get_json, self.url)
+        except Exception:
+            self.counts['failed_polls'] += 1
+            traceback.print_exc()
+            return
+
+        fresh = collector.new_reports(vehicles, timestamp)
+        self.counts['repeats'] += len(vehicles) - len(fresh)
+        if not fresh:
+            return
+
+        # remembered now rather than once written, so the next polls skip
+        # them while they are still buffered
+        collector.remember(fresh, timestamp)
+        self._buffer.append((timestamp, fresh))
+        self._rows += len(fresh)
+
+        if self._rows >= self.batch_size:
+            self._full.set()
+
+    async def flush(self):
+        """
+        Writes the buffered snapshots
+
+        The buffer is swapped out first, so polls keep buffering while the
+        write runs.  If it fails, the snapshots go back in the buffer for
+        the next flush.
+        """
+        if not self._buffer:
+            return
+
+        loop = asyncio.get_running_loop()
+        snapshots, self._buffer = self._buffer, []
+        rows, self._rows = self._rows, 0
+
+        start = time.perf_counter()
+        try:
+            await loop.run_in_executor(self._writer, self.write, snapshots)
+        except Exception:
+            self.counts['failed_flushes'] += 1
+            traceback.print_exc()
+            self._requeue(snapshots, rows)
+            return
+
+        self.counts['flushes'] += 1
+        self.counts['written'] += rows
+        print(f"Flushed {rows} rows from {len(snapshots)} snapshots "
+              f"in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def _requeue(self, snapshots, rows):
+        """
+        Puts snapshots that failed to write back at the front of the buffer,
+        dropping the oldest ones past max_buffer
+        """
+        self._buffer = snapshots + self._buffer
+        self._rows += rows
+
+        while self._rows > self.max_buffer and len(self._buffer) > 1:
+            _, vehicles = self._buffer.pop(0)
+            self._rows -= len(vehicles)
+            self.counts['dropped'] += len(vehicles)
+
+    async def _poll_loop(self):
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time()
+
+        while not self._stopping.is_set():
+            await self.poll()
+
+            next_poll += self.interval
+            if next_poll < loop.time():
+                missed = int((loop.time() - next_poll) // self.interval) + 1
+                self.counts['skipped_polls'] += missed
+                next_poll += missed * self.interval
+
+            try:
+                await asyncio.wait_for(self._stopping.wait(),
+                                       next_poll - loop.time())
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush_loop(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_after)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            # the last flush is done by run(), after the last poll
+            if not self._stopping.is_set():
+                await self.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Poll the vehicles feed and store the locations')
+    parser.add_argument('--url', default=VEHICLES_URL,
+                        help='vehicles feed URL')
+    parser.add_argument('--interval', type=float, default=10,
+                        help='seconds between polls')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='buffered rows that trigger a write')
+    parser.add_argument('--flush-after', type=float, default=60,
+                        help='most seconds between writes')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='drop the batches instead of writing them')
+    args = parser.parse_args()
+
+    daemon = LocationDaemon(
+        url=args.url, interval=args.interval, batch_size=args.batch_size,
+        flush_after=args.flush_after,
+        write=discard_snapshots if args.dry_run else write_snapshots,
+        load=None if args.dry_run else load_last_seen)
+
+    asyncio.run(daemon.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,9 @@
 # Script that collects route data from Restbus and stores it in the database
 
-import os
-import json
-import requests
-import psycopg2 as pg
-from dotenv import load_dotenv
 from datetime import date
-
-
-def load_db():
-    """ loads the database and returns the connection object """
-
-    # load credentials
-    load_dotenv()
-    creds = {
-      'user': os.environ.get('USER'),
-      'password': os.environ.get('PASSWORD'),
-      'host': os.environ.get('HOST'),
-      'dbname': os.environ.get('DATABASE')
-    }
-
-    # return the database connection
-    return pg.connect(**creds)
+from lambda_runtime import get_connection, get_json, get_json_all
+from versions import (canonical_json, content_hash, latest_versions,
+                      is_unchanged)
 
 
 def get_active_routes():
@@ -30,11 +12,11 @@ def get_active_routes():
     # call api to get all current routes
     #url = 'http://restbus.info/api/agencies/sf-muni/routes'
     url = 'http://webservices.nextbus.com/service/publicJSONFeed?command=routeList&a=sf-muni'
-    r = requests.get(url)
+    routes = get_json(url)
 
     # extract id's
     route_list = []
-    for route in r.json()['route']:
+    for route in routes['route']:
         route_list.append(route['tag'])
 
     # return the list
@@ -96,8 +78,8 @@ def collect_routes(event, context, verbose=True):
         enables print statements that go to the AWS logs
     """
 
-    # set up database connection
-    cnx = load_db()
+    # reuse the database connection of earlier invocations, if any
+    cnx = get_connection()
     cursor = cnx.cursor()
 
     # get a list of active route id's
@@ -105,43 +87,44 @@ def collect_routes(event, context, verbose=True):
     if verbose:
         print(f"Found {len(route_list)} active routes")
 
-    # for each route id
-    for rid in route_list:
-        # build API url
-        #url = 'http://restbus.info/api/agencies/sf-muni/routes/'+rid
-        url = 'http://webservices.nextbus.com/service/publicJSONFeed?command=routeConfig&a=sf-muni&r='+rid
-
-        # get the schedule json
-        new_route = requests.get(url).json()
-
-        # check if it exists already
-        # run query to get latest schedule with this rid
-        query = """
-            SELECT *
-            FROM routes
-            WHERE rid = %s
-            ORDER BY begin_date DESC
-            LIMIT 1;
-        """
-        cursor.execute(query, (rid,))
-        row = cursor.fetchone()
-        # row is a tuple of (id, rid, route_name, route_type, begin_date, end_date, content)
+    # the id and content hash of every route's latest definition
+    latest = latest_versions(cursor, 'routes')
+
+    # build API url for each route id
+    #url = 'http://restbus.info/api/agencies/sf-muni/routes/'
+    url = 'http://webservices.nextbus.com/service/publicJSONFeed?command=routeConfig&a=sf-muni&r='
+    urls = {rid: url + rid for rid in route_list}
+
+    # fetch the route definitions several at a time, and store each one
+    # as soon as it arrives
+    for rid, new_route in get_json_all(urls):
+        if new_route is None:
+            # the old definition stays current until the next run
+            print(f"Could not fetch route {rid}, skipped")
+            continue
+
+        # serialize once, for the hash and the insert
+        content = canonical_json(new_route)
+        digest = content_hash(content)
+        row = latest.get(rid)
+        # row is a tuple of (id, content_hash) of the latest definition
 
         if row == None:
             # no route with this rid was found, just insert the new route data
             query = """
-                INSERT INTO routes (rid, route_name, route_type, begin_date, content)
-                VALUES (%s, %s, %s, %s, %s);
+                INSERT INTO routes (rid, route_name, route_type, begin_date,
+                                    content, content_hash)
+                VALUES (%s, %s, %s, %s, %s, %s);
             """
             cursor.execute(query, (rid, new_route['route']['title'],
                                    get_type(rid, new_route['route']['title']),
                                    date.today().isoformat(),
-                                   json.dumps(new_route)))
+                                   content, digest))
 
             if verbose:
                 print(f"No Route with rid {rid} found, inserted new row")
 
-        elif row[6] != new_route:
+        elif not is_unchanged(cursor, 'routes', row, new_route, digest):
             # new route is different
             # update the end date of the old route definition
             query = """
@@ -153,13 +136,14 @@ def collect_routes(event, context, verbose=True):
 
             # and insert the new schedule
             query = """
-                INSERT INTO routes (rid, route_name, route_type, begin_date, content)
-                VALUES (%s, %s, %s, %s, %s);
+                INSERT INTO routes (rid, route_name, route_type, begin_date,
+                                    content, content_hash)
+                VALUES (%s, %s, %s, %s, %s, %s);
             """
             cursor.execute(query, (rid, new_route['route']['title'],
                                    get_type(rid, new_route['route']['title']),
                                    date.today().isoformat(),
-                                   json.dumps(new_route)))
+                                   content, digest))
 
             if verbose:
                 print(f"Definition for route {rid} updated")
@@ -171,4 +155,3 @@ def collect_routes(event, context, verbose=True):
 
     cursor.close()
     cnx.commit()
-    cnx.close()
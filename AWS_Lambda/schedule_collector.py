@@ -1,40 +1,60 @@
-import os
-import json
-import requests
-import psycopg2 as pg
-from dotenv import load_dotenv
 from datetime import date
+from lambda_runtime import get_connection, get_json, get_json_all, get_setting
+from versions import (canonical_json, content_hash, latest_versions,
+                      is_unchanged, version_delta)
 
-def load_db():
-    """ loads the database and returns the connection object """
-
-    # load credentials
-    load_dotenv()
-    creds = {
-      'user': os.environ.get('USER'),
-      'password': os.environ.get('PASSWORD'),
-      'host': os.environ.get('HOST'),
-      'dbname': os.environ.get('DATABASE')
-    }
-
-    # return the database connection
-    return pg.connect(**creds)
+# with SCHEDULE_DELTAS=1 in the environment, a changed schedule is stored as
+# a delta against the route's latest full version (its keyframe), and in
+# full once its keyframe has KEYFRAME_EVERY deltas, or if the delta is over
+# KEYFRAME_RATIO of the full schedule's size
+KEYFRAME_EVERY = 10
+KEYFRAME_RATIO = .5
 
 def get_active_routes():
     """ returns a list of active route id's """
 
     # call api to get all current routes
     url = 'http://restbus.info/api/agencies/sf-muni/routes'
-    r = requests.get(url)
+    routes = get_json(url)
 
     # extract id's
     route_list = []
-    for route in r.json():
+    for route in routes:
         route_list.append(route['id'])
 
     # return the list
     return route_list
 
+def delta_version(cursor, rid, new_schedule, content):
+    """
+    returns (base_id, delta) to store a new schedule as a delta against the
+    route's latest keyframe, or (None, None) to store it in full
+
+    param content:
+        the new schedule as canonical JSON, to compare sizes
+    """
+
+    # the latest full version, and how many deltas it already has
+    query = """
+        SELECT id, content,
+            (SELECT count(*) FROM schedules d WHERE d.base_id = k.id)
+        FROM schedules k
+        WHERE rid = %s AND content IS NOT NULL
+        ORDER BY begin_date DESC, id DESC
+        LIMIT 1;
+    """
+    cursor.execute(query, (rid,))
+    row = cursor.fetchone()
+    if row is None or row[2] >= KEYFRAME_EVERY:
+        return None, None
+
+    # a schedule that went back to its keyframe gets an empty delta
+    delta = canonical_json(version_delta(row[1], new_schedule))
+    if len(delta) > KEYFRAME_RATIO * len(content):
+        return None, None
+
+    return row[0], delta
+
 def collect_schedules(event, context, verbose=True):
     """
     main handler function, called by AWS Lambda
@@ -46,8 +66,8 @@ def collect_schedules(event, context, verbose=True):
         enables print statements that go to the AWS logs
     """
 
-    # set up database connection
-    cnx = load_db()
+    # reuse the database connection of earlier invocations, if any
+    cnx = get_connection()
     cursor = cnx.cursor()
 
     # get a list of active route id's
@@ -55,41 +75,48 @@ def collect_schedules(event, context, verbose=True):
     if verbose:
         print(f"Found {len(route_list)} active routes")
 
-    # for each route id
-    for rid in route_list:
-        # build API url
-        url = 'http://webservices.nextbus.com/service/publicJSONFeed?command=schedule&a=sf-muni&r='+rid
-
-        # get the schedule json
-        r = requests.get(url)
-        new_schedule = r.json()
-
-        # check if it exists already
-        # run query to get latest schedule with this rid
-        query = """
-            SELECT *
-            FROM schedules
-            WHERE rid = %s
-            ORDER BY begin_date DESC
-            LIMIT 1;
-        """
-        cursor.execute(query, (rid,))
-        row = cursor.fetchone()
-        # row is a tuple of (id, rid, begin_date, end_date, content)
+    # store changed schedules as deltas, see delta_version()
+    use_deltas = get_setting('SCHEDULE_DELTAS') == '1'
+
+    # the id and content hash of every route's latest schedule
+    latest = latest_versions(cursor, 'schedules')
+
+    # build API url for each route id
+    url = 'http://webservices.nextbus.com/service/publicJSONFeed?command=schedule&a=sf-muni&r='
+    urls = {rid: url + rid for rid in route_list}
+
+    # fetch the schedules several at a time, and store each one as soon
+    # as it arrives
+    for rid, new_schedule in get_json_all(urls):
+        if new_schedule is None:
+            # the old schedule stays current until the next run
+            print(f"Could not fetch schedule for route {rid}, skipped")
+            continue
+
+        # serialize once, for the hash and the insert
+        content = canonical_json(new_schedule)
+        digest = content_hash(content)
+        row = latest.get(rid)
+        # row is a tuple of (id, content_hash) of the latest schedule
 
         if row == None:
             # no schedule with this rid was found, just insert the new schedule
             query = """
-                INSERT INTO schedules (rid, begin_date, content)
-                VALUES (%s, %s, %s);
+                INSERT INTO schedules (rid, begin_date, content, content_hash)
+                VALUES (%s, %s, %s, %s);
             """
-            cursor.execute(query, (rid, date.today().isoformat(), 
-                                   json.dumps(new_schedule)))
+            cursor.execute(query, (rid, date.today().isoformat(),
+                                   content, digest))
+
+            # tell listening APIs to drop cached info for this route,
+            # delivered when the transaction commits
+            cursor.execute("SELECT pg_notify('schedules', %s);", (rid,))
 
             if verbose:
                 print(f"No schedule with rid {rid} found, inserted new row")
 
-        elif row[4] != new_schedule:
+        elif not is_unchanged(cursor, 'schedules', row, new_schedule,
+                              digest):
             # new schedule is different
             # update the end date of the old schedule
             query = """
@@ -99,16 +126,27 @@ def collect_schedules(event, context, verbose=True):
             """
             cursor.execute(query, (date.today().isoformat(), row[0]))
 
-            # and insert the new schedule
+            # and insert the new schedule, as a delta if enabled
+            base_id, delta = None, None
+            if use_deltas:
+                base_id, delta = delta_version(cursor, rid, new_schedule,
+                                               content)
             query = """
-                INSERT INTO schedules (rid, begin_date, content)
-                VALUES (%s, %s, %s);
+                INSERT INTO schedules (rid, begin_date, content, content_hash,
+                                       base_id, delta)
+                VALUES (%s, %s, %s, %s, %s, %s);
             """
-            cursor.execute(query, (rid, date.today().isoformat(), 
-                                   json.dumps(new_schedule)))
+            cursor.execute(query, (rid, date.today().isoformat(),
+                                   content if delta is None else None,
+                                   digest, base_id, delta))
+
+            # tell listening APIs to drop cached info for this route,
+            # delivered when the transaction commits
+            cursor.execute("SELECT pg_notify('schedules', %s);", (rid,))
 
             if verbose:
-                print(f"Schedule for route {rid} updated")
+                stored = 'as a delta' if delta is not None else 'in full'
+                print(f"Schedule for route {rid} updated, stored {stored}")
 
         else:
             # new schedule is same as old schedule, no updates needed
@@ -117,4 +155,3 @@ def collect_schedules(event, context, verbose=True):
 
     cursor.close()
     cnx.commit()
-    cnx.close()
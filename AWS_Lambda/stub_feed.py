@@ -0,0 +1,96 @@
+# Script that serves a fake restbus vehicles feed, to run location_daemon.py
+# locally without calling the real API
+#
+#     python stub_feed.py --port 8001 --vehicles 900
+#
+# GET /vehicles returns the vehicles in restbus' format.  Each vehicle sends
+# a new report every --report-every seconds, moving a little each time, and
+# repeats its last report in between like the real feed.
+
+import json
+import math
+import time
+import random
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def make_vehicles(count, report_every):
+    """ returns count fake vehicles spread over San Francisco """
+    now = time.time()
+    return [{
+        'id': str(1000 + number),
+        'routeId': random.choice(['1', '5', '14', '38', 'N', 'KT']),
+        'directionId': random.choice(['0', '1']),
+        'heading': random.randrange(0, 360),
+        'lat': round(random.uniform(37.71, 37.81), 6),
+        'lon': round(random.uniform(-122.51, -122.39), 6),
+        'kph': 0,
+        # staggered, so they don't all report at the same time
+        'reported': now - random.uniform(0, report_every)
+    } for number in range(count)]
+
+
+def snapshot(vehicles, report_every):
+    """
+    Moves the vehicles whose next report is due, and returns the feed as a
+    list of restbus vehicle dicts
+    """
+    now = time.time()
+    feed = []
+    for vehicle in vehicles:
+        if now - vehicle['reported'] >= report_every:
+            vehicle['reported'] = now
+            vehicle['kph'] = random.randrange(0, 40)
+            distance = vehicle['kph'] / 3600 * report_every / 111
+            angle = math.radians(vehicle['heading'])
+            vehicle['lat'] = round(vehicle['lat'] +
+                                   distance * math.cos(angle), 6)
+            vehicle['lon'] = round(vehicle['lon'] +
+                                   distance * math.sin(angle), 6)
+
+        report = {key: value for key, value in vehicle.items()
+                  if key != 'reported'}
+        report['secsSinceReport'] = int(now - vehicle['reported'])
+        feed.append(report)
+
+    return feed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake vehicles feed')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--vehicles', type=int, default=900,
+                        help='number of vehicles')
+    parser.add_argument('--report-every', type=float, default=30,
+                        help='seconds between reports of each vehicle')
+    args = parser.parse_args()
+
+    vehicles = make_vehicles(args.vehicles, args.report_every)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/vehicles':
+                self.send_error(404)
+                return
+
+            body = json.dumps(snapshot(vehicles, args.report_every)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('', args.port), Handler)
+    print(f'Serving {args.vehicles} vehicles on '
+          f'http://localhost:{args.port}/vehicles')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# Tests for the schedule delta storage, run from this folder:
+#
+#     python -m unittest test_versions
+
+import os
+import sys
+import json
+import copy
+import unittest
+import importlib.util
+from versions import (canonical_json, diff_content, apply_delta,
+                      version_delta)
+import schedule_collector
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(here, 'Report_Generation'))
+import report_classes  # noqa: E402
+
+# the API's copy of apply_delta(), loaded by path since the API's modules
+# are imported from its application folder
+spec = importlib.util.spec_from_file_location(
+    'api_schedule', os.path.join(here, '..', 'sfmta-api', 'application',
+                                 'schedule', 'schedule.py'))
+api_schedule = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(api_schedule)
+
+
+def make_schedule(trips=100):
+    """ returns a small schedule in the Nextbus format """
+    return {
+        'route': [{
+            'serviceClass': 'wkd',
+            'direction': 'Inbound',
+            'tr': [{'blockID': str(trip),
+                    'stop': [{'tag': 'a', 'content': f'{trip}:00'}]}
+                   for trip in range(trips)]
+        }],
+        'copyright': 'All data copyright SFMTA'
+    }
+
+
+class SchedulesTable:
+    """
+    A cursor over schedule rows in memory, answering the queries of
+    schedule_collector.delta_version() and report_classes.read_schedule()
+    """
+    def __init__(self, rows):
+        # {id: (content, base_id, delta)}, as psycopg2 returns them
+        self.rows = rows
+        self.result = None
+
+    def execute(self, query, params):
+        if 'count(*)' in query:
+            keyframes = [id for id, row in self.rows.items()
+                         if row[0] is not None]
+            keyframe = max(keyframes)
+            deltas = sum(row[1] == keyframe for row in self.rows.values())
+            self.result = (keyframe, self.rows[keyframe][0], deltas)
+        else:
+            self.result = self.rows[params[0]]
+
+    def fetchone(self):
+        return self.result
+
+
+class TestDeltas(unittest.TestCase):
+    def setUp(self):
+        report_classes._schedule_cache.clear()
+
+    def test_round_trip(self):
+        old = make_schedule()
+        new = copy.deepcopy(old)
+        new['route'][0]['tr'][5]['stop'][0]['content'] = '5:30'
+        del new['route'][0]['tr'][7]
+        new['route'][0]['tr'].insert(2, {'blockID': 'x', 'stop': []})
+
+        delta = json.loads(canonical_json(diff_content(old, new)))
+        self.assertEqual(apply_delta(old, delta), new)
+        self.assertEqual(old, make_schedule())
+
+    def test_empty_delta(self):
+        schedule = make_schedule()
+        self.assertIsNone(diff_content(schedule, schedule))
+        delta = version_delta(schedule, copy.deepcopy(schedule))
+        self.assertEqual(delta, {'keys': {}, 'removed': []})
+        self.assertEqual(apply_delta(schedule, delta), schedule)
+
+    def test_revert_to_keyframe(self):
+        keyframe = make_schedule()
+        changed = copy.deepcopy(keyframe)
+        changed['route'][0]['tr'][3]['stop'][0]['content'] = '3:15'
+        table = SchedulesTable({1: (keyframe, None, None)})
+
+        # a changed version, then a version equal to the keyframe again,
+        # both stored as deltas the way schedule_collector inserts them
+        for id, schedule in [(2, changed), (3, keyframe)]:
+            base_id, delta = schedule_collector.delta_version(
+                table, 'X', schedule, canonical_json(schedule))
+            self.assertEqual(base_id, 1)
+            self.assertNotEqual(delta, 'null')
+            table.rows[id] = (None, base_id, json.loads(delta))
+
+        self.assertEqual(report_classes.read_schedule(2, table), changed)
+        self.assertEqual(report_classes.read_schedule(3, table), keyframe)
+
+    def test_read_null_delta(self):
+        # rows stored before empty deltas were explicit have a JSON null
+        # delta, they are still rebuilt from their keyframe
+        keyframe = make_schedule()
+        table = SchedulesTable({1: (keyframe, None, None),
+                                2: (None, 1, None)})
+        self.assertEqual(report_classes.read_schedule(2, table), keyframe)
+
+    def test_copies_agree(self):
+        # the report uses this file's apply_delta(), the API has a copy
+        self.assertIs(report_classes.apply_delta, apply_delta)
+
+        old = make_schedule(20)
+        new = copy.deepcopy(old)
+        new['route'][0]['tr'][5]['stop'][0]['content'] = '5:30'
+        del new['route'][0]['tr'][7:9]
+        new['route'][0]['tr'].insert(2, {'blockID': 'x', 'stop': []})
+        new['route'][0]['serviceClass'] = 'sat'
+        new['route'].append({'serviceClass': 'sun', 'tr': []})
+        new['copyright'] = None
+        new['header'] = {'stop': ['a', 'b']}
+        renamed = {key: value for key, value in old.items()
+                   if key != 'copyright'}
+
+        deltas = [
+            (old, None),
+            (old, version_delta(old, copy.deepcopy(old))),
+            (old, {'value': [1, 2]}),
+            (old, json.loads(canonical_json(diff_content(old, new)))),
+            (old, diff_content(old, renamed)),
+            ([1, 2, 3], diff_content([1, 2, 3], [0, 1, 3, 4])),
+            ([1, 2, 3], version_delta([1, 2, 3], [1, 2, 3]))
+        ]
+        for base, delta in deltas:
+            self.assertEqual(api_schedule.apply_delta(base, delta),
+                             apply_delta(base, delta))
+
+
+if __name__ == "__main__":
+    unittest.main()
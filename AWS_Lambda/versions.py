@@ -0,0 +1,194 @@
+# Change detection shared by route_collector and schedule_collector, which
+# store a new version of a route's definition or schedule when it changes,
+# and the schedule deltas read back by the report
+#
+# Package this file in both functions' zips and the report's, next to the
+# script.
+#
+# A schedule stored as a delta (content NULL, see schedule_collector) always
+# has a keyframe, a version stored in full, as its base_id: delta_version()
+# only picks rows with content as bases.  So any version is rebuilt with a
+# single apply_delta() on its base's content, which the readers
+# (read_schedule() in Report_Generation/report_classes.py and
+# load_schedule() in sfmta-api/application/schedule/schedule.py) rely on.
+
+import json
+import hashlib
+from difflib import SequenceMatcher
+
+
+def canonical_json(content):
+    """
+    Returns content serialized as canonical JSON: keys sorted and no
+    whitespace, so equal content always gives the same text
+
+    Also used as the text inserted in the content column, so each new
+    version is only serialized once.
+    """
+    return json.dumps(content, sort_keys=True, separators=(',', ':'),
+                      ensure_ascii=False)
+
+
+def content_hash(text):
+    """ returns the SHA-256 hex digest of canonical_json() text """
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def latest_versions(cursor, table):
+    """
+    Returns the latest version of every route in a table, in one query
+    without the content
+
+    Arguments:
+        cursor (psycopg2 cursor): cursor to query with
+        table (str): 'routes' or 'schedules'
+
+    Returns a dict of {rid: (id, content_hash)}, content_hash is None for
+    versions stored before the column existed
+    """
+    cursor.execute(f"""
+        SELECT DISTINCT ON (rid) rid, id, content_hash
+        FROM {table}
+        ORDER BY rid, begin_date DESC, id DESC;
+    """)
+    return {rid: (version_id, digest)
+            for rid, version_id, digest in cursor.fetchall()}
+
+
+def is_unchanged(cursor, table, version, content, digest):
+    """
+    Returns True if a stored version has the same content as a new one
+
+    Compares hashes.  A version without a hash has its content read and
+    compared instead, and gets the hash if it is the same, so it is only
+    read once.
+
+    Arguments:
+        cursor (psycopg2 cursor): cursor in the collector's transaction
+        table (str): 'routes' or 'schedules'
+        version (tuple): (id, content_hash) from latest_versions()
+        content (dict): the new content, as returned by the API
+        digest (str): content_hash() of the new content
+    """
+    version_id, stored = version
+    if stored is not None:
+        return stored == digest
+
+    cursor.execute(f"SELECT content FROM {table} WHERE id = %s;",
+                   (version_id,))
+    if cursor.fetchone()[0] != content:
+        return False
+
+    cursor.execute(f"UPDATE {table} SET content_hash = %s WHERE id = %s;",
+                   (digest, version_id))
+    return True
+
+
+def diff_content(old, new):
+    """
+    Returns a delta that turns old into new with apply_delta(), or None if
+    they are equal
+
+    Dicts are compared key by key and lists item by item, so a delta only
+    holds what changed (e.g. the trips and stop times of a schedule).
+    Equal list items are matched with difflib, so an added trip doesn't
+    make every trip after it look changed.
+
+    A delta is a JSON-serializable dict, one of:
+        {'value': new}
+            - replaces the value
+        {'keys': {key: delta}, 'removed': [key]}
+            - patches a dict, new keys have a 'value' delta
+        {'items': [[start, end, 'splice', items]
+                   or [start, end, 'patch', deltas]]}
+            - patches a list, replacing old[start:end] with new items or
+              patching each old item, in order of start
+    """
+    if old == new:
+        return None
+
+    if isinstance(old, dict) and isinstance(new, dict):
+        keys = {}
+        for key, value in new.items():
+            if key not in old:
+                keys[key] = {'value': value}
+            else:
+                delta = diff_content(old[key], value)
+                if delta is not None:
+                    keys[key] = delta
+        return {'keys': keys,
+                'removed': [key for key in old if key not in new]}
+
+    if isinstance(old, list) and isinstance(new, list):
+        # items are matched by their canonical JSON, autojunk would treat
+        # items repeated often (e.g. skipped stops) as noise
+        matcher = SequenceMatcher(None, [canonical_json(x) for x in old],
+                                  [canonical_json(x) for x in new],
+                                  autojunk=False)
+        items = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == 'equal':
+                continue
+            if tag == 'replace' and i2 - i1 == j2 - j1:
+                items.append([i1, i2, 'patch',
+                              [diff_content(a, b) for a, b
+                               in zip(old[i1:i2], new[j1:j2])]])
+            else:
+                items.append([i1, i2, 'splice', new[j1:j2]])
+        return {'items': items}
+
+    return {'value': new}
+
+
+def version_delta(old, new):
+    """
+    Returns the delta to store for new as a version based on old
+
+    Like diff_content(), but never None: a version equal to its base (e.g.
+    a schedule reverted to its keyframe) gets an explicit empty delta, so
+    it is stored as a delta rather than as JSON null.
+    """
+    delta = diff_content(old, new)
+    if delta is not None:
+        return delta
+    if isinstance(old, dict):
+        return {'keys': {}, 'removed': []}
+    if isinstance(old, list):
+        return {'items': []}
+    return {'value': new}
+
+
+def apply_delta(base, delta):
+    """
+    Returns base with a delta from diff_content() applied
+
+    base is not modified, the result shares the parts that didn't change
+    with it.  The API image can't import this file, so
+    sfmta-api/application/schedule/schedule.py has a copy, test_versions.py
+    checks that they agree.
+    """
+    if delta is None:
+        return base
+
+    if 'value' in delta:
+        return delta['value']
+
+    if 'keys' in delta:
+        result = {key: value for key, value in base.items()
+                  if key not in delta['removed']}
+        for key, change in delta['keys'].items():
+            result[key] = apply_delta(base.get(key), change)
+        return result
+
+    result = []
+    position = 0
+    for start, end, kind, items in delta['items']:
+        result.extend(base[position:start])
+        if kind == 'splice':
+            result.extend(items)
+        else:
+            result.extend(apply_delta(item, change)
+                          for item, change in zip(base[start:end], items))
+        position = end
+    result.extend(base[position:])
+    return result
@@ -1,13 +1,26 @@
 # Flask app providing API links for the web front end to use
 
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, render_template, g, abort
 import json
 import os
+import queue
+import hashlib
+import threading
+import time
 from flask_cors import CORS
 from datetime import date, timedelta
-import psycopg2 as pg
 from dotenv import load_dotenv
-from schedule.schedule import Schedule
+from schedule.schedule import Schedule, get_schedule_version, \
+    get_service_class
+from database.database import ConnectionPool, day_bounds, start_listener
+from cache.cache import TTLCache, SingleFlight, FileSingleFlight
+from jobs.jobs import JobQueue, JobsUnavailable
+from vehicles.vehicles import VehicleStore, VehicleFeed, FEED_QUEUE_SIZE, \
+    FEED_KEEPALIVE, parse_routes, snapshot_message, sse_event
+from locations.locations import STREAM_BATCH, parse_stream_args, \
+    parse_bbox_args, locations_query, next_after, LocationEncoder
+from formats.formats import MEDIA_TYPES, COLUMNAR_FORMATS, negotiate, \
+    encode_records, dumps, column_names, serialize_rows
 
 # Instantiating app w/ CORS, loading env. variables
 load_dotenv()
@@ -22,6 +35,108 @@ creds = {
   'dbname': os.environ.get('DATABASE')
 }
 
+# one pool of DB connections shared by every request and thread
+# sizes can be tuned through the environment for each deployment
+pool = ConnectionPool(creds,
+                      min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+                      max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+                      timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)))
+
+# serialized /get-route-info responses,
+# keyed by (route id, schedule version, service class)
+route_info_cache = TTLCache(
+    max_size=int(os.environ.get('ROUTE_INFO_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('ROUTE_INFO_CACHE_TTL', 86400)))
+
+# concurrent identical requests for expensive responses share one
+# computation; with several gunicorn workers, set SINGLE_FLIGHT_DIR to
+# also share it between the workers through lock files
+if os.environ.get('SINGLE_FLIGHT_DIR'):
+    flights = FileSingleFlight(os.environ['SINGLE_FLIGHT_DIR'])
+else:
+    flights = SingleFlight()
+
+# historical reports are generated in background worker processes
+report_jobs = JobQueue(os.environ.get('JOBS_DB', 'jobs.sqlite3'), creds,
+                       workers=int(os.environ.get('JOB_WORKERS', 2)))
+
+# latest report of every vehicle, for the real-time endpoints, and the
+# changes pushed to /vehicles/stream clients each time it is reloaded
+vehicle_feed = VehicleFeed()
+vehicle_store = VehicleStore(
+    max_age=float(os.environ.get('VEHICLES_MAX_AGE', 60)),
+    feed=vehicle_feed)
+
+
+def refresh_vehicles():
+    """
+    Reloads the vehicle snapshot, after location_collector stores a cycle
+    """
+    with pool.connection() as cnx:
+        vehicle_store.refresh(cnx)
+
+
+# schedule_collector sends NOTIFY schedules, '<rid>' when it stores a new
+# schedule version, drop the cached responses for that route when it does
+# location_collector sends NOTIFY vehicles after each cycle
+# report job workers are spawned and import this script as __mp_main__,
+# they don't need the background threads
+background = __name__ != '__mp_main__'
+if background and os.environ.get('DB_LISTEN', '1') == '1':
+    start_listener(creds, {
+        'schedules': lambda rid: route_info_cache.invalidate(
+            lambda key: key[0] == rid),
+        'vehicles': lambda payload: refresh_vehicles()
+    })
+
+# reloads the snapshot for /vehicles/stream clients when no notification
+# came for VEHICLES_MAX_AGE seconds
+if background:
+    vehicle_store.start_reloader(pool)
+
+# request latency per endpoint, exposed through /metrics
+latency = {}
+latency_lock = threading.Lock()
+
+
+def get_db():
+    """
+    Returns a DB connection checked out from the pool for this request
+    The connection is returned to the pool when the request ends
+    """
+    if 'cnx' not in g:
+        g.cnx = pool.getconn()
+    return g.cnx
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_latency(response):
+    # time spent building the response, not streaming it
+    elapsed = (time.perf_counter() - g.start) * 1000
+    endpoint = request.endpoint or 'unknown'
+
+    with latency_lock:
+        stats = latency.setdefault(endpoint, {'count': 0, 'total_ms': 0,
+                                              'max_ms': 0})
+        stats['count'] += 1
+        stats['total_ms'] += elapsed
+        stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+    response.headers['X-Response-Time'] = f'{elapsed:.1f}ms'
+    return response
+
+
+@app.teardown_request
+def return_db(exception):
+    cnx = g.pop('cnx', None)
+    if cnx is not None:
+        pool.putconn(cnx)
+
 
 @app.route("/")
 def index():
@@ -34,7 +149,7 @@ def test():
     Temporary route to test DB connection
     Returns first 10 rows from locations table
     """
-    cnx = pg.connect(**creds)
+    cnx = get_db()
     cursor = cnx.cursor()
 
     query = """
@@ -44,44 +159,17 @@ def test():
     cursor.execute(query)
     rows = cursor.fetchall()
 
-    return json.dumps(rows, sort_keys=False, default=str)
+    return Response(serialize_rows(column_names(cursor), rows),
+                    mimetype='application/json')
 
 
 @app.route('/system-real-time')
 def get_system_real_time():
     """
-    Hits the database for the 100 most recent entries
-    Returns each entry in a separate dictionary
-    """
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-
-    query = """
-    SELECT 
-    timestamp, rid, vid, age, kph, heading, latitude, longitude, direction
-    FROM locations
-    ORDER BY timestamp DESC
-    LIMIT 100
+    Returns the latest report of every vehicle in service, human readable
+    Accepts route as route id as string, to only show that route
     """
-
-    query2 = """
-    SELECT
-    column_name
-    FROM information_schema.columns
-    WHERE table_name = 'locations'
-    """
-
-    cursor.execute(query2)
-    columns = cursor.fetchall()
-
-    cursor.execute(query)
-    rows = cursor.fetchall()
-
-    elements = []
-
-    for element in rows:
-        elements.append(
-            {columns[x+1][0]: element[x] for x in range(len(element))})
+    elements = vehicle_store.get(pool, request.args.get('route'))
 
     return render_template('system_real_time.html',
                            elements=elements)
@@ -90,40 +178,57 @@ def get_system_real_time():
 @app.route('/system-real-time-json')
 def jsonify_system_real_time():
     """
-    Hits the database for the 100 most recent entries
-    Returns a single json containing all called entries
+    Returns the latest report of every vehicle in service as json
+    Accepts route as route id as string, to only return that route
     """
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
+    elements = vehicle_store.get(pool, request.args.get('route'))
 
-    query = """
-    SELECT 
-    timestamp, rid, vid, age, kph, heading, latitude, longitude, direction
-    FROM locations
-    ORDER BY timestamp DESC
-    LIMIT 100
-    """
+    return json_response(elements)
 
-    query2 = """
-    SELECT
-    column_name
-    FROM information_schema.columns
-    WHERE table_name = 'locations'
-    """
 
-    cursor.execute(query2)
-    columns = cursor.fetchall()
-
-    cursor.execute(query)
-    rows = cursor.fetchall()
-
-    elements = []
+@app.route('/vehicles/stream', methods=['GET'])
+def stream_vehicles():
+    """
+    Pushes vehicle positions as server-sent events, for clients that would
+    otherwise poll /system-real-time-json
 
-    for element in rows:
-        elements.append(
-            {columns[x+1][0]: element[x] for x in range(len(element))})
+    The first event is a snapshot of the vehicles in service, followed by
+    a diff event with what changed each time location_collector stores a
+    cycle.  See VehicleFeed for the message format.
 
-    return json.dumps(elements, sort_keys=False, default=str)
+    Request parameters:
+        route: comma separated route ids to follow (default: every route)
+    """
+    routes = parse_routes(request.args.get('route'))
+
+    # subscribe before taking the snapshot, so no change is missed between
+    # the two, diffs already in the snapshot are skipped by version
+    messages = queue.Queue(maxsize=FEED_QUEUE_SIZE)
+    key = vehicle_feed.subscribe(messages.put_nowait, routes)
+    try:
+        version, vehicles = vehicle_store.snapshot(pool, routes)
+    except Exception:
+        vehicle_feed.unsubscribe(key)
+        raise
+
+    def generate():
+        try:
+            yield sse_event('snapshot', snapshot_message(version, vehicles))
+            while vehicle_feed.subscribed(key) or not messages.empty():
+                try:
+                    diff_version, message = messages.get(
+                        timeout=FEED_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if diff_version > version:
+                    yield sse_event('diff', message)
+        finally:
+            vehicle_feed.unsubscribe(key)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @app.route('/daily-general-json', methods=['GET'])
@@ -132,43 +237,22 @@ def get_daily_usage():
      Pulls all data from the specified date as json
      Expects date as string: YYYY-MM-DD
      Defaults to previous day if none given
+     Accepts the streaming and paging parameters of stream_locations()
     """
     day = request.args.get('day',
                            default=(date.today() - timedelta(days=1)))
-    day = f'%{day}%'
-
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-
-    query = """
-    SELECT
-    (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst'), 
-    rid, vid, age, kph, heading, latitude, longitude, direction
-    FROM locations
-    WHERE (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst')::TEXT LIKE %s
-    ORDER BY timestamp
+    try:
+        start, end = day_bounds(day)
+    except ValueError:
+        abort(400, 'day must be a date as YYYY-MM-DD')
+
+    # compare the raw UTC column against the day's bounds so the
+    # (timestamp, id) and (rid, timestamp, id) indexes can be used
+    where = """
+    timestamp >= %s AND timestamp < %s
     """
 
-    query2 = """
-    SELECT
-    column_name
-    FROM information_schema.columns
-    WHERE table_name = 'locations'
-    """
-
-    cursor.execute(query, (day,))
-    rows = cursor.fetchall()
-
-    cursor.execute(query2)
-    columns = cursor.fetchall()
-
-    elements = []
-
-    for element in rows:
-        elements.append(
-            {columns[x+1][0]: element[x] for x in range(len(element))})
-
-    return json.dumps(elements, sort_keys=False, default=str)
+    return stream_locations(where, (start, end))
 
 
 @app.route('/daily-route-json', methods=['GET'])
@@ -177,47 +261,141 @@ def get_daily_by_route():
      Pulls all data from the specified date as json
      Expects date as string: YYYY-MM-DD
      Defaults to previous day if none given
+     Accepts the streaming and paging parameters of stream_locations()
     """
     day = request.args.get('day',
                            default=(date.today() - timedelta(days=1)))
-    day = f'%{day}%'
+    try:
+        start, end = day_bounds(day)
+    except ValueError:
+        abort(400, 'day must be a date as YYYY-MM-DD')
 
     route = request.args.get('route',
                              default='1')
 
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-
-    query = """
-    SELECT
-    (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst'), 
-    rid, vid, age, kph, heading, latitude, longitude, direction
-    FROM locations
-    WHERE (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst')::TEXT LIKE %s
+    # compare the raw UTC column against the day's bounds so the
+    # (timestamp, id) and (rid, timestamp, id) indexes can be used
+    where = """
+    timestamp >= %s AND timestamp < %s
     AND rid = %s
-    ORDER BY timestamp
     """
 
-    query2 = """
-    SELECT
-    column_name
-    FROM information_schema.columns
-    WHERE table_name = 'locations'
-    """
+    return stream_locations(where, (start, end, route))
 
-    cursor.execute(query, (day, route))
-    rows = cursor.fetchall()
 
-    cursor.execute(query2)
-    columns = cursor.fetchall()
+@app.route('/locations/bbox', methods=['GET'])
+def get_locations_in_bbox():
+    """
+     Pulls the locations reported inside a box during a time window
+     Expects bbox as min_lon,min_lat,max_lon,max_lat
+     Expects start and end as local datetimes: YYYY-MM-DDTHH:MM:SS,
+     at most a day apart
+     Accepts the streaming and paging parameters of stream_locations()
+    """
+    try:
+        args = parse_bbox_args(request.args)
+    except ValueError as error:
+        abort(400, str(error))
+
+    # the (tile, timestamp) index gives the window's rows in the tiles
+    # covering the box, then the points are checked against the box itself
+    where = """
+    tile = ANY(%s::INTEGER[]) AND timestamp >= %s AND timestamp < %s
+    AND longitude BETWEEN %s AND %s AND latitude BETWEEN %s AND %s
+    """
 
-    elements = []
+    min_lon, min_lat, max_lon, max_lat = args['bbox']
+    return stream_locations(where, (args['tiles'], args['start'],
+                                    args['end'], min_lon, max_lon,
+                                    min_lat, max_lat))
 
-    for element in rows:
-        elements.append(
-            {columns[x+1][0]: element[x] for x in range(len(element))})
 
-    return json.dumps(elements, sort_keys=False, default=str)
+def stream_locations(where, params):
+    """
+    Streams the locations rows matching a WHERE clause, in (timestamp, id)
+    order, without holding the whole result in memory
+
+    Rows are read from a server-side cursor in batches and written out as
+    they arrive, as one JSON array (the default), NDJSON, or columnar
+    batches for dataframes (Arrow IPC stream, Parquet, MessagePack).
+
+    Arguments:
+        where (str): SQL condition on the locations table, written by the
+                     endpoint and never taken from the request
+        params (tuple): values for the placeholders in where
+
+    Request parameters:
+        fields: comma separated columns to return, see LOCATION_FIELDS
+        format: 'json' (default), 'ndjson', 'arrow', 'parquet' or
+                'msgpack', otherwise picked from the Accept header
+        limit: return at most this many rows, and a X-Next-After header
+               when there may be more
+        after: the X-Next-After value of the previous page, returns the
+               rows after it (keyset pagination on timestamp, id)
+    """
+
+    try:
+        args = parse_stream_args(request.args,
+                                 request.headers.get('Accept'))
+    except ValueError as error:
+        abort(400, str(error))
+
+    fields, output, limit = args['fields'], args['format'], args['limit']
+    query, params = locations_query(where, params, fields, limit,
+                                    args['after'])
+
+    cnx = pool.getconn()
+    try:
+        # named cursors are server-side, rows are sent as they're fetched
+        cursor = cnx.cursor(name='locations_stream')
+        cursor.itersize = STREAM_BATCH
+        cursor.execute(query, params)
+
+        headers = {}
+        if limit is not None:
+            # a page is at most MAX_PAGE rows, so it can be read up front
+            # to find where the next page starts
+            rows = cursor.fetchall()
+            if next_after(rows, limit) is not None:
+                headers['X-Next-After'] = next_after(rows, limit)
+            batches = iter([rows])
+        else:
+            batches = iter(lambda: cursor.fetchmany(STREAM_BATCH), [])
+    except Exception:
+        pool.putconn(cnx)
+        raise
+
+    released = []
+
+    def release():
+        # called when the rows are sent, and again when the response is
+        # closed, the connection is only given back once
+        if released:
+            return
+        released.append(True)
+        try:
+            cursor.close()
+        finally:
+            pool.putconn(cnx)
+
+    def generate():
+        try:
+            encoder = LocationEncoder(fields, output)
+            yield encoder.start()
+            for rows in batches:
+                yield encoder.encode(rows)
+            yield encoder.finish()
+        finally:
+            release()
+
+    headers['Vary'] = 'Accept'
+    response = Response(generate(), mimetype=MEDIA_TYPES[output],
+                        headers=headers)
+
+    # the server closes the response even if the client went away before
+    # the generator started, when the finally in generate() never runs
+    response.call_on_close(release)
+    return response
 
 
 @app.route('/get-route-info', methods=['GET'])
@@ -238,10 +416,30 @@ def get_route_schedule():
     day = request.args.get('day',
                            default=(date.today() - timedelta(days=1)))
 
-    sched = Schedule(route_id, day, creds)
+    # everything but the date only depends on the schedule version and
+    # the service class of the day, so it is cached under those
+    cnx = get_db()
+    key = (str(route_id), get_schedule_version(route_id, day, cnx),
+           get_service_class(day))
+
+    body = route_info_cache.get(key)
+    if body is None:
+        body = flights.do(('route-info',) + key,
+                          lambda: build_route_info(route_id, day, cnx))
+        route_info_cache.put(key, body)
+
+    # add the date in front of the cached fields
+    return '{"date": ' + json.dumps(day, default=str) + ', ' + body[1:]
 
-    tables = {'date': day,
-              'route': sched.route_id,
+
+def build_route_info(route_id, day, cnx):
+    """
+    Loads a route's schedule and returns the serialized /get-route-info
+    fields that only depend on it
+    """
+    sched = Schedule(route_id, day, cnx)
+
+    tables = {'route': sched.route_id,
               'inbound': sched.inbound_table.to_json(),
               'outbound': sched.outbound_table.to_json(),
               'stops': sched.list_stops(),
@@ -251,6 +449,192 @@ def get_route_schedule():
     return json.dumps(tables, sort_keys=False, default=str)
 
 
+@app.route('/report', methods=['GET'])
+def get_report():
+    """
+    Returns the stored daily report for a date, optionally only for one
+    route and only some fields of each route's report
+    Expects date as string: YYYY-MM-DD, defaults to previous day
+    Accepts route_id, to return only that route's (or aggregate's) report
+    Accepts fields, comma separated report fields to return,
+    see AWS_Lambda/Report_Generation/report_data_structure.md
+    Accepts format, 'json' (default), 'arrow', 'parquet' or 'msgpack' for
+    a table with a row per route and a column per field, otherwise picked
+    from the Accept header
+
+    The selection is done in the database with JSONB operators, so only
+    the requested parts of the report are read out and sent. Responses
+    carry an ETag and Last-Modified so clients can revalidate them.
+    """
+    day = request.args.get('date',
+                           default=(date.today() - timedelta(days=1)))
+    try:
+        day = date.fromisoformat(str(day))
+    except ValueError:
+        abort(400, 'date must be a date as YYYY-MM-DD')
+
+    route_id = request.args.get('route_id')
+
+    fields = request.args.get('fields')
+    if fields is not None:
+        fields = [field.strip() for field in fields.split(',')
+                  if field.strip()]
+
+    try:
+        output = negotiate(request.args.get('format'),
+                           request.headers.get('Accept'),
+                           ['json'] + COLUMNAR_FORMATS)
+    except ValueError as error:
+        abort(400, str(error))
+
+    cnx = get_db()
+    with cnx.cursor() as cursor:
+        # look up when the stored report last changed first, so a client
+        # that already has the current version doesn't need the selection
+        # to be run
+        query = """
+        SELECT updated_at
+        FROM reports
+        WHERE date = %s::TIMESTAMP
+        LIMIT 1;
+        """
+        cursor.execute(query, (day,))
+        row = cursor.fetchone()
+        if row is None:
+            abort(404, f'no report for {day}')
+
+        # report_main sets updated_at every time it writes a report, so
+        # it identifies the stored version without reading the report
+        updated_at = row[0]
+        etag = hashlib.md5(
+            f'{day}|{updated_at.isoformat()}|{route_id}|{fields}|'
+            f'{output}'.encode()).hexdigest()
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            # one element of the report per route, keeping their order,
+            # each narrowed to the requested fields
+            query = """
+            SELECT COALESCE(jsonb_agg(
+                CASE WHEN %(fields)s::TEXT[] IS NULL THEN element
+                ELSE (SELECT COALESCE(jsonb_object_agg(key, value),
+                                      '{}'::JSONB)
+                      FROM jsonb_each(element)
+                      WHERE key = ANY(%(fields)s::TEXT[]))
+                END
+                ORDER BY position), '[]'::JSONB)::TEXT
+            FROM reports,
+                jsonb_array_elements(report::JSONB)
+                WITH ORDINALITY AS elements(element, position)
+            WHERE date = %(date)s::TIMESTAMP AND
+                (%(route_id)s::TEXT IS NULL OR
+                 element->>'route_id' = %(route_id)s::TEXT);
+            """
+            cursor.execute(query, {'date': day, 'route_id': route_id,
+                                   'fields': fields})
+            body = cursor.fetchone()[0]
+
+            if route_id is not None and body == '[]':
+                abort(404, f'no report for route {route_id} on {day}')
+
+            if output != 'json':
+                body = encode_records(json.loads(body), output)
+            response = Response(body, mimetype=MEDIA_TYPES[output])
+
+    response.set_etag(etag)
+    response.vary.add('Accept')
+    response.last_modified = updated_at
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
+
+
+@app.route('/report-jobs', methods=['POST'])
+def submit_report_job():
+    """
+    Queues a report to be generated from the stored history
+    Expects date as string: YYYY-MM-DD
+    or start and end as strings: YYYY-MM-DD, inclusive, for a range
+    Returns the job, with the URL to poll in the Location header
+    Returns the existing job if the same report was already requested
+    """
+    try:
+        if 'date' in request.args:
+            start = end = date.fromisoformat(request.args['date'])
+        else:
+            start = date.fromisoformat(request.args['start'])
+            end = date.fromisoformat(request.args['end'])
+        job, created = report_jobs.submit(start, end)
+    except (KeyError, ValueError) as error:
+        abort(400, f'expects date, or start and end, as YYYY-MM-DD: {error}')
+    except JobsUnavailable as error:
+        abort(503, str(error))
+
+    # 202 until the report is ready to fetch
+    status = 200 if job['status'] == 'done' else 202
+    headers = {'Location': f"/report-jobs/{job['id']}"}
+    return json_response(dict(job, created_now=created), status, headers)
+
+
+@app.route('/report-jobs/<job_id>', methods=['GET'])
+def get_report_job(job_id):
+    """
+    Returns the status of a report job: queued, running, done, or failed
+    Finished jobs link to their result
+    """
+    job = report_jobs.get(job_id)
+    if job is None:
+        abort(404, f'no job {job_id}')
+
+    if job['status'] == 'done':
+        job['result'] = f'/report-jobs/{job_id}/result'
+
+    return json_response(job)
+
+
+@app.route('/report-jobs/<job_id>/result', methods=['GET'])
+def get_report_job_result(job_id):
+    """
+    Returns the report generated by a finished job
+    """
+    job = report_jobs.get(job_id, result=True)
+    if job is None:
+        abort(404, f'no job {job_id}')
+    if job['status'] != 'done':
+        abort(409, f"job {job_id} is {job['status']}")
+
+    return Response(job['result'], mimetype='application/json')
+
+
+@app.route('/metrics')
+def get_metrics():
+    """
+    Returns connection pool counts, cache counts, and request latency
+    per endpoint
+    """
+    with latency_lock:
+        requests = {endpoint: dict(stats, mean_ms=stats['total_ms'] /
+                                   stats['count'])
+                    for endpoint, stats in latency.items()}
+
+    return json_response({'pool': pool.stats(),
+                          'route_info_cache': route_info_cache.stats(),
+                          'single_flight': flights.stats(),
+                          'report_jobs': report_jobs.stats(),
+                          'vehicles': vehicle_store.stats(),
+                          'vehicle_feed': vehicle_feed.stats(),
+                          'requests': requests})
+
+
+def json_response(data, status=200, headers=None):
+    """
+    Returns data serialized as JSON, with the fast shared encoder
+    """
+    return Response(dumps(data), status=status, headers=headers,
+                    mimetype='application/json')
+
+
 if __name__ == "__main__":
     app.jinja_env.auto_reload = True
     app.config['TEMPLATES_AUTO_RELOAD'] = True
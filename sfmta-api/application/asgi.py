@@ -0,0 +1,658 @@
+# ASGI version of the Flask app in app.py, served with uvicorn:
+#     uvicorn asgi:app --host 0.0.0.0 --port 8000 --loop uvloop
+#
+# The endpoints are the same.  Database reads use an asyncpg pool, so slow
+# clients streaming real-time or daily data wait on the event loop instead
+# of each holding a thread.  Schedule processing and report jobs still run
+# synchronous code, in the threadpool.
+
+import os
+import asyncio
+import json
+import time
+import hashlib
+import asyncpg
+from datetime import date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from dotenv import load_dotenv
+from fastapi import FastAPI, HTTPException, Request, WebSocket
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
+from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
+from starlette.websockets import WebSocketDisconnect
+from starlette.templating import Jinja2Templates
+from schedule.schedule import Schedule, get_schedule_version, \
+    get_service_class
+from database.database import ConnectionPool, day_bounds, start_listener
+from cache.cache import TTLCache, SingleFlight
+from jobs.jobs import JobQueue, JobsUnavailable
+from vehicles.vehicles import VehicleStore, VehicleFeed, FeedOverflow, \
+    FEED_QUEUE_SIZE, FEED_KEEPALIVE, parse_routes, snapshot_message, \
+    sse_event
+from locations.locations import STREAM_BATCH, parse_stream_args, \
+    parse_bbox_args, locations_query, next_after, numbered, LocationEncoder
+from formats.formats import MEDIA_TYPES, COLUMNAR_FORMATS, negotiate, \
+    encode_records, dumps, serialize_rows
+
+# Instantiating app w/ CORS, loading env. variables
+load_dotenv()
+app = FastAPI()
+app.add_middleware(CORSMiddleware, allow_origins=['*'])
+templates = Jinja2Templates(
+    directory=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'templates'))
+
+# credentials for DB connection
+creds = {
+  'user': os.environ.get('USERNAME'),
+  'password': os.environ.get('PASSWORD'),
+  'host': os.environ.get('HOST'),
+  'dbname': os.environ.get('DATABASE')
+}
+
+# asyncpg pool for the async endpoints, created on first use inside the
+# server's event loop
+_pool = None
+
+# psycopg2 pool for the synchronous Schedule code, run in the threadpool
+sync_pool = ConnectionPool(creds,
+                           min_size=0,
+                           max_size=int(os.environ.get('DB_POOL_MAX', 10)),
+                           timeout=float(os.environ.get('DB_POOL_TIMEOUT',
+                                                        30)))
+
+# the same caches and job queue as the Flask app
+route_info_cache = TTLCache(
+    max_size=int(os.environ.get('ROUTE_INFO_CACHE_SIZE', 512)),
+    ttl=float(os.environ.get('ROUTE_INFO_CACHE_TTL', 86400)))
+flights = SingleFlight()
+report_jobs = JobQueue(os.environ.get('JOBS_DB', 'jobs.sqlite3'), creds,
+                       workers=int(os.environ.get('JOB_WORKERS', 2)))
+
+vehicle_feed = VehicleFeed()
+vehicle_store = VehicleStore(
+    max_age=float(os.environ.get('VEHICLES_MAX_AGE', 60)),
+    feed=vehicle_feed)
+
+
+def refresh_vehicles():
+    """
+    Reloads the vehicle snapshot, after location_collector stores a cycle
+    """
+    with sync_pool.connection() as cnx:
+        vehicle_store.refresh(cnx)
+
+
+if os.environ.get('DB_LISTEN', '1') == '1':
+    start_listener(creds, {
+        'schedules': lambda rid: route_info_cache.invalidate(
+            lambda key: key[0] == rid),
+        'vehicles': lambda payload: refresh_vehicles()
+    })
+
+# reloads the snapshot for feed subscribers when no notification came for
+# VEHICLES_MAX_AGE seconds
+vehicle_store.start_reloader(sync_pool)
+
+# request latency per endpoint, exposed through /metrics
+latency = {}
+
+
+async def get_pool():
+    """
+    Returns the asyncpg pool, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        pool = await asyncpg.create_pool(
+            user=creds['user'], password=creds['password'],
+            host=creds['host'], database=creds['dbname'],
+            min_size=int(os.environ.get('DB_POOL_MIN', 1)),
+            max_size=int(os.environ.get('DB_POOL_MAX', 10)))
+
+        # another request may have created it while this one waited
+        if _pool is None:
+            _pool = pool
+        else:
+            await pool.close()
+
+    return _pool
+
+
+@app.middleware('http')
+async def record_latency(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+
+    # time until the response starts, not until it is fully streamed
+    elapsed = (time.perf_counter() - start) * 1000
+    # the matched endpoint's function name, as in the Flask app
+    endpoint = request.scope.get('endpoint')
+    endpoint = endpoint.__name__ if endpoint is not None else 'unknown'
+    stats = latency.setdefault(endpoint, {'count': 0, 'total_ms': 0,
+                                          'max_ms': 0})
+    stats['count'] += 1
+    stats['total_ms'] += elapsed
+    stats['max_ms'] = max(stats['max_ms'], elapsed)
+
+    response.headers['X-Response-Time'] = f'{elapsed:.1f}ms'
+    return response
+
+
+@app.get('/', response_class=PlainTextResponse)
+async def index():
+    return "Hello there!"
+
+
+@app.get('/test')
+async def test():
+    """
+    Temporary route to test DB connection
+    Returns first 10 rows from locations table
+    """
+    pool = await get_pool()
+    rows = await pool.fetch('SELECT * FROM locations LIMIT 10')
+
+    # asyncpg records carry their column names
+    columns = list(rows[0].keys()) if rows else []
+    return Response(serialize_rows(columns, rows),
+                    media_type='application/json')
+
+
+@app.get('/system-real-time')
+async def get_system_real_time(request: Request, route: str = None):
+    """
+    Returns the latest report of every vehicle in service, human readable
+    """
+    elements = await vehicles(route)
+
+    return templates.TemplateResponse('system_real_time.html',
+                                      {'request': request,
+                                       'elements': elements})
+
+
+@app.get('/system-real-time-json')
+async def jsonify_system_real_time(route: str = None):
+    """
+    Returns the latest report of every vehicle in service as json
+    """
+    return json_response(await vehicles(route))
+
+
+async def vehicles(route):
+    """
+    Returns the vehicle snapshot, reloading it in the threadpool only if
+    it is out of date
+    """
+    _, elements = await vehicle_snapshot(None if route is None else {route})
+    return elements
+
+
+async def vehicle_snapshot(routes=None):
+    """
+    Returns the vehicle snapshot's (version, vehicles), reloading it in the
+    threadpool only if it is out of date
+    """
+    if vehicle_store.expired():
+        return await run_in_threadpool(vehicle_store.snapshot, sync_pool,
+                                       routes)
+    return vehicle_store.snapshot(sync_pool, routes)
+
+
+@app.get('/vehicles/stream')
+async def stream_vehicles(route: str = None):
+    """
+    Pushes vehicle positions as server-sent events, a snapshot event then
+    a diff event each time location_collector stores a cycle
+
+    route: comma separated route ids to follow (default: every route)
+    """
+    routes = parse_routes(route)
+
+    # subscribe before taking the snapshot, so no change is missed between
+    # the two, diffs already in the snapshot are skipped by version
+    key, messages = subscribe(routes)
+    try:
+        version, snapshot = await vehicle_snapshot(routes)
+    except Exception:
+        vehicle_feed.unsubscribe(key)
+        raise
+
+    async def generate():
+        try:
+            yield sse_event('snapshot', snapshot_message(version, snapshot))
+            async for message in feed_messages(key, messages, version):
+                if message is None:
+                    yield ': keepalive\n\n'
+                else:
+                    yield sse_event('diff', message)
+        finally:
+            vehicle_feed.unsubscribe(key)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache',
+                                      'X-Accel-Buffering': 'no'})
+
+
+@app.websocket('/vehicles/ws')
+async def vehicles_websocket(websocket: WebSocket, route: str = None):
+    """
+    Pushes the same messages as /vehicles/stream over a WebSocket, each
+    message is the JSON text of a snapshot or diff
+    """
+    await websocket.accept()
+    routes = parse_routes(route)
+
+    key, messages = subscribe(routes)
+    try:
+        version, snapshot = await vehicle_snapshot(routes)
+        await websocket.send_text(snapshot_message(version, snapshot))
+
+        # a client that went away is noticed on the next send, the server
+        # pings idle connections itself
+        async for message in feed_messages(key, messages, version):
+            if message is not None:
+                await websocket.send_text(message)
+
+        # dropped for falling behind, the client should reconnect
+        await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        vehicle_feed.unsubscribe(key)
+
+
+def subscribe(routes):
+    """
+    Subscribes to the vehicle feed, returns (key, messages) where messages
+    is an asyncio queue of (version, text) pairs
+
+    Messages are published from the thread that reloads the snapshot, and
+    handed to the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    messages = asyncio.Queue()
+
+    def deliver(item):
+        if messages.qsize() >= FEED_QUEUE_SIZE:
+            raise FeedOverflow()
+        loop.call_soon_threadsafe(messages.put_nowait, item)
+
+    return vehicle_feed.subscribe(deliver, routes), messages
+
+
+async def feed_messages(key, messages, version):
+    """
+    Yields the text of each diff message newer than a snapshot version,
+    and None when there was nothing to send for FEED_KEEPALIVE seconds
+
+    Stops once the subscriber was dropped and its messages were read.
+    """
+    while vehicle_feed.subscribed(key) or not messages.empty():
+        try:
+            diff_version, message = await asyncio.wait_for(
+                messages.get(), FEED_KEEPALIVE)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+
+        if diff_version > version:
+            yield message
+
+
+@app.get('/daily-general-json')
+async def get_daily_usage(request: Request, day: str = None):
+    """
+     Pulls all data from the specified date as json
+     Expects date as string: YYYY-MM-DD
+     Defaults to previous day if none given
+     Accepts the streaming and paging parameters of the Flask version
+    """
+    start, end = parse_day(day)
+
+    where = """
+    timestamp >= %s AND timestamp < %s
+    """
+
+    return await stream_locations(request, where, (start, end))
+
+
+@app.get('/daily-route-json')
+async def get_daily_by_route(request: Request, day: str = None,
+                             route: str = '1'):
+    """
+     Pulls all data from the specified date as json
+     Expects date as string: YYYY-MM-DD
+     Defaults to previous day if none given
+     Accepts the streaming and paging parameters of the Flask version
+    """
+    start, end = parse_day(day)
+
+    where = """
+    timestamp >= %s AND timestamp < %s
+    AND rid = %s
+    """
+
+    return await stream_locations(request, where, (start, end, route))
+
+
+@app.get('/locations/bbox')
+async def get_locations_in_bbox(request: Request):
+    """
+     Pulls the locations reported inside a box during a time window,
+     see get_locations_in_bbox() in app.py
+    """
+    try:
+        args = parse_bbox_args(request.query_params)
+    except ValueError as error:
+        raise HTTPException(400, str(error))
+
+    where = """
+    tile = ANY(%s::INTEGER[]) AND timestamp >= %s AND timestamp < %s
+    AND longitude BETWEEN %s AND %s AND latitude BETWEEN %s AND %s
+    """
+
+    min_lon, min_lat, max_lon, max_lat = args['bbox']
+    return await stream_locations(request, where,
+                                  (args['tiles'], args['start'],
+                                   args['end'], min_lon, max_lon,
+                                   min_lat, max_lat))
+
+
+async def stream_locations(request, where, params):
+    """
+    Streams the locations rows matching a WHERE clause, see
+    stream_locations() in app.py
+
+    Whole days are read through a cursor in a transaction, and the
+    connection is held only while the response is being sent.
+    """
+    try:
+        args = parse_stream_args(request.query_params,
+                                 request.headers.get('accept'))
+    except ValueError as error:
+        raise HTTPException(400, str(error))
+
+    fields, output, limit = args['fields'], args['format'], args['limit']
+    query, params = locations_query(where, params, fields, limit,
+                                    args['after'])
+    query = numbered(query)
+    media_type = MEDIA_TYPES[output]
+    headers = {'Vary': 'Accept'}
+    encoder = LocationEncoder(fields, output)
+    pool = await get_pool()
+
+    if limit is not None:
+        # a page is at most MAX_PAGE rows, so it can be read up front
+        # to find where the next page starts
+        rows = await pool.fetch(query, *params)
+        body = encoder.start() + encoder.encode(rows) + encoder.finish()
+
+        if next_after(rows, limit) is not None:
+            headers['X-Next-After'] = next_after(rows, limit)
+        return Response(body, media_type=media_type, headers=headers)
+
+    async def generate():
+        async with pool.acquire() as cnx:
+            # asyncpg cursors need a transaction
+            async with cnx.transaction():
+                cursor = await cnx.cursor(query, *params)
+                yield encoder.start()
+                while True:
+                    rows = await cursor.fetch(STREAM_BATCH)
+                    if not rows:
+                        break
+                    yield encoder.encode(rows)
+                yield encoder.finish()
+
+    return StreamingResponse(generate(), media_type=media_type,
+                             headers=headers)
+
+
+@app.get('/get-route-info')
+async def get_route_schedule(route_id: str = '1', day: str = None):
+    """
+    Pulls general schedule info for a specified route and date, see
+    get_route_schedule() in app.py
+    """
+    day = day or str(date.today() - timedelta(days=1))
+
+    # Schedule is synchronous pandas code, run it in the threadpool
+    body = await run_in_threadpool(route_info, route_id, day)
+
+    return Response('{"date": ' + json.dumps(day, default=str) + ', ' +
+                    body[1:], media_type='application/json')
+
+
+def route_info(route_id, day):
+    """
+    Returns the cached or freshly built /get-route-info fields
+    """
+    with sync_pool.connection() as cnx:
+        key = (str(route_id), get_schedule_version(route_id, day, cnx),
+               get_service_class(day))
+
+        body = route_info_cache.get(key)
+        if body is None:
+            body = flights.do(('route-info',) + key,
+                              lambda: build_route_info(route_id, day, cnx))
+            route_info_cache.put(key, body)
+
+    return body
+
+
+def build_route_info(route_id, day, cnx):
+    """
+    Loads a route's schedule and returns the serialized /get-route-info
+    fields that only depend on it
+    """
+    sched = Schedule(route_id, day, cnx)
+
+    tables = {'route': sched.route_id,
+              'inbound': sched.inbound_table.to_json(),
+              'outbound': sched.outbound_table.to_json(),
+              'stops': sched.list_stops(),
+              'intervals': {'mean': sched.mean_interval,
+                            'mode': sched.common_interval}}
+
+    return json.dumps(tables, sort_keys=False, default=str)
+
+
+@app.get('/report')
+async def get_report(request: Request, route_id: str = None,
+                     fields: str = None):
+    """
+    Returns the stored daily report for a date, see get_report() in app.py
+    """
+    try:
+        day = date.fromisoformat(request.query_params.get(
+            'date', str(date.today() - timedelta(days=1))))
+    except ValueError:
+        raise HTTPException(400, 'date must be a date as YYYY-MM-DD')
+
+    if fields is not None:
+        fields = [field.strip() for field in fields.split(',')
+                  if field.strip()]
+
+    try:
+        output = negotiate(request.query_params.get('format'),
+                           request.headers.get('accept'),
+                           ['json'] + COLUMNAR_FORMATS)
+    except ValueError as error:
+        raise HTTPException(400, str(error))
+
+    pool = await get_pool()
+    async with pool.acquire() as cnx:
+        row = await cnx.fetchrow("""
+        SELECT updated_at
+        FROM reports
+        WHERE date = $1::TIMESTAMP
+        LIMIT 1;
+        """, day)
+        if row is None:
+            raise HTTPException(404, f'no report for {day}')
+
+        # report_main sets updated_at every time it writes a report, so
+        # it identifies the stored version without reading the report
+        updated_at = row[0]
+        etag = '"' + hashlib.md5(
+            f'{day}|{updated_at.isoformat()}|{route_id}|{fields}|'
+            f'{output}'.encode()
+        ).hexdigest() + '"'
+        # TIMESTAMPTZ comes back aware, a plain TIMESTAMP is taken as UTC
+        if updated_at.tzinfo is None:
+            updated_at = updated_at.replace(tzinfo=timezone.utc)
+        headers = {
+            'ETag': etag,
+            'Last-Modified': format_datetime(
+                updated_at.astimezone(timezone.utc), usegmt=True),
+            'Cache-Control': 'public, max-age=300',
+            'Vary': 'Accept'
+        }
+
+        if not_modified(request, etag, updated_at):
+            return Response(status_code=304, headers=headers)
+
+        body = await cnx.fetchval("""
+        SELECT COALESCE(jsonb_agg(
+            CASE WHEN $3::TEXT[] IS NULL THEN element
+            ELSE (SELECT COALESCE(jsonb_object_agg(key, value),
+                                  '{}'::JSONB)
+                  FROM jsonb_each(element)
+                  WHERE key = ANY($3::TEXT[]))
+            END
+            ORDER BY position), '[]'::JSONB)::TEXT
+        FROM reports,
+            jsonb_array_elements(report::JSONB)
+            WITH ORDINALITY AS elements(element, position)
+        WHERE date = $1::TIMESTAMP AND
+            ($2::TEXT IS NULL OR element->>'route_id' = $2::TEXT);
+        """, day, route_id, fields)
+
+    if route_id is not None and body == '[]':
+        raise HTTPException(404, f'no report for route {route_id} on {day}')
+
+    if output != 'json':
+        body = encode_records(json.loads(body), output)
+    return Response(body, media_type=MEDIA_TYPES[output], headers=headers)
+
+
+@app.post('/report-jobs')
+async def submit_report_job(request: Request):
+    """
+    Queues a report to be generated from the stored history, see
+    submit_report_job() in app.py
+    """
+    args = request.query_params
+    try:
+        if 'date' in args:
+            start = end = date.fromisoformat(args['date'])
+        else:
+            start = date.fromisoformat(args['start'])
+            end = date.fromisoformat(args['end'])
+        job, created = await run_in_threadpool(report_jobs.submit,
+                                               start, end)
+    except (KeyError, ValueError) as error:
+        raise HTTPException(
+            400, f'expects date, or start and end, as YYYY-MM-DD: {error}')
+    except JobsUnavailable as error:
+        raise HTTPException(503, str(error))
+
+    return json_response(dict(job, created_now=created),
+                         status_code=200 if job['status'] == 'done' else 202,
+                         headers={'Location': f"/report-jobs/{job['id']}"})
+
+
+@app.get('/report-jobs/{job_id}')
+async def get_report_job(job_id: str):
+    """
+    Returns the status of a report job
+    """
+    job = await run_in_threadpool(report_jobs.get, job_id)
+    if job is None:
+        raise HTTPException(404, f'no job {job_id}')
+
+    if job['status'] == 'done':
+        job['result'] = f'/report-jobs/{job_id}/result'
+
+    return json_response(job)
+
+
+@app.get('/report-jobs/{job_id}/result')
+async def get_report_job_result(job_id: str):
+    """
+    Returns the report generated by a finished job
+    """
+    job = await run_in_threadpool(report_jobs.get, job_id, True)
+    if job is None:
+        raise HTTPException(404, f'no job {job_id}')
+    if job['status'] != 'done':
+        raise HTTPException(409, f"job {job_id} is {job['status']}")
+
+    return Response(job['result'], media_type='application/json')
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """
+    Returns connection pool counts, cache counts, and request latency
+    per endpoint
+    """
+    requests = {endpoint: dict(stats, mean_ms=stats['total_ms'] /
+                               stats['count'])
+                for endpoint, stats in latency.items()}
+
+    pool = {'size': 0, 'idle': 0}
+    if _pool is not None:
+        pool = {'size': _pool.get_size(), 'idle': _pool.get_idle_size(),
+                'min_size': _pool.get_min_size(),
+                'max_size': _pool.get_max_size()}
+
+    return json_response({'pool': pool,
+                          'sync_pool': sync_pool.stats(),
+                          'route_info_cache': route_info_cache.stats(),
+                          'single_flight': flights.stats(),
+                          'report_jobs': report_jobs.stats(),
+                          'vehicles': vehicle_store.stats(),
+                          'vehicle_feed': vehicle_feed.stats(),
+                          'requests': requests})
+
+
+def not_modified(request, etag, updated_at):
+    """
+    Returns True if a conditional request already has this version,
+    If-None-Match is used over If-Modified-Since when both are sent
+    """
+    if 'if-none-match' in request.headers:
+        tags = [tag.strip() for tag in
+                request.headers['if-none-match'].split(',')]
+        return etag in tags or '*' in tags
+
+    if 'if-modified-since' in request.headers:
+        try:
+            since = parsedate_to_datetime(request.headers['if-modified-since'])
+        except (TypeError, ValueError):
+            return False
+        return updated_at.replace(microsecond=0) <= since
+
+    return False
+
+
+def parse_day(day):
+    """
+    Returns the UTC bounds of a day parameter, defaulting to yesterday
+    """
+    day = day or date.today() - timedelta(days=1)
+    try:
+        return day_bounds(day)
+    except ValueError:
+        raise HTTPException(400, 'day must be a date as YYYY-MM-DD')
+
+
+def json_response(data, status_code=200, headers=None):
+    """
+    Returns data serialized the same way as the Flask app
+    """
+    return Response(dumps(data),
+                    status_code=status_code, headers=headers,
+                    media_type='application/json')
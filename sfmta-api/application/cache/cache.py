@@ -0,0 +1,316 @@
+# An in-process cache with a size bound and expiry, shared by the API
+# endpoints
+
+import os
+import fcntl
+import pickle
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    def __init__(self, max_size=512, ttl=86400):
+        """
+        The TTLCache class keeps up to max_size values, evicting the least
+        recently used one when full, and drops values older than ttl.
+
+        Safe to use from several threads.
+
+        Parameters:
+
+        max_size (int)
+            - the most values to keep
+
+        ttl (float)
+            - seconds a value is kept after it is stored, None to keep
+              values until they are evicted or invalidated
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (value, time stored), least recently used first
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self._counts = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0
+        }
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, or default if there is none
+        """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is not None and self._expired(entry):
+                del self._data[key]
+                self._counts['expirations'] += 1
+                entry = None
+
+            if entry is None:
+                self._counts['misses'] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self._counts['hits'] += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Stores a value, evicting the least recently used value if full
+        """
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._counts['evictions'] += 1
+
+    def invalidate(self, match=None):
+        """
+        Drops stored values
+
+        Arguments:
+            match (function): drops the values whose key match(key) is
+                              True for, or every value if None
+
+        Returns how many values were dropped
+        """
+        with self._lock:
+            keys = [key for key in self._data
+                    if match is None or match(key)]
+            for key in keys:
+                del self._data[key]
+            self._counts['invalidations'] += len(keys)
+
+        return len(keys)
+
+    def stats(self):
+        """
+        Returns a dict of the cache size and counters
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['size'] = len(self._data)
+            stats['max_size'] = self.max_size
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_rate'] = stats['hits'] / lookups if lookups else None
+
+        return stats
+
+    def _expired(self, entry):
+        return (self.ttl is not None and
+                time.monotonic() - entry[1] > self.ttl)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SingleFlight:
+    def __init__(self):
+        """
+        The SingleFlight class coalesces concurrent identical computations
+        in one process: while a computation for a key is running, other
+        threads asking for the same key wait for it and share its result
+        instead of repeating it.
+        """
+        self._calls = {}
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self._counts = {'computed': 0, 'shared': 0}
+
+    def do(self, key, compute):
+        """
+        Returns compute(), or the result of the call already running for
+        key if there is one
+
+        If compute raises, every thread waiting on it gets the exception
+
+        Arguments:
+            key (hashable): identifies the computation
+            compute (function): takes no arguments, returns the result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self._counts['computed'] += 1
+            else:
+                self._counts['shared'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+
+        try:
+            call.value = compute()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            # later calls start a new computation
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.value
+
+    def stats(self):
+        """
+        Returns a dict of the counters, and how many calls are running
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['in_flight'] = len(self._calls)
+
+        return stats
+
+
+class FileSingleFlight(SingleFlight):
+    def __init__(self, directory, max_age=600):
+        """
+        The FileSingleFlight class coalesces concurrent identical
+        computations across processes on one machine, such as gunicorn
+        workers, using a lock file per key.
+
+        Threads in one process are coalesced first, then one thread per
+        process takes the key's file lock. The first to get it computes
+        and saves the result, the others read that result once the lock
+        is free. Results must be picklable.
+
+        Parameters:
+
+        directory (str)
+            - where the lock and result files are kept, shared by all the
+              processes and only writable by them
+
+        max_age (float)
+            - seconds a saved result is kept, it is only read by processes
+              that were waiting while it was computed; older files are
+              deleted every max_age seconds so the directory doesn't grow
+              with every key ever computed
+        """
+        super().__init__()
+        self.directory = directory
+        self.max_age = max_age
+        self._swept = time.time()
+        os.makedirs(directory, exist_ok=True)
+
+    def do(self, key, compute):
+        value = super().do(key, lambda: self._locked(key, compute))
+
+        # at most one sweep per max_age in each process
+        with self._lock:
+            sweep = time.time() - self._swept > self.max_age
+            if sweep:
+                self._swept = time.time()
+        if sweep:
+            self.sweep()
+
+        return value
+
+    def sweep(self):
+        """
+        Deletes the files of keys whose result is older than max_age, and
+        temporary files left by processes that died while writing
+
+        A key's files are only deleted while holding its lock, so nobody
+        is computing it.  A process that opened the lock file just before
+        it was deleted may compute the key again, it never gets a wrong
+        result.
+        """
+        cutoff = time.time() - self.max_age
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    os.remove(entry.path)
+                elif entry.name.endswith('.lock'):
+                    self._remove_key(entry.path[:-len('.lock')], cutoff)
+            except OSError:
+                # deleted by another process's sweep
+                pass
+
+    def _remove_key(self, path, cutoff):
+        """
+        Deletes a key's lock and result files if the result is older than
+        cutoff (or missing) and nobody holds the lock
+        """
+        with open(path + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # being computed right now
+                return
+            try:
+                try:
+                    if os.path.getmtime(path + '.result') >= cutoff:
+                        return
+                    os.remove(path + '.result')
+                except FileNotFoundError:
+                    pass
+                os.remove(path + '.lock')
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _locked(self, key, compute):
+        """
+        Computes under the key's file lock, or reads the result saved by
+        the process that held the lock while this one waited
+        """
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        path = os.path.join(self.directory, name)
+        started = time.time()
+
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # a result saved after this call started was computed by
+                # another process while this one waited for the lock
+                try:
+                    if os.path.getmtime(path + '.result') >= started:
+                        with open(path + '.result', 'rb') as result:
+                            with self._lock:
+                                self._counts['shared'] += 1
+                            return pickle.load(result)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+
+                value = compute()
+
+                # write then rename, so readers never see a partial file
+                temp = f'{path}.{os.getpid()}.tmp'
+                with open(temp, 'wb') as result:
+                    pickle.dump(value, result)
+                os.replace(temp, path + '.result')
+
+                return value
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class _Call:
+    """ a computation running in a SingleFlight """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
@@ -0,0 +1,323 @@
+# A thread-safe pool of database connections shared by the API endpoints
+
+import select
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+import psycopg2 as pg
+from psycopg2 import extensions
+
+
+# locations timestamps are stored in UTC, and the API reports them in
+# Pacific Standard Time (the 'pst' conversions in its queries)
+LOCAL_UTC_OFFSET = timedelta(hours=-8)
+
+
+def day_bounds(day):
+    """
+    Returns the UTC [start, end) bounds of a local service day, as naive
+    datetimes to compare with the locations timestamp column
+
+    Comparing the raw column with these bounds lets the database use an
+    index on timestamp, instead of converting every row's timestamp.
+
+    Arguments:
+        day (str or date): the local date, as YYYY-MM-DD if a string
+
+    Raises ValueError if day is not a valid date
+    """
+
+    start = datetime.combine(date.fromisoformat(str(day)),
+                             datetime.min.time()) - LOCAL_UTC_OFFSET
+    return start, start + timedelta(days=1)
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection is free before the checkout timeout
+    """
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, creds, min_size=1, max_size=10, timeout=30,
+                 check_after=30, max_idle=300):
+        """
+        The ConnectionPool class keeps database connections open between
+        requests, so each request doesn't pay for a new connection and the
+        number of connections to the database stays bounded.
+
+        Connections are opened lazily, so the app can start while the
+        database is down.
+
+        Parameters:
+
+        creds (dict)
+            - local environment variables for db connection
+
+        min_size (int)
+            - how many idle connections to keep open once opened, idle
+              connections past this are closed after max_idle seconds
+
+        max_size (int)
+            - the most connections open at once, checkouts past this
+              wait for a connection to be returned
+
+        timeout (float)
+            - seconds to wait for a free connection before raising
+              PoolTimeout
+
+        check_after (float)
+            - connections idle for longer than this many seconds are
+              checked with a trivial query before being handed out
+
+        max_idle (float)
+            - seconds an idle connection past min_size is kept open
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('pool sizes must satisfy 0 <= min <= max, '
+                             'and max >= 1')
+
+        self.creds = creds
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_idle = max_idle
+
+        # idle connections, as (connection, time returned) pairs
+        # used as a stack so the most recently used connection is reused
+        self._idle = []
+        self._open = 0
+        self._lock = threading.Condition()
+
+        # counters exposed through stats()
+        self._counts = {
+            'opened': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'failed_checks': 0
+        }
+
+    def getconn(self):
+        """
+        Checks out a connection, opening one if none are idle and the pool
+        is not full, otherwise waiting for one to be returned
+
+        The connection must be given back with putconn()
+        """
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            self._counts['checkouts'] += 1
+
+        while True:
+            with self._lock:
+                cnx, idle_since = self._take(deadline)
+
+            # nothing idle, but there is room for a new connection
+            if cnx is None:
+                return self._connect()
+
+            # connections that have been idle a while may have been dropped
+            # by the server, check them before handing them out
+            if (time.monotonic() - idle_since > self.check_after and
+                    not self._healthy(cnx)):
+                self._discard(cnx, failed=True)
+                continue
+
+            return cnx
+
+    def putconn(self, cnx):
+        """
+        Returns a connection to the pool
+
+        Any open transaction is rolled back so the next user gets a clean
+        connection, broken connections are closed instead of being reused
+        """
+        try:
+            if cnx.closed:
+                raise pg.InterfaceError('connection already closed')
+            status = cnx.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                raise pg.InterfaceError('connection lost')
+            if status != extensions.TRANSACTION_STATUS_IDLE:
+                cnx.rollback()
+        except pg.Error:
+            self._discard(cnx)
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            self._idle.append((cnx, now))
+            self._lock.notify()
+
+            # the oldest idle connections are at the bottom of the stack,
+            # close them once there are more than min_size idle
+            stale = []
+            while (len(self._idle) > self.min_size and
+                    now - self._idle[0][1] > self.max_idle):
+                stale.append(self._idle.pop(0)[0])
+
+        for old in stale:
+            self._discard(old)
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the length of a with block
+        """
+        cnx = self.getconn()
+        try:
+            yield cnx
+        finally:
+            self.putconn(cnx)
+
+    def close(self):
+        """
+        Closes every idle connection, checked out connections are closed
+        when they are returned
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for cnx, _ in idle:
+            self._discard(cnx)
+
+    def stats(self):
+        """
+        Returns a dict of the pool size and counters
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['open'] = self._open
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._open - len(self._idle)
+            stats['min_size'] = self.min_size
+            stats['max_size'] = self.max_size
+
+        return stats
+
+    def _take(self, deadline):
+        """
+        Returns an idle (connection, idle since) pair, or (None, None) after
+        reserving room for a new connection
+
+        Must be called holding the lock
+        """
+        waited = False
+        while not self._idle and self._open >= self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self._counts['timeouts'] += 1
+                raise PoolTimeout(f'no free connection after {self.timeout}s')
+            if not waited:
+                self._counts['waits'] += 1
+                waited = True
+            self._lock.wait(remaining)
+
+        if self._idle:
+            return self._idle.pop()
+
+        # count the connection as open before connecting, so other threads
+        # can't go past max_size while this one connects
+        self._open += 1
+        return None, None
+
+    def _connect(self):
+        """
+        Opens a new connection, in the room reserved by _take()
+        """
+        try:
+            cnx = pg.connect(**self.creds)
+        except Exception:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._counts['opened'] += 1
+
+        return cnx
+
+    def _healthy(self, cnx):
+        """
+        Returns True if the connection still answers a trivial query
+        """
+        try:
+            with cnx.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            cnx.rollback()
+            return True
+        except pg.Error:
+            return False
+
+    def _discard(self, cnx, failed=False):
+        """
+        Closes a connection and frees its place in the pool
+        """
+        try:
+            cnx.close()
+        except pg.Error:
+            pass
+
+        with self._lock:
+            self._open -= 1
+            self._counts['closed'] += 1
+            if failed:
+                self._counts['failed_checks'] += 1
+            self._lock.notify()
+
+
+def listen(creds, callbacks, retry=30):
+    """
+    Calls callbacks[channel](payload) for each NOTIFY sent on the channels,
+    forever
+
+    Runs on its own connection, outside the pool, and reconnects after
+    retry seconds if the connection is lost. Meant to run in a daemon
+    thread, see start_listener().
+
+    Arguments:
+        creds (dict): local environment variables for db connection
+        callbacks (dict): the function to call with the payload of each
+                          notification, for each channel to LISTEN on
+                          (channels are plain identifiers)
+        retry (float): seconds to wait before reconnecting
+    """
+    while True:
+        try:
+            cnx = pg.connect(**creds)
+            cnx.autocommit = True
+            with cnx.cursor() as cursor:
+                for channel in callbacks:
+                    cursor.execute(f'LISTEN {channel};')
+
+            while True:
+                # wake up now and then even without notifications,
+                # so a dropped connection is noticed by poll()
+                select.select([cnx], [], [], 60)
+                cnx.poll()
+                while cnx.notifies:
+                    note = cnx.notifies.pop(0)
+                    try:
+                        callbacks[note.channel](note.payload)
+                    except Exception:
+                        # keep listening if one callback fails
+                        traceback.print_exc()
+        except pg.Error:
+            time.sleep(retry)
+
+
+def start_listener(creds, callbacks):
+    """
+    Runs listen() in a daemon thread and returns the thread
+    """
+    thread = threading.Thread(target=listen, args=(creds, callbacks),
+                              name='listen', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,135 @@
+# Script that measures the daily locations queries before and after
+# switching from the text LIKE filter to UTC range bounds
+#
+# Run from sfmta-api/application, before and after applying
+# migrations/001_locations_time_indexes.sql:
+#     python -m database.measure_daily_queries 2020-06-01 --route 1
+
+import os
+import json
+import argparse
+import statistics
+import psycopg2 as pg
+from dotenv import load_dotenv
+from database.database import day_bounds
+
+# the filters the daily endpoints used before, and use now
+OLD_WHERE = {
+    'general': """
+    (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst')::TEXT LIKE %s
+    """,
+    'route': """
+    (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst')::TEXT LIKE %s
+    AND rid = %s
+    """
+}
+NEW_WHERE = {
+    'general': """
+    timestamp >= %s AND timestamp < %s
+    """,
+    'route': """
+    timestamp >= %s AND timestamp < %s
+    AND rid = %s
+    """
+}
+
+
+def measure(cursor, where, params, runs):
+    """
+    Runs EXPLAIN ANALYZE on a daily query several times
+
+    Arguments:
+        cursor (psycopg2 cursor): cursor on the database to measure
+        where (str): the WHERE clause of the query
+        params (tuple): values for the placeholders in where
+        runs (int): how many times to run the query
+
+    Returns a dict of the median and min execution time (ms), the number
+    of rows, and the scan used on the locations table
+    """
+
+    query = f"""
+    EXPLAIN (ANALYZE, FORMAT JSON)
+    SELECT
+    (timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst'),
+    rid, vid, age, kph, heading, latitude, longitude, direction
+    FROM locations
+    WHERE {where}
+    ORDER BY timestamp, id
+    """
+
+    times = []
+    for _ in range(runs):
+        cursor.execute(query, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        times.append(plan[0]['Execution Time'])
+
+    return {
+        'median_ms': statistics.median(times),
+        'min_ms': min(times),
+        'rows': plan[0]['Plan']['Actual Rows'],
+        'scans': find_scans(plan[0]['Plan'])
+    }
+
+
+def find_scans(node):
+    """ returns the scan node types (and indexes) in a query plan """
+
+    scans = []
+    if node['Node Type'].endswith('Scan'):
+        scan = node['Node Type']
+        if 'Index Name' in node:
+            scan += f" using {node['Index Name']}"
+        scans.append(scan)
+
+    for child in node.get('Plans', []):
+        scans += find_scans(child)
+
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare daily locations query latency')
+    parser.add_argument('day', help='local date to query, YYYY-MM-DD')
+    parser.add_argument('--route', default='1', help='route id')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs of each query')
+    args = parser.parse_args()
+
+    # load credentials
+    load_dotenv()
+    creds = {
+      'user': os.environ.get('USERNAME'),
+      'password': os.environ.get('PASSWORD'),
+      'host': os.environ.get('HOST'),
+      'dbname': os.environ.get('DATABASE')
+    }
+
+    start, end = day_bounds(args.day)
+    like = f'%{args.day}%'
+
+    cnx = pg.connect(**creds)
+    with cnx.cursor() as cursor:
+        for name in ('general', 'route'):
+            route = (args.route,) if name == 'route' else ()
+            before = measure(cursor, OLD_WHERE[name], (like,) + route,
+                             args.runs)
+            after = measure(cursor, NEW_WHERE[name], (start, end) + route,
+                            args.runs)
+
+            print(f"{name}: {before['rows']} rows before, "
+                  f"{after['rows']} rows after")
+            print(f"  before: median {before['median_ms']:.1f}ms, "
+                  f"min {before['min_ms']:.1f}ms, "
+                  f"{', '.join(before['scans'])}")
+            print(f"  after:  median {after['median_ms']:.1f}ms, "
+                  f"min {after['min_ms']:.1f}ms, "
+                  f"{', '.join(after['scans'])}")
+    cnx.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+-- Indexes for time range queries on the locations table
+--
+-- The daily endpoints filter on timestamp >= start AND timestamp < end,
+-- optionally with rid = route, and order by (timestamp, id) for keyset
+-- pagination. id is included so the index also gives that order.
+--
+-- CONCURRENTLY builds the indexes without blocking the collector's inserts,
+-- so this file can't run inside a transaction block:
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 001_locations_time_indexes.sql
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS locations_timestamp_id_idx
+    ON locations (timestamp, id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS locations_rid_timestamp_id_idx
+    ON locations (rid, timestamp, id);
+
+ANALYZE locations;
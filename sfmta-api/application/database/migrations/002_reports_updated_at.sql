@@ -0,0 +1,11 @@
+-- Tracks when each stored report last changed, for the Last-Modified
+-- header of the /report endpoint
+--
+-- New reports get the insert time, and report_main sets it again when it
+-- updates an existing report. Existing rows get the time this runs.
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 002_reports_updated_at.sql
+
+ALTER TABLE reports
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS reports_date_idx ON reports (date);
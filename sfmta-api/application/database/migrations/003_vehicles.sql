@@ -0,0 +1,26 @@
+-- The latest location report of each vehicle, upserted by
+-- location_collector every cycle so the real-time endpoints don't need
+-- to search the locations history
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 003_vehicles.sql
+
+CREATE TABLE IF NOT EXISTS vehicles (
+    vid TEXT PRIMARY KEY,
+    timestamp TIMESTAMP NOT NULL,
+    rid TEXT,
+    age INTEGER,
+    kph INTEGER,
+    heading INTEGER,
+    latitude DOUBLE PRECISION,
+    longitude DOUBLE PRECISION,
+    direction TEXT
+);
+
+-- fill it from the last hour of history
+INSERT INTO vehicles (vid, timestamp, rid, age, kph, heading,
+                      latitude, longitude, direction)
+SELECT DISTINCT ON (vid)
+    vid, timestamp, rid, age, kph, heading, latitude, longitude, direction
+FROM locations
+WHERE timestamp > (SELECT MAX(timestamp) FROM locations) - INTERVAL '1 hour'
+ORDER BY vid, timestamp DESC
+ON CONFLICT (vid) DO NOTHING;
@@ -0,0 +1,28 @@
+-- Grid tiles for bounding box queries on the locations table
+--
+-- location_collector stores the tile of each location report, this adds
+-- the column, fills it for the existing rows, and indexes (tile, timestamp)
+-- so /locations/bbox only reads the tiles covering the box. The key must
+-- match tile_key() in application/locations/locations.py:
+--     tile = floor((latitude + 90) * 100) * 65536
+--            + floor((longitude + 180) * 100)
+--
+-- Run it before deploying the new location_collector, which inserts the
+-- column, and once more after to fill the rows inserted in between; the
+-- fill only touches rows without a tile. CONCURRENTLY builds the index
+-- without blocking inserts, so this file can't run inside a transaction:
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 004_locations_tiles.sql
+
+ALTER TABLE locations ADD COLUMN IF NOT EXISTS tile INTEGER;
+
+UPDATE locations
+SET tile = floor((latitude::DOUBLE PRECISION + 90) * 100)::INTEGER * 65536
+           + floor((longitude::DOUBLE PRECISION + 180) * 100)::INTEGER
+WHERE tile IS NULL
+    AND latitude IS NOT NULL
+    AND longitude IS NOT NULL;
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS locations_tile_timestamp_idx
+    ON locations (tile, timestamp);
+
+ANALYZE locations;
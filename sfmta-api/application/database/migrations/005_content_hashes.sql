@@ -0,0 +1,21 @@
+-- Content hashes of the stored route definitions and schedules
+--
+-- route_collector and schedule_collector store the SHA-256 of each new
+-- version's content as canonical JSON (see AWS_Lambda/versions.py), and
+-- detect changes by comparing hashes, without reading the content back.
+--
+-- Postgres can't reproduce that JSON from jsonb, so existing rows are left
+-- without a hash: the collectors compare the content of a version that has
+-- none once, the old way, and fill in its hash if it is unchanged.
+--
+-- Run it before deploying the new collectors, which insert the column:
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 005_content_hashes.sql
+
+ALTER TABLE routes ADD COLUMN IF NOT EXISTS content_hash TEXT;
+ALTER TABLE schedules ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+-- the latest version of every route, see latest_versions()
+CREATE INDEX IF NOT EXISTS routes_rid_begin_date_idx
+    ON routes (rid, begin_date DESC, id DESC);
+CREATE INDEX IF NOT EXISTS schedules_rid_begin_date_idx
+    ON schedules (rid, begin_date DESC, id DESC);
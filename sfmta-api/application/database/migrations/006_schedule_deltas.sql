@@ -0,0 +1,21 @@
+-- Schedule versions stored as deltas
+--
+-- With SCHEDULE_DELTAS=1, schedule_collector stores a new schedule version
+-- as the changes against the route's latest full version (a keyframe)
+-- instead of the whole multi-MB schedule: content is NULL, base_id is the
+-- keyframe's id and delta holds the changes (see diff_content() in
+-- AWS_Lambda/versions.py). A version is rebuilt by applying its delta to
+-- the keyframe's content, existing rows stay full versions.
+--
+-- Run it before deploying the new schedule_collector, which inserts the
+-- columns:
+--     psql -h $HOST -U $USERNAME -d $DATABASE -f 006_schedule_deltas.sql
+
+ALTER TABLE schedules ALTER COLUMN content DROP NOT NULL;
+
+ALTER TABLE schedules
+    ADD COLUMN IF NOT EXISTS base_id INTEGER REFERENCES schedules (id),
+    ADD COLUMN IF NOT EXISTS delta JSONB;
+
+-- counting the deltas of a keyframe, see schedule_collector
+CREATE INDEX IF NOT EXISTS schedules_base_id_idx ON schedules (base_id);
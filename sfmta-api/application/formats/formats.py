@@ -0,0 +1,291 @@
+# Encodes responses, shared by the Flask app and the ASGI app: JSON through
+# a fast encoder, and columnar Arrow IPC, Parquet or MessagePack batches for
+# clients that load bulk data into dataframes
+
+import json
+from datetime import date
+
+# orjson serializes much faster than json, and handles datetimes natively,
+# dumps() falls back to json with the same output without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# the columnar formats need optional packages, and are only offered when
+# they are installed
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# the media type of each response format
+MEDIA_TYPES = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+    'msgpack': 'application/msgpack'
+}
+
+COLUMNAR_FORMATS = ['arrow', 'parquet', 'msgpack']
+
+
+def dumps(data):
+    """
+    Returns data serialized as compact JSON bytes
+
+    Dates and datetimes are written as ISO 8601 strings, numpy scalars as
+    numbers, and other values json can't serialize (e.g. Decimal) as str().
+    """
+    if orjson is not None:
+        return orjson.dumps(data, default=_default,
+                            option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=_default, separators=(',', ':'),
+                      ensure_ascii=False).encode()
+
+
+def _default(value):
+    """ serializes the values the JSON encoders don't handle """
+    if isinstance(value, date):
+        return value.isoformat()
+    if hasattr(value, 'item') and hasattr(value, 'dtype'):
+        return value.item()
+    return str(value)
+
+
+def column_names(cursor):
+    """
+    Returns the names of the columns of a cursor's last query, from
+    cursor.description, so rows are keyed by what the query selected
+    """
+    return [column[0] for column in cursor.description]
+
+
+def serialize_rows(columns, rows):
+    """
+    Returns rows as a JSON array of objects keyed by columns, as bytes
+
+    Arguments:
+        columns (list): the name of each value of a row, see column_names()
+        rows (list): rows as sequences, values past the columns are left out
+    """
+    return dumps([dict(zip(columns, row)) for row in rows])
+
+
+def available_formats(formats):
+    """
+    Returns the formats of a list whose packages are installed
+    """
+    missing = set()
+    if pa is None:
+        missing |= {'arrow', 'parquet'}
+    if msgpack is None:
+        missing.add('msgpack')
+    return [name for name in formats if name not in missing]
+
+
+def negotiate(requested, accept, formats):
+    """
+    Picks the format of a response
+
+    Arguments:
+        requested (str): the format request parameter, wins if given
+        accept (str): the Accept header, used if no format was requested
+        formats (list): the formats the endpoint serves, the first one is
+                        the default
+
+    Returns the format's name, the default if the Accept header names none
+    of them
+
+    Raises ValueError with a message for the client if the requested
+    format is not served
+    """
+    formats = available_formats(formats)
+
+    if requested:
+        if requested not in formats:
+            raise ValueError(f'format must be one of: {", ".join(formats)}')
+        return requested
+
+    # media types in order of preference, by q value then position
+    preferred = []
+    for position, part in enumerate((accept or '').split(',')):
+        media, _, params = part.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        preferred.append((-quality, position, media.strip().lower()))
+
+    for quality, _, media in sorted(preferred):
+        if quality == 0:
+            break
+        for name in formats:
+            if MEDIA_TYPES[name] == media:
+                return name
+
+    return formats[0]
+
+
+class ColumnarEncoder:
+    def __init__(self, output, fields, types=None):
+        """
+        The ColumnarEncoder class turns batches of rows into a columnar
+        response, chunk by chunk, so a large result can be streamed
+
+        - arrow: an Arrow IPC stream, one record batch per batch of rows
+        - parquet: a Parquet file, one row group per batch of rows
+        - msgpack: a sequence of MessagePack maps of {field: [values]},
+          one per batch of rows, timestamps as strings like the JSON output
+
+        Parameters:
+
+        output (str)
+            - 'arrow', 'parquet' or 'msgpack'
+
+        fields (list)
+            - the names of the columns, rows may have extra values after
+              them which are left out
+
+        types (list)
+            - the Arrow type of each field ('int64', 'float64', 'string'
+              or 'timestamp'), inferred from the first batch if not given
+        """
+        self.output = output
+        self.fields = fields
+        self.types = types
+
+        self._sink = _Sink()
+        self._writer = None
+        self._schema = None
+
+    def encode(self, rows):
+        """
+        Returns the bytes of a batch of rows
+        """
+        if not rows:
+            return b''
+
+        columns = list(zip(*rows))[:len(self.fields)]
+
+        if self.output == 'msgpack':
+            return msgpack.packb(dict(zip(self.fields, map(list, columns))),
+                                 default=_default, use_bin_type=True)
+
+        if self._schema is None:
+            arrays = [pa.array(column, type=_arrow_type(name))
+                      for column, name in zip(columns, self._type_names())]
+            self._schema = pa.schema([(field, array.type) for field, array
+                                      in zip(self.fields, arrays)])
+        else:
+            arrays = [pa.array(column, type=field.type)
+                      for column, field in zip(columns, self._schema)]
+
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+        self._write(batch)
+        return self._sink.drain()
+
+    def finish(self):
+        """
+        Returns the bytes that end the response
+        """
+        if self.output == 'msgpack':
+            return b''
+
+        # an empty result still carries the columns
+        if self._schema is None:
+            self._schema = pa.schema([
+                (field, _arrow_type(name) or pa.null())
+                for field, name in zip(self.fields, self._type_names())])
+        if self._writer is None:
+            self._open()
+        self._writer.close()
+        return self._sink.drain()
+
+    def _type_names(self):
+        return self.types or [None] * len(self.fields)
+
+    def _open(self):
+        if self.output == 'arrow':
+            self._writer = pa.ipc.new_stream(self._sink, self._schema)
+        else:
+            self._writer = pq.ParquetWriter(self._sink, self._schema)
+
+    def _write(self, batch):
+        if self._writer is None:
+            self._open()
+        if self.output == 'arrow':
+            self._writer.write_batch(batch)
+        else:
+            self._writer.write_table(pa.Table.from_batches([batch]))
+
+
+def encode_records(records, output):
+    """
+    Returns a list of dicts encoded as one columnar batch, with a column
+    for every key found in the dicts, in order of appearance
+
+    Nested values become Arrow structs and lists.
+    """
+    fields = list(dict.fromkeys(key for record in records for key in record))
+    rows = [tuple(record.get(field) for field in fields)
+            for record in records]
+
+    encoder = ColumnarEncoder(output, fields)
+    return encoder.encode(rows) + encoder.finish()
+
+
+def _arrow_type(name):
+    """ returns the Arrow type for a type name, None to infer it """
+    return {
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'string': pa.string(),
+        'timestamp': pa.timestamp('us'),
+        None: None
+    }[name]
+
+
+class _Sink:
+    """
+    A write-only file that keeps what was written until it is drained,
+    the Arrow and Parquet writers write into it
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,347 @@
+# A queue of report jobs that run in worker processes, so reports that take
+# minutes to generate are not built inside a request
+
+import os
+import sys
+import json
+import time
+import uuid
+import sqlite3
+import traceback
+import multiprocessing
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import psycopg2 as pg
+
+# the report generation code is shared with the report Lambda
+REPORT_GENERATION_PATH = os.environ.get(
+    'REPORT_GENERATION_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 '..', '..', '..', 'AWS_Lambda', 'Report_Generation'))
+
+# longest date range one job can cover
+MAX_RANGE_DAYS = 31
+
+# a job that hasn't finished this long after it was queued is assumed lost
+# (e.g. the API restarted), a day's report takes 3-4 minutes
+JOB_TIMEOUT = 60 * 60
+JOB_TIMEOUT_PER_DAY = 15 * 60
+
+
+class JobsUnavailable(Exception):
+    """
+    Raised when jobs are submitted but the report pipeline can't be
+    imported, see pipeline_error()
+    """
+    pass
+
+
+def import_pipeline():
+    """
+    Imports and returns report_main from REPORT_GENERATION_PATH
+    """
+    if REPORT_GENERATION_PATH not in sys.path:
+        sys.path.insert(0, REPORT_GENERATION_PATH)
+    import report_main
+    return report_main
+
+
+def pipeline_error():
+    """
+    Returns why the report pipeline can't be imported, or None if it can
+
+    Checked once when the queue is created, so a deployment without the
+    pipeline (e.g. the Docker image, which only holds sfmta-api) refuses
+    jobs with a clear error instead of failing every job it runs.
+    """
+    try:
+        import_pipeline()
+    except Exception as error:
+        # ImportError, or an error raised by one of its imports
+        return (f'report generation is unavailable, report_main could not '
+                f'be imported from {REPORT_GENERATION_PATH} ({error}); set '
+                f'REPORT_GENERATION_PATH to the AWS_Lambda/Report_Generation '
+                f'folder')
+    return None
+
+
+class JobQueue:
+    def __init__(self, db_path, creds, workers=2):
+        """
+        The JobQueue class queues report jobs in a SQLite database and runs
+        them in a pool of worker processes.
+
+        Each job covers one date, or a range of dates.  Jobs are keyed by
+        their dates, so asking for a report that is queued, running, or done
+        returns the existing job, and finished reports are kept in the
+        database so asking again is instant.
+
+        Several API processes can share one database file.
+
+        Parameters:
+
+        db_path (str)
+            - the SQLite database file, created if needed
+
+        creds (dict)
+            - local environment variables for db connection, used by the
+              workers to load data
+
+        workers (int)
+            - how many jobs run at once in this process's pool
+        """
+        self.db_path = db_path
+        self.creds = creds
+        self.workers = workers
+
+        # the pool is started on first use, not when the app is imported
+        self._executor = None
+
+        # jobs are refused if the workers couldn't build reports
+        self.unavailable = pipeline_error()
+        if self.unavailable:
+            print(self.unavailable)
+
+        db = self._connect()
+        try:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    key TEXT UNIQUE NOT NULL,
+                    start_date TEXT NOT NULL,
+                    end_date TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    expires REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    error TEXT,
+                    result TEXT
+                );
+            """)
+        finally:
+            db.close()
+
+    def submit(self, start, end=None):
+        """
+        Queues a report job for a date or range of dates, unless one is
+        already queued, running, or done
+
+        Arguments:
+            start (date): the first date of the report
+            end (date): the last date, inclusive (default: start)
+
+        Returns (job, created): the job as a dict, and whether it was
+        queued by this call
+
+        Raises ValueError if the range is backwards or too long, and
+        JobsUnavailable if the report pipeline can't be imported
+        """
+        if self.unavailable:
+            raise JobsUnavailable(self.unavailable)
+
+        end = start if end is None else end
+        days = (end - start).days + 1
+        if days < 1:
+            raise ValueError('end must not be before start')
+        if days > MAX_RANGE_DAYS:
+            raise ValueError(f'ranges are limited to {MAX_RANGE_DAYS} days')
+
+        key = f'{start}/{end}'
+        now = time.time()
+
+        db = self._connect()
+        try:
+            # take the write lock first, so two processes can't both
+            # decide to queue the same job
+            db.execute('BEGIN IMMEDIATE;')
+
+            row = db.execute('SELECT * FROM jobs WHERE key = ?;',
+                             (key,)).fetchone()
+            if row is not None and not _failed(row, now):
+                db.execute('COMMIT;')
+                return job_dict(row, now), False
+
+            # failed and lost jobs are replaced by a new attempt
+            job_id = uuid.uuid4().hex
+            db.execute('DELETE FROM jobs WHERE key = ?;', (key,))
+            db.execute("""
+                INSERT INTO jobs (id, key, start_date, end_date, status,
+                                  created, expires)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?);
+            """, (job_id, key, str(start), str(end), now,
+                  now + JOB_TIMEOUT + days * JOB_TIMEOUT_PER_DAY))
+            db.execute('COMMIT;')
+        except Exception:
+            db.execute('ROLLBACK;')
+            raise
+        finally:
+            db.close()
+
+        self._pool().submit(run_job, self.db_path, job_id, self.creds)
+
+        return self.get(job_id), True
+
+    def get(self, job_id, result=False):
+        """
+        Returns a job as a dict, or None if there is no such job
+
+        Arguments:
+            job_id (str): the id returned when the job was queued
+            result (bool): include the report JSON text of finished jobs
+        """
+        db = self._connect()
+        try:
+            row = db.execute('SELECT * FROM jobs WHERE id = ?;',
+                             (job_id,)).fetchone()
+        finally:
+            db.close()
+
+        if row is None:
+            return None
+
+        job = job_dict(row, time.time())
+        if result and job['status'] == 'done':
+            job['result'] = row['result']
+        return job
+
+    def stats(self):
+        """
+        Returns the number of jobs with each status
+        """
+        db = self._connect()
+        try:
+            rows = db.execute("""
+                SELECT status, COUNT(*) FROM jobs GROUP BY status;
+            """).fetchall()
+        finally:
+            db.close()
+
+        stats = {status: count for status, count in rows}
+        if self.unavailable:
+            stats['unavailable'] = self.unavailable
+        return stats
+
+    def _pool(self):
+        if self._executor is None:
+            # workers are spawned, not forked: by now the app runs other
+            # threads (LISTEN, vehicle reloads), and a forked child could
+            # deadlock on a lock one of them held at the time
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def _connect(self):
+        return connect(self.db_path)
+
+
+def connect(db_path):
+    """
+    Opens the jobs database, in autocommit mode so transactions are
+    explicit
+    """
+    db = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def job_dict(row, now):
+    """
+    Returns the public fields of a job row as a dict
+    """
+    job = {
+        'id': row['id'],
+        'start_date': row['start_date'],
+        'end_date': row['end_date'],
+        'status': row['status'],
+        'created': row['created'],
+        'started': row['started'],
+        'finished': row['finished'],
+        'error': row['error']
+    }
+
+    if _failed(row, now) and row['status'] != 'failed':
+        job['status'] = 'failed'
+        job['error'] = 'job was lost or timed out'
+
+    return job
+
+
+def _failed(row, now):
+    """ True if a job failed, or has not finished before it expired """
+    return (row['status'] == 'failed' or
+            (row['status'] != 'done' and now > row['expires']))
+
+
+def run_job(db_path, job_id, creds):
+    """
+    Runs a report job, in a worker process
+
+    Stored daily reports are reused, other dates are built with the report
+    Lambda's pipeline.  A single date's result is that day's report, a
+    range's result is a list of {"date", "report"} objects.
+
+    Arguments:
+        db_path (str): the jobs database
+        job_id (str): the job to run
+        creds (dict): local environment variables for db connection
+    """
+    db = connect(db_path)
+    db.execute("""
+        UPDATE jobs SET status = 'running', started = ? WHERE id = ?;
+    """, (time.time(), job_id))
+    row = db.execute('SELECT * FROM jobs WHERE id = ?;',
+                     (job_id,)).fetchone()
+
+    cnx = None
+    try:
+        start = date.fromisoformat(row['start_date'])
+        end = date.fromisoformat(row['end_date'])
+
+        cnx = pg.connect(**creds)
+        reports = []
+        day = start
+        while day <= end:
+            reports.append({'date': str(day),
+                            'report': build_report(day, cnx)})
+            day += timedelta(days=1)
+
+        result = reports[0]['report'] if start == end else reports
+        db.execute("""
+            UPDATE jobs SET status = 'done', finished = ?, result = ?
+            WHERE id = ?;
+        """, (time.time(), json.dumps(result, default=str), job_id))
+    except Exception as error:
+        traceback.print_exc()
+        db.execute("""
+            UPDATE jobs SET status = 'failed', finished = ?, error = ?
+            WHERE id = ?;
+        """, (time.time(), repr(error), job_id))
+    finally:
+        if cnx is not None:
+            cnx.close()
+        db.close()
+
+
+def build_report(day, cnx):
+    """
+    Returns the report for a date, from the reports table if it was stored,
+    otherwise built with the report Lambda's pipeline
+    """
+    with cnx.cursor() as cursor:
+        cursor.execute("""
+            SELECT report
+            FROM reports
+            WHERE date = %s::TIMESTAMP
+            LIMIT 1;
+        """, (day,))
+        row = cursor.fetchone()
+    cnx.rollback()
+
+    if row is not None:
+        report = row[0]
+        return json.loads(report) if isinstance(report, str) else report
+
+    return import_pipeline().build_report(pd.to_datetime(day), cnx)
@@ -0,0 +1,92 @@
+# Script that load tests an instance of the API, to compare the Flask app
+# (python app.py) with the ASGI app (uvicorn asgi:app --port 8000)
+#
+#     python load_test.py http://localhost:5000 /system-real-time-json
+#     python load_test.py http://localhost:8000 /system-real-time-json
+#
+# Each client sends its requests one after another.  With --read-delay,
+# clients read the response body slowly, like clients on slow connections
+# pulling a daily dump.
+
+import time
+import argparse
+import statistics
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_client(url, count, read_delay, chunk_size):
+    """
+    Sends count requests to url, one after another
+
+    Returns a list of (seconds, status code, bytes) for each request,
+    status code is None if the request failed
+    """
+    session = requests.Session()
+    results = []
+
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            with session.get(url, stream=True, timeout=300) as response:
+                size = 0
+                for chunk in response.iter_content(chunk_size):
+                    size += len(chunk)
+                    if read_delay:
+                        time.sleep(read_delay)
+                results.append((time.perf_counter() - start,
+                                response.status_code, size))
+        except requests.RequestException:
+            results.append((time.perf_counter() - start, None, 0))
+
+    return results
+
+
+def percentile(values, fraction):
+    """ returns the value at a fraction (0 to 1) of the sorted values """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the API')
+    parser.add_argument('base', help='base URL, e.g. http://localhost:5000')
+    parser.add_argument('path', nargs='?', default='/',
+                        help='path and query to request')
+    parser.add_argument('--clients', type=int, default=50,
+                        help='concurrent clients')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests per client')
+    parser.add_argument('--read-delay', type=float, default=0,
+                        help='seconds to wait between reading chunks')
+    parser.add_argument('--chunk-size', type=int, default=16384,
+                        help='bytes read at a time')
+    args = parser.parse_args()
+
+    url = args.base.rstrip('/') + args.path
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        futures = [executor.submit(run_client, url, args.requests,
+                                   args.read_delay, args.chunk_size)
+                   for _ in range(args.clients)]
+        results = [result for future in futures
+                   for result in future.result()]
+    elapsed = time.perf_counter() - start
+
+    ok = [seconds for seconds, status, _ in results if status == 200]
+    errors = len(results) - len(ok)
+    size = sum(size for _, _, size in results)
+
+    print(f'{url}: {args.clients} clients x {args.requests} requests '
+          f'in {elapsed:.2f}s')
+    print(f'  throughput: {len(ok) / elapsed:.1f} requests/s, '
+          f'{size / elapsed / 1e6:.2f} MB/s, {errors} errors')
+    if ok:
+        print(f'  latency: median {statistics.median(ok) * 1000:.1f}ms, '
+              f'p95 {percentile(ok, .95) * 1000:.1f}ms, '
+              f'max {max(ok) * 1000:.1f}ms')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# Builds the queries and output of the locations endpoints, shared by the
+# Flask app and the ASGI app
+
+import re
+import math
+from datetime import datetime, timedelta
+from formats.formats import COLUMNAR_FORMATS, ColumnarEncoder, negotiate, \
+    dumps, serialize_rows
+from database.database import LOCAL_UTC_OFFSET
+
+# columns that can be requested from the locations endpoints,
+# and the SQL that selects each one
+LOCATION_FIELDS = {
+    'id': 'id',
+    'timestamp': "(timestamp AT TIME ZONE 'utc' AT TIME ZONE 'pst')",
+    'rid': 'rid',
+    'vid': 'vid',
+    'age': 'age',
+    'kph': 'kph',
+    'heading': 'heading',
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'direction': 'direction'
+}
+
+# the Arrow type of each column, for the columnar formats
+LOCATION_TYPES = {
+    'id': 'int64',
+    'timestamp': 'timestamp',
+    'rid': 'string',
+    'vid': 'string',
+    'age': 'int64',
+    'kph': 'int64',
+    'heading': 'int64',
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'direction': 'string'
+}
+
+# response formats, json is the default
+STREAM_FORMATS = ['json', 'ndjson'] + COLUMNAR_FORMATS
+
+# columns returned when no fields are given
+DEFAULT_FIELDS = ['timestamp', 'rid', 'vid', 'age', 'kph', 'heading',
+                  'latitude', 'longitude', 'direction']
+
+# rows fetched from the server-side cursor at a time
+STREAM_BATCH = 5000
+
+# largest page a client can ask for
+MAX_PAGE = 50000
+
+# locations are filed in a grid of 1/TILES_PER_DEGREE degree tiles (about
+# 1.1km north-south and 0.9km east-west in San Francisco), the tile column
+# is set by location_collector, see tile_key()
+TILES_PER_DEGREE = 100
+
+# largest box and time window a bbox request can cover
+MAX_TILES = 2500
+MAX_WINDOW = timedelta(days=1)
+
+
+def parse_stream_args(args, accept=None):
+    """
+    Reads the streaming and paging parameters of a locations request
+
+    Arguments:
+        args (dict-like): the request's query parameters
+        accept (str): the request's Accept header, picks the format when
+                      there is no format parameter
+
+    Returns a dict of fields (list), format (from STREAM_FORMATS),
+    limit (int or None), and after ((timestamp, id) or None)
+
+    Raises ValueError with a message for the client if any are invalid
+    """
+
+    fields = args.get('fields') or ','.join(DEFAULT_FIELDS)
+    fields = [field.strip() for field in fields.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in LOCATION_FIELDS]
+    if unknown or not fields:
+        raise ValueError(
+            f'fields must be from: {", ".join(LOCATION_FIELDS)}')
+
+    output = negotiate(args.get('format'), accept, STREAM_FORMATS)
+
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_PAGE:
+            raise ValueError(f'limit must be between 1 and {MAX_PAGE}')
+
+    after = args.get('after')
+    if after is not None:
+        try:
+            after_time, after_id = after.rsplit(',', 1)
+            after = (datetime.fromisoformat(after_time), int(after_id))
+        except ValueError:
+            raise ValueError(
+                'after must be the X-Next-After of the previous page')
+
+    return {'fields': fields, 'format': output, 'limit': limit,
+            'after': after}
+
+
+def tile_key(latitude, longitude):
+    """
+    Returns the grid tile of a point, as stored in the locations tile column
+
+    location_collector and migrations/004_locations_tiles.sql compute the
+    same key, the three must be kept in step.
+    """
+    row = math.floor((latitude + 90) * TILES_PER_DEGREE)
+    column = math.floor((longitude + 180) * TILES_PER_DEGREE)
+    return row * 65536 + column
+
+
+def parse_bbox_args(args):
+    """
+    Reads the box and time window of a /locations/bbox request
+
+    Arguments:
+        args (dict-like): the request's query parameters, bbox as
+                          min_lon,min_lat,max_lon,max_lat and start, end as
+                          local (Pacific) ISO datetimes
+
+    Returns a dict of bbox (tuple), tiles (list of the tile keys that
+    cover the box), and start, end (UTC datetimes to compare with the
+    timestamp column)
+
+    Raises ValueError with a message for the client if any are invalid
+    """
+    try:
+        min_lon, min_lat, max_lon, max_lat = (
+            float(value) for value in args.get('bbox', '').split(','))
+    except ValueError:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    if not (-180 <= min_lon <= max_lon <= 180 and
+            -90 <= min_lat <= max_lat <= 90):
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+
+    # the corners' tiles give the range of rows and columns to read
+    low, high = tile_key(min_lat, min_lon), tile_key(max_lat, max_lon)
+    rows = range(low // 65536, high // 65536 + 1)
+    columns = range(low % 65536, high % 65536 + 1)
+    if len(rows) * len(columns) > MAX_TILES:
+        raise ValueError(f'bbox covers more than {MAX_TILES} tiles')
+
+    try:
+        start = datetime.fromisoformat(args.get('start', ''))
+        end = datetime.fromisoformat(args.get('end', ''))
+    except ValueError:
+        raise ValueError('start and end must be datetimes as '
+                         'YYYY-MM-DDTHH:MM:SS')
+    if not timedelta(0) < end - start <= MAX_WINDOW:
+        raise ValueError(f'end must be after start, by at most '
+                         f'{MAX_WINDOW.total_seconds() / 3600:g} hours')
+
+    return {'bbox': (min_lon, min_lat, max_lon, max_lat),
+            'tiles': [row * 65536 + column
+                      for row in rows for column in columns],
+            'start': start - LOCAL_UTC_OFFSET,
+            'end': end - LOCAL_UTC_OFFSET}
+
+
+def locations_query(where, params, fields, limit=None, after=None):
+    """
+    Builds the query for a locations request, with %s placeholders
+
+    Arguments:
+        where (str): SQL condition on the locations table, written by the
+                     endpoint and never taken from the request
+        params (tuple): values for the placeholders in where
+        fields (list): columns to select, from LOCATION_FIELDS
+        limit (int): the page size, or None for every row
+        after ((timestamp, id)): return the rows after this key
+
+    Returns (query, params)
+    """
+
+    # the raw timestamp and id are always selected last, they are the key
+    # the rows are ordered and paged by
+    query = f"""
+    SELECT
+    {', '.join(LOCATION_FIELDS[field] for field in fields)},
+    timestamp, id
+    FROM locations
+    WHERE {where}
+    """
+    params = list(params)
+
+    if after is not None:
+        query += "    AND (timestamp, id) > (%s::TIMESTAMP, %s)\n"
+        params += list(after)
+
+    query += "    ORDER BY timestamp, id\n"
+    if limit is not None:
+        query += "    LIMIT %s\n"
+        params.append(limit)
+
+    return query, params
+
+
+def next_after(rows, limit):
+    """
+    Returns the X-Next-After value for a page of rows, or None if the page
+    isn't full so there are no more rows
+    """
+    if limit is None or len(rows) < limit:
+        return None
+    return f'{rows[-1][-2].isoformat()},{rows[-1][-1]}'
+
+
+def encode_rows(rows, fields, output, first):
+    """
+    Serializes a batch of rows for a streamed response
+
+    Arguments:
+        rows (list): rows from locations_query(), in fields order
+        fields (list): the names of the selected fields
+        output (str): 'json' for part of one array, 'ndjson' for lines
+        first (bool): True for the first batch of a JSON array
+
+    Returns a bytes chunk, the JSON array's brackets are written by
+    the caller
+    """
+    if output == 'ndjson':
+        return b''.join(dumps(dict(zip(fields, row))) + b'\n'
+                        for row in rows)
+
+    # the batch is serialized as one array, without its brackets
+    chunk = serialize_rows(fields, rows)[1:-1]
+    return chunk if first or not chunk else b',' + chunk
+
+
+class LocationEncoder:
+    def __init__(self, fields, output):
+        """
+        The LocationEncoder class serializes the batches of rows of a
+        locations response, in any of STREAM_FORMATS
+
+        start(), encode() for each batch, then finish() give the bytes
+        chunks of the response
+
+        Parameters:
+
+        fields (list)
+            - the names of the selected fields
+
+        output (str)
+            - the response format, from STREAM_FORMATS
+        """
+        self.fields = fields
+        self.output = output
+        self._first = True
+        self._columnar = None
+        if output in COLUMNAR_FORMATS:
+            self._columnar = ColumnarEncoder(
+                output, fields, [LOCATION_TYPES[field] for field in fields])
+
+    def start(self):
+        """ Returns the chunk that starts the response """
+        if self._columnar is not None:
+            return b''
+        return b'[' if self.output == 'json' else b''
+
+    def encode(self, rows):
+        """ Returns the chunk for a batch of rows from locations_query() """
+        if self._columnar is not None:
+            return self._columnar.encode(rows)
+
+        chunk = encode_rows(rows, self.fields, self.output, self._first)
+        self._first = self._first and not rows
+        return chunk
+
+    def finish(self):
+        """ Returns the chunk that ends the response """
+        if self._columnar is not None:
+            return self._columnar.finish()
+        return b']' if self.output == 'json' else b''
+
+
+def numbered(query):
+    """
+    Returns a query with its %s placeholders numbered as $1, $2, ...
+    for asyncpg
+    """
+    count = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%s', lambda match: f'${next(count)}', query)
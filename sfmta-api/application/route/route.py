@@ -2,7 +2,9 @@
 # provides various accessor methods for it
 
 import pandas as pd
+import numpy as np
 import psycopg2 as pg
+from scipy.spatial import cKDTree
 # from dotenv import load_dotenv
 import os
 
@@ -25,21 +27,25 @@ class Route:
         self.route_id = str(route_id)
         self.date = pd.to_datetime(date)
 
-        # load the route data
-        self.route_data = load_route(self.route_id, self.date, connection)
+        # load the route data, and the id of the route definition row
+        self.version, self.route_data = load_route(self.route_id, self.date,
+                                                   connection)
 
         # extract stops info and rearrange columns to be more human readable
         # note: the stop tag is what was used in the schedule data, not stopId
         self.stops_table = pd.DataFrame(self.route_data['stop'])
         self.stops_table = self.stops_table[['stopId', 'tag', 'title', 'lat', 'lon']]
 
-        # extract route path, list of (lat, lon) pairs
-        self.path_coords = extract_path(self.route_data)
+        # extract the route path for each direction tag,
+        # arrays of (lat, lon) pairs
+        self.path_coords = get_paths(self.route_id, self.version,
+                                     self.route_data)
 
 
 def load_route(route, date, connection):
     """
-    loads raw route data from the database and returns it
+    loads raw route data from the database and returns it, along with
+    the id of the route definition row as its version
 
     Parameters:
 
@@ -70,7 +76,7 @@ def load_route(route, date, connection):
 
     # build selection query
     query = """
-        SELECT content
+        SELECT id, content
         FROM routes
         WHERE rid = %s AND
             begin_date <= %s::TIMESTAMP AND
@@ -79,75 +85,209 @@ def load_route(route, date, connection):
 
     # execute query and return the route data
     cursor.execute(query, (route, str(date), str(date)))
-    return cursor.fetchone()[0]['route']
+    result = cursor.fetchone()
+    return result[0], result[1]['route']
 
 
-def extract_path(route_data):
+# cache of built paths, keyed by (route id, route version id)
+# module level so it is reused while the process (or Lambda container) lives
+_path_cache = {}
+PATH_CACHE_SIZE = 256
+
+
+def get_paths(route_id, version, route_data):
+    """
+    Returns extract_paths(route_data), cached per route version
+
+    A route version never changes once it is stored, so the ordered paths
+    only need to be built once for each one.
+
+    Arguments:
+        route_id (str): the route id
+        version (int): the id of the route definition row in the database
+        route_data (dict): the raw route data for that version
     """
-    Extracts the list of path coordinates for a route.
 
-    The raw data stores this as an unordered list of sub-routes, so this
-    function deciphers the order they should go in and returns a single list.
+    key = (str(route_id), version)
+    if key not in _path_cache:
+        # drop the oldest entry when the cache is full
+        if len(_path_cache) >= PATH_CACHE_SIZE:
+            _path_cache.pop(next(iter(_path_cache)))
+        _path_cache[key] = extract_paths(route_data)
+
+    return _path_cache[key]
+
+
+def as_list(value):
     """
+    The raw Nextbus data uses a single object instead of a list when there
+    is only one item, this always returns a list
+    """
+
+    return value if isinstance(value, list) else [value]
 
-    # KNOWN BUG
-    # this approach assumed all routes were either a line or a loop.
-    # routes that have multiple sub-paths meeting at a point break this,
-    # route 24 is a current example.
-    # I'm committing this now to get the rest of the code out there
 
-    # extract the list of subpaths as just (lat,lon) coordinates
+def extract_paths(route_data, snap=.03, join=.015):
+    """
+    Extracts an ordered path for each direction (and branch) of a route.
+
+    The raw data stores the path as an unordered list of sub-paths that meet
+    at shared end points.  This indexes the sub-paths by their first point
+    in a dict, then chains them end to start for each direction: where the
+    path branches, it takes the sub-path that serves the direction's next
+    stop.  Routes that split into branches (route 24 for example) get one
+    path per branch.
+
+    Each sub-path is added at most once per direction, so the chaining is
+    linear in the number of sub-paths and stops.
+
+    Arguments:
+        route_data (dict): the raw route data
+        snap (float): sub-paths within this many km of the closest one to a
+                      stop are also considered to serve it (default .03)
+        join (float): end points closer than this many km are treated as
+                      the same point, the raw data is not always exact
+                      (default .015)
+
+    Returns a dict, keys are direction tags and values are (n, 2) numpy
+    arrays of (lat, lon) coordinates in the order a bus travels them
+    """
+
+    # extract each sub-path as an array of (lat, lon) coordinates
     # also converts from string to float (raw data has strings)
-    path = []
-    for sub_path in route_data['path']:
-        path.append([(float(p['lat']), float(p['lon'])) 
-                     for p in sub_path['point']])
-
-    # start with the first element, remove it from path
-    final = path[0]
-    path.pop(0)
-
-    # loop until the first and last coordinates in final match
-    counter = len(path)
-    done = True
-    while final[0] != final[-1]:
-        # loop through the sub-paths that we haven't yet moved to final
-        for i in range(len(path)):
-            # check if the last coordinate in final matches the first 
-            # coordinate of another sub-path
-            if final[-1] == path[i][0]:
-                # match found, move it to final
-                # leave out the first coordinate to avoid duplicates
-                final = final + path[i][1:]
-                path.pop(i)
-                break  # break the for loop
-                
-        # protection against infinite loops, if the path never closes
-        counter -= 1
-        if counter < 0:
-            done = False
-            break
-
-    if not done:
-        # route did not connect in a loop, perform same steps backwards 
-        # to get the rest of the line
-        for _ in range(len(path)):
-            # loop through the sub-paths that we haven't yet moved to final
-            for i in range(len(path)):
-                # check if the first coordinate in final matches the last 
-                # coordinate of another sub-path
-                if final[0] == path[i][-1]:
-                    # match found, move it to final
-                    # leave out the last coordinate to avoid duplicates
-                    final = path[i][:-1] + final
-                    path.pop(i)
-                    break  # break the for loop
-
-    # some routes may have un-used sub-paths
-    # Route 1 for example has two sub-paths that are almost identical, with the 
-    # same start and end points
-    if len(path) > 0:
-        print(f"WARNING: {len(path)} unused sub-paths")
-
-    # return the final result
-    return final
+    sub_paths = []
+    for sub_path in as_list(route_data['path']):
+        points = np.array([(float(p['lat']), float(p['lon']))
+                           for p in as_list(sub_path['point'])])
+        if len(points) >= 2:
+            sub_paths.append(points)
+    n_paths = len(sub_paths)
+
+    if n_paths == 0:
+        return {}
+
+    # project onto a flat plane in km, so distances are easy to calculate
+    center = np.concatenate(sub_paths).mean(axis=0)
+    scale = np.array([111.13, 111.41 * np.cos(np.radians(center[0]))])
+    flat = [(p - center) * scale for p in sub_paths]
+
+    # number the end points so the ones within join km of each other share
+    # a number: first points are 0 to n-1 and last points n to 2n-1, close
+    # pairs come from a KD-tree and are merged with a small union-find
+    ends = np.array([p[0] for p in flat] + [p[-1] for p in flat])
+    parent = list(range(len(ends)))
+
+    def node(i):
+        """ returns the number shared by end point i and those joined to it """
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in cKDTree(ends).query_pairs(join):
+        parent[node(i)] = node(j)
+
+    # sub-paths indexed by their first point, so the sub-paths continuing
+    # from another one are a dict lookup
+    starts_at = {}
+    for i in range(n_paths):
+        starts_at.setdefault(node(i), []).append(i)
+    end_node = [node(n_paths + i) for i in range(n_paths)]
+
+    # points every snap km along each sub-path, labelled with the sub-path,
+    # so the sub-paths near a stop are a KD-tree lookup even where the raw
+    # points are far apart
+    dense, owner = [], []
+    for i, p in enumerate(flat):
+        vectors = np.diff(p, axis=0)
+        steps = np.maximum(np.ceil(np.hypot(vectors[:, 0], vectors[:, 1]) /
+                                   snap), 1).astype(int)
+        segment = np.repeat(np.arange(len(vectors)), steps)
+        t = ((np.arange(steps.sum()) - np.repeat(steps.cumsum() - steps,
+                                                 steps)) /
+             np.repeat(steps, steps))
+        dense.append(p[segment] + t[:, None] * vectors[segment])
+        owner.append(np.full(len(segment), i))
+    dense = np.concatenate(dense + [np.array([p[-1] for p in flat])])
+    owner = np.concatenate(owner + [np.arange(n_paths)])
+    tree = cKDTree(dense)
+
+    # stop locations in the same flat plane
+    stops = {s['tag']: ((float(s['lat']), float(s['lon'])) - center) * scale
+             for s in as_list(route_data['stop'])}
+
+    def distance(i, location):
+        """ distance from a location to the closest point of sub-path i """
+        return np.linalg.norm(flat[i] - location, axis=1).min()
+
+    def chain(start, serves, locations):
+        """
+        Chains sub-paths from start through the stops, returns the list of
+        sub-paths and how many times it had to jump between sub-paths that
+        don't connect
+        """
+        order, used = [start], {start}
+        jumps = 0
+        k = 0
+        while True:
+            # move past the stops served by the sub-path just added, and
+            # stops whose sub-paths have all been used (a loop closing)
+            while k < len(serves) and (order[-1] in serves[k] or
+                                       serves[k] <= used):
+                k += 1
+            if k == len(serves):
+                return order, jumps
+
+            # continue with a sub-path that serves the next stop, or else
+            # one that ends closer to the next stop than it starts
+            follow = [j for j in starts_at.get(end_node[order[-1]], [])
+                      if j not in used]
+            step = next((j for j in follow if j in serves[k]), None)
+            if step is None and follow:
+                closest = min(follow, key=lambda j: np.linalg.norm(
+                    flat[j][-1] - locations[k]))
+                if (np.linalg.norm(flat[closest][-1] - locations[k]) <
+                        np.linalg.norm(flat[closest][0] - locations[k])):
+                    step = closest
+
+            # no way forward through the graph, jump to the closest unused
+            # sub-path serving the next stop
+            if step is None:
+                step = min(serves[k] - used,
+                           key=lambda j: distance(j, locations[k]))
+                jumps += 1
+
+            order.append(step)
+            used.add(step)
+
+    paths = {}
+    for direction in as_list(route_data['direction']):
+        tags = [s['tag'] for s in as_list(direction['stop'])
+                if s['tag'] in stops]
+        if len(tags) == 0:
+            continue
+        locations = np.array([stops[tag] for tag in tags])
+
+        # the sub-paths within snap km of the closest one to each stop
+        closest, _ = tree.query(locations)
+        serves = [set(owner[hits].tolist()) for hits in
+                  tree.query_ball_point(locations, closest + snap)]
+
+        # start from whichever sub-path at the first stop reaches the
+        # others with the fewest jumps (a street served in both directions
+        # has a sub-path each way)
+        order, _ = min((chain(start, serves, locations)
+                        for start in sorted(serves[0])),
+                       key=lambda result: (result[1], len(result[0])))
+
+        # join the sub-paths, dropping the first point of a sub-path when it
+        # is the end of the one before it
+        pieces = [sub_paths[order[0]]]
+        for i, j in zip(order, order[1:]):
+            if end_node[i] == node(j):
+                pieces.append(sub_paths[j][1:])
+            else:
+                pieces.append(sub_paths[j])
+        paths[direction['tag']] = np.concatenate(pieces)
+
+    return paths
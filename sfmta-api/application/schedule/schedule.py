@@ -2,13 +2,12 @@
 # provides various accessor methods for it
 
 import pandas as pd
-import psycopg2 as pg
 import numpy as np
 from scipy import stats
 
 
 class Schedule:
-    def __init__(self, route_id, date, creds):
+    def __init__(self, route_id, date, connection):
         """
         The Schedule class loads the schedule for a particular route and day,
         and makes several accessor methods available for it.
@@ -22,15 +21,15 @@ class Schedule:
             - Which date to load
             - Converted with pandas.to_datetime so many formats are acceptable
 
-        creds (dict)
-            -  local environment variables for db connection
+        connection (psycopg2 connection)
+            - an open DB connection, such as one checked out of the
+              app's connection pool
         """
-        self.creds = creds
         self.route_id = str(route_id)
         self.date = pd.to_datetime(date)
 
         # load the schedule for that date and route
-        self.route_data = load_schedule(self.route_id, self.date, self.creds)
+        self.route_data = load_schedule(self.route_id, self.date, connection)
 
         # process data into a table
         self.inbound_table, self.outbound_table = \
@@ -40,6 +39,11 @@ class Schedule:
         self.mean_interval, self.common_interval = get_common_intervals(
                                     [self.inbound_table, self.outbound_table])
 
+        # sorted scheduled times for each stop, used for interval lookups
+        self.stop_times = get_stop_times(self.inbound_table,
+                                         self.outbound_table)
+        self._build_lookup()
+
     def list_stops(self):
         """
         returns the list of all stops used by this schedule
@@ -53,6 +57,29 @@ class Schedule:
         # then back to list for the correct output type
         return list(set(inbound + outbound))
 
+    def _build_lookup(self):
+        """
+        Flattens stop_times into one sorted array for get_intervals()
+
+        Each stop's times are offset by a different number of days (its row
+        number), so the whole array stays sorted and one binary search can
+        answer queries for every stop at once.
+        """
+
+        self._offset = 2 * 24 * 60 * 60
+        self._rows = {}
+        arrays = []
+        for direction in ['inbound', 'outbound']:
+            tags = list(self.stop_times[direction].keys())
+            self._rows[direction] = (pd.Index(tags), len(arrays))
+            for tag in tags:
+                arrays.append(self.stop_times[direction][tag] +
+                              len(arrays) * self._offset)
+
+        self._count = np.array([len(a) for a in arrays], dtype=int)
+        self._start = np.cumsum(self._count) - self._count
+        self._flat = np.concatenate(arrays) if arrays else np.empty(0)
+
     def get_specific_interval(self, stop, time, inbound=True):
         """
         Returns the expected interval, in minutes, for a given stop and
@@ -74,48 +101,74 @@ class Schedule:
 
         # ensure correct parameter types
         stop = str(stop)
-        time = pd.to_datetime(time)
-
-        # check which route to use, and extract the column for the given stop
-        if (stop in self.inbound_table.columns and
-                stop in self.outbound_table.columns):
-            # stop exists in both, use inbound parameter to decide
-            if inbound:
-                sched = self.inbound_table[stop]
-            else:
-                sched = self.outbound_table[stop]
-        elif stop in self.inbound_table.columns:
-            # stop is in the inbound schedule, use that
-            sched = self.inbound_table[stop]
-        elif stop in self.outbound_table.columns:
-            # stop is in the outbound schedule, use that
-            sched = self.outbound_table[stop]
-        else:
+
+        if (stop not in self.inbound_table.columns and
+                stop not in self.outbound_table.columns):
             # stop doesn't exist in either, throw an error
             raise ValueError(f"Stop id '{stop}' doesn't exist "
                              f"in either inbound or outbound schedules")
 
-        # 1: convert schedule to datetime for comparison statements
-        # 2: drop any NaN values
-        # 3: convert to list since pd.Series threw errors on i indexing
-        sched = list(pd.to_datetime(sched.dropna()))
+        direction = 'inbound' if inbound else 'outbound'
+        return self.get_intervals([stop], [time], direction)[0]
+
+    def get_intervals(self, stops, times, direction='inbound'):
+        """
+        Returns the expected interval, in minutes, for many (stop, time)
+        pairs at once.  Works the same as get_specific_interval(), but uses
+        the sorted stop_times arrays so every query is one binary search.
+
+        Parameters:
+
+        stops (array-like of str or int)
+            - the stop tag/id of each query
+
+        times (array-like of str or pandas.Timestamp)
+            - the time of day of each query, only the time portion is used
 
-        # reset the date portion of the time parameter to
-        # ensure we are checking the schedule correctly
-        time = time.replace(year=self.date.year, month=self.date.month,
-                            day=self.date.day)
+        direction (str or array-like of str, optional)
+            - 'inbound' or 'outbound', for all queries or one per query
+            - ignored unless the given stop is in both inbound and outbound
 
-        # iterate through that list to find where the time parameter fits
-        for i in range(1, len(sched)):
-            # start at 1 and move forward,
-            # is the time parameter before this schedule entry?
-            if time < sched[i]:
-                # return the difference between this entry and the previous one
-                return (sched[i] - sched[i-1]).seconds / 60
+        Returns a numpy array of intervals, NaN for stops that are not in the
+        schedule or only have one scheduled time
+        """
 
-        # can only reach this point if the time parameter is after all entries
-        # in the schedule, return the last available interval
-        return (sched[len(sched)-1] - sched[len(sched)-2]).seconds / 60
+        stops = pd.Index(np.asarray(stops).astype(str))
+        times = pd.Series(pd.to_datetime(times))
+        seconds = (times - times.dt.normalize()).dt.total_seconds().to_numpy()
+        inbound = np.char.lower(np.broadcast_to(
+            np.asarray(direction, dtype=str), len(stops))) == 'inbound'
+
+        # find the row for each stop, preferring the requested direction
+        rows = {}
+        for key, (index, first_row) in self._rows.items():
+            rows[key] = index.get_indexer(stops)
+            rows[key] = np.where(rows[key] >= 0, rows[key] + first_row, -1)
+        row_in, row_out = rows['inbound'], rows['outbound']
+        row = np.where(inbound,
+                       np.where(row_in >= 0, row_in, row_out),
+                       np.where(row_out >= 0, row_out, row_in))
+
+        result = np.full(len(stops), np.nan)
+        if len(self._count) == 0:
+            return result
+        found = (row >= 0) & (self._count[np.maximum(row, 0)] > 1)
+        row = row[found]
+        start = self._start[row]
+
+        # every stop's times are offset by a different number of days, so
+        # one search of the flat array covers all stops
+        position = np.searchsorted(self._flat,
+                                   seconds[found] + row * self._offset,
+                                   side='right') - start
+
+        # use the first scheduled time after the given time, or the last
+        # available interval if the time is after all entries
+        position = np.clip(position, 1, self._count[row] - 1)
+        result[found] = (self._flat[start + position] -
+                         self._flat[start + position - 1]) / 60
+
+        return result
 
 
 def extract_schedule_tables(route_data):
@@ -180,7 +233,38 @@ def extract_schedule_tables(route_data):
     return inbound_df, outbound_df
 
 
-def load_schedule(route, date, creds):
+def get_stop_times(inbound_table, outbound_table):
+    """
+    converts schedule tables to sorted arrays of scheduled times for each stop
+
+    returns a dict keyed by direction ('inbound' or 'outbound'), values are
+    dicts of stop tag -> sorted numpy array of seconds after midnight
+    """
+
+    stop_times = {}
+    for direction, table in [('inbound', inbound_table),
+                             ('outbound', outbound_table)]:
+        stop_times[direction] = {}
+        for stop in table.columns:
+            seconds = pd.to_timedelta(table[stop].dropna()).dt.total_seconds()
+            stop_times[direction][str(stop)] = np.sort(seconds.to_numpy())
+
+    return stop_times
+
+
+# selects the schedule row in effect for a route and date
+# on the day a schedule changes both the old and new rows match,
+# so the newest one is used
+SCHEDULE_WHERE = """
+        WHERE rid = %s AND
+            begin_date <= %s::TIMESTAMP AND
+            (end_date IS NULL OR end_date >= %s::TIMESTAMP)
+        ORDER BY begin_date DESC, id DESC
+        LIMIT 1;
+"""
+
+
+def load_schedule(route, date, connection):
     """
     loads schedule data from the database and returns it
 
@@ -193,50 +277,132 @@ def load_schedule(route, date, creds):
             - Which date to load
             - Converted with pandas.to_datetime so many formats are acceptable
 
-        creds (dict)
-            -  local environment variables for db connection
+        connection (psycopg2 connection)
+            - an open DB connection, it is not closed here
     """
 
     # ensure correct parameter types
     route = str(route)
     date = pd.to_datetime(date)
 
-    # load environment variables for DB connection
-    cnx = pg.connect(**creds)
-    cursor = cnx.cursor()
-
     # build selection query
     query = """
-        SELECT content
+        SELECT content, base_id, delta
         FROM schedules
-        WHERE rid = %s AND
-            begin_date <= %s::TIMESTAMP AND
-            (end_date IS NULL OR end_date >= %s::TIMESTAMP);
-    """
+    """ + SCHEDULE_WHERE
 
     # execute query and save the route data to a local variable
-    cursor.execute(query, (route, str(date), str(date)))
-    data = cursor.fetchone()[0]['route']
+    with connection.cursor() as cursor:
+        cursor.execute(query, (route, str(date), str(date)))
+        content, base_id, delta = cursor.fetchone()
 
-    # pd.Timestamp.dayofweek returns 0 for monday and 6 for Sunday
-    # the actual serviceClass strings are defined by Nextbus
-    # these are the only 3 service classes we can currently observe,
-    # if others are published later then this will need to change
-    if date.dayofweek <= 4:
-        service_class = 'wkd'
-    elif date.dayofweek == 5:
-        service_class = 'sat'
-    else:
-        service_class = 'sun'
+        # versions stored as a delta are rebuilt from their keyframe,
+        # even when the delta itself is empty; a keyframe is never a
+        # delta itself (see AWS_Lambda/versions.py), so one step is enough
+        if base_id is not None:
+            cursor.execute("SELECT content FROM schedules WHERE id = %s;",
+                           (base_id,))
+            content = apply_delta(cursor.fetchone()[0], delta)
+
+    data = content['route']
 
     # the schedule format has two entries for each serviceClass,
     # one each for inbound and outbound.
 
     # return each entry in the data list with the correct serviceClass
+    service_class = get_service_class(date)
     return [sched for sched in data
             if (sched['serviceClass'] == service_class)]
 
 
+def apply_delta(base, delta):
+    """
+    Returns base with a stored schedule delta applied, sharing the parts
+    that didn't change with base
+
+    A copy of apply_delta() in AWS_Lambda/versions.py, which describes the
+    delta format, since the API image doesn't hold that folder.
+    AWS_Lambda/test_versions.py checks that the two agree.
+    """
+    if delta is None:
+        return base
+
+    if 'value' in delta:
+        return delta['value']
+
+    if 'keys' in delta:
+        result = {key: value for key, value in base.items()
+                  if key not in delta['removed']}
+        for key, change in delta['keys'].items():
+            result[key] = apply_delta(base.get(key), change)
+        return result
+
+    result = []
+    position = 0
+    for start, end, kind, items in delta['items']:
+        result.extend(base[position:start])
+        if kind == 'splice':
+            result.extend(items)
+        else:
+            result.extend(apply_delta(item, change)
+                          for item, change in zip(base[start:end], items))
+        position = end
+    result.extend(base[position:])
+    return result
+
+
+def get_schedule_version(route, date, connection):
+    """
+    returns the id of the schedule row load_schedule would load, without
+    loading its content, or None if there is no schedule for that date
+
+    a schedule row never changes once it is stored, so together with the
+    service class the id identifies the schedule a route runs on a date
+
+    Parameters:
+
+        route (str)
+            - The route id
+
+        date (str or pd.Datetime)
+            - Which date
+
+        connection (psycopg2 connection)
+            - an open DB connection, it is not closed here
+    """
+
+    date = pd.to_datetime(date)
+
+    query = """
+        SELECT id
+        FROM schedules
+    """ + SCHEDULE_WHERE
+
+    with connection.cursor() as cursor:
+        cursor.execute(query, (str(route), str(date), str(date)))
+        row = cursor.fetchone()
+
+    return None if row is None else row[0]
+
+
+def get_service_class(date):
+    """
+    returns the Nextbus serviceClass that runs on a date
+    """
+
+    # pd.Timestamp.dayofweek returns 0 for monday and 6 for Sunday
+    # the actual serviceClass strings are defined by Nextbus
+    # these are the only 3 service classes we can currently observe,
+    # if others are published later then this will need to change
+    date = pd.to_datetime(date)
+    if date.dayofweek <= 4:
+        return 'wkd'
+    elif date.dayofweek == 5:
+        return 'sat'
+    else:
+        return 'sun'
+
+
 def get_common_intervals(df_list):
     """
     takes route schedule tables and returns both the average interval (mean)
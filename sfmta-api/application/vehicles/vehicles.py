@@ -0,0 +1,410 @@
+# Keeps the latest report of every vehicle in memory, for the real-time
+# endpoints, and pushes what changed to subscribed clients
+
+import itertools
+import threading
+import time
+import traceback
+from datetime import timedelta
+from formats.formats import dumps
+
+# columns of the vehicles table, in the order the endpoints return them
+VEHICLE_FIELDS = ['timestamp', 'rid', 'vid', 'age', 'kph', 'heading',
+                  'latitude', 'longitude', 'direction']
+
+# messages a feed subscriber can fall behind by before it is dropped
+FEED_QUEUE_SIZE = 100
+
+# seconds between keepalive messages on an idle feed connection
+FEED_KEEPALIVE = 15
+
+
+class VehicleStore:
+    def __init__(self, max_age=60, stale_after=600, feed=None):
+        """
+        The VehicleStore class holds a snapshot of the vehicles table,
+        which location_collector upserts with the latest report of each
+        vehicle every minute.
+
+        Reading the whole fleet from the snapshot costs O(fleet) and no
+        database access.  The snapshot is reloaded when location_collector
+        notifies that it stored a new cycle, or when it is older than
+        max_age seconds.
+
+        Parameters:
+
+        max_age (float)
+            - seconds a snapshot is used before it is reloaded on access,
+              in case a notification was missed
+
+        stale_after (float)
+            - vehicles whose latest report is this many seconds older than
+              the newest report are left out, they are out of service
+
+        feed (VehicleFeed)
+            - optional, is sent what changed on each route every time the
+              snapshot is reloaded
+        """
+        self.max_age = max_age
+        self.stale_after = stale_after
+        self.feed = feed
+
+        self._vehicles = []
+        self._newest = None
+        self._loaded = None
+        self._version = 0
+        self._lock = threading.Lock()
+
+        # held for the whole of every reload, so reloads (notifications,
+        # expiry) run one at a time and publish their diffs in order
+        self._refreshing = threading.Lock()
+
+    def refresh(self, connection):
+        """
+        Reloads the snapshot from the vehicles table, waiting for a reload
+        already in progress to finish first
+
+        Arguments:
+            connection (psycopg2 connection): an open DB connection
+        """
+        with self._refreshing:
+            return self._reload(connection)
+
+    def _reload(self, connection):
+        """
+        Reloads the snapshot, the caller holds self._refreshing
+
+        A reload that read older reports than the current snapshot keeps
+        the current one, so the snapshot and its version only move forward.
+        """
+        query = f"""
+        SELECT {', '.join(VEHICLE_FIELDS)}
+        FROM vehicles
+        WHERE timestamp >= (SELECT MAX(timestamp) FROM vehicles) - %s
+        ORDER BY rid, vid;
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, (timedelta(seconds=self.stale_after),))
+            rows = cursor.fetchall()
+        connection.rollback()
+
+        vehicles = [dict(zip(VEHICLE_FIELDS, row)) for row in rows]
+        newest = max((vehicle['timestamp'] for vehicle in vehicles),
+                     default=None)
+
+        with self._lock:
+            self._loaded = time.monotonic()
+            if (newest is None or self._newest is not None and
+                    newest < self._newest):
+                return self._vehicles
+            previous = self._vehicles
+            self._vehicles = vehicles
+            self._newest = newest
+            self._version += 1
+            version = self._version
+
+        # the changes are worked out once here, however many clients
+        # are subscribed
+        if self.feed is not None:
+            self.feed.publish(version, diff_vehicles(previous, vehicles))
+
+        return vehicles
+
+    def get(self, pool, route=None):
+        """
+        Returns the latest report of every vehicle in service, as dicts
+        sorted by route and vehicle id, reloading the snapshot if needed
+
+        Arguments:
+            pool (ConnectionPool): where to get a connection to reload
+            route (str): only return vehicles on this route
+        """
+        routes = None if route is None else {route}
+        return self.snapshot(pool, routes)[1]
+
+    def snapshot(self, pool, routes=None):
+        """
+        Returns (version, vehicles), the snapshot's version and the latest
+        report of every vehicle in service, reloading it if needed
+
+        Arguments:
+            pool (ConnectionPool): where to get a connection to reload
+            routes (set): only return vehicles on these routes
+        """
+        self.reload_expired(pool)
+
+        with self._lock:
+            version, vehicles = self._version, self._vehicles
+
+        if routes is None:
+            return version, vehicles
+        return version, [vehicle for vehicle in vehicles
+                         if vehicle['rid'] in routes]
+
+    def reload_expired(self, pool):
+        """
+        Reloads the snapshot if it expired, returns True if this call did
+
+        Arguments:
+            pool (ConnectionPool): where to get a connection to reload
+        """
+        if not self.expired():
+            return False
+
+        # one thread reloads, the others wait and use its snapshot
+        with self._refreshing:
+            if not self.expired():
+                return False
+            with pool.connection() as cnx:
+                self._reload(cnx)
+        return True
+
+    def start_reloader(self, pool):
+        """
+        Runs a daemon thread that reloads the snapshot when it expires while
+        the feed has subscribers, and returns the thread
+
+        Feed subscribers wait for diffs instead of reading the snapshot, so
+        without notifications from the database nothing else reloads it
+        for them.  This thread is the only place that happens, however many
+        clients are connected.
+
+        Arguments:
+            pool (ConnectionPool): where to get a connection to reload
+        """
+        def run():
+            while True:
+                # sleep until the snapshot expires, checking at most
+                # once a second
+                age = self.stats()['age']
+                remaining = 0 if age is None else self.max_age - age
+                time.sleep(max(remaining, 0) + 1)
+
+                if self.feed is None or not self.feed.stats()['subscribers']:
+                    continue
+                try:
+                    self.reload_expired(pool)
+                except Exception:
+                    # keep going if the database is unavailable, and try
+                    # again once the snapshot would have expired
+                    traceback.print_exc()
+                    time.sleep(self.max_age)
+
+        thread = threading.Thread(target=run, name='vehicles', daemon=True)
+        thread.start()
+        return thread
+
+    def expired(self):
+        """ True if the snapshot was never loaded or is too old """
+        with self._lock:
+            return (self._loaded is None or
+                    time.monotonic() - self._loaded > self.max_age)
+
+    def stats(self):
+        """
+        Returns the snapshot's size, age in seconds, and version
+        """
+        with self._lock:
+            return {
+                'vehicles': len(self._vehicles),
+                'age': None if self._loaded is None
+                else time.monotonic() - self._loaded,
+                'version': self._version
+            }
+
+
+class FeedOverflow(Exception):
+    """
+    Raised by a subscriber's deliver function when it can't keep up
+    """
+    pass
+
+
+class VehicleFeed:
+    def __init__(self):
+        """
+        The VehicleFeed class pushes the changes to the vehicle snapshot to
+        subscribed clients, e.g. server-sent event or WebSocket connections.
+
+        Each change is encoded once per route and the same text is handed
+        to every subscriber of that route, so the cost of an update doesn't
+        grow with the number of clients beyond handing out the messages.
+
+        Messages are JSON objects:
+            {"event": "diff", "version": <snapshot version>,
+             "routes": {"<rid>": {"updated": [<vehicle>, ...],
+                                  "removed": ["<vid>", ...]}}}
+
+        Subscribers to every route get one message per update covering all
+        the routes that changed, subscribers to some routes get one message
+        for each of their routes that changed.
+        """
+        self._subscribers = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self._counts = {
+            'published': 0,
+            'delivered': 0,
+            'dropped': 0
+        }
+
+    def subscribe(self, deliver, routes=None):
+        """
+        Registers a subscriber, and returns its key for unsubscribe()
+
+        Arguments:
+            deliver (function): called with a (version, text) pair for
+                                each message, from the thread that reloads
+                                the snapshot, so it must not block; raising
+                                FeedOverflow (or any exception) drops the
+                                subscriber
+            routes (set): route ids to get changes for (default: all)
+        """
+        key = next(self._ids)
+        with self._lock:
+            self._subscribers[key] = (routes, deliver)
+        return key
+
+    def unsubscribe(self, key):
+        """ Removes a subscriber, if it is still subscribed """
+        with self._lock:
+            self._subscribers.pop(key, None)
+
+    def subscribed(self, key):
+        """ False once a subscriber was removed, e.g. for falling behind """
+        with self._lock:
+            return key in self._subscribers
+
+    def publish(self, version, diffs):
+        """
+        Sends the changes of a snapshot reload to the subscribers
+
+        Arguments:
+            version (int): the version of the new snapshot
+            diffs (dict): the changes on each route, from diff_vehicles()
+        """
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+            self._counts['published'] += 1
+
+        if not diffs or not subscribers:
+            return
+
+        # encode each message once, for all the subscribers that get it
+        everything = None
+        by_route = {}
+        for _, (routes, _) in subscribers:
+            if routes is None:
+                if everything is None:
+                    everything = diff_message(version, diffs)
+                continue
+            for route in routes:
+                if route in diffs and route not in by_route:
+                    by_route[route] = diff_message(
+                        version, {route: diffs[route]})
+
+        delivered = 0
+        dropped = []
+        for key, (routes, deliver) in subscribers:
+            if routes is None:
+                messages = [everything]
+            else:
+                messages = [by_route[route] for route in routes
+                            if route in by_route]
+            try:
+                for message in messages:
+                    deliver((version, message))
+                    delivered += 1
+            except Exception:
+                # a client that can't keep up is dropped, it reconnects
+                # and starts again from a snapshot
+                dropped.append(key)
+
+        with self._lock:
+            for key in dropped:
+                self._subscribers.pop(key, None)
+            self._counts['delivered'] += delivered
+            self._counts['dropped'] += len(dropped)
+
+    def stats(self):
+        """
+        Returns the number of subscribers and the message counters
+        """
+        with self._lock:
+            stats = dict(self._counts)
+            stats['subscribers'] = len(self._subscribers)
+        return stats
+
+
+def diff_vehicles(old, new):
+    """
+    Returns what changed on each route between two snapshots
+
+    A vehicle that moved to another route is updated on its new route and
+    removed from its old one.
+
+    Arguments:
+        old (list): the previous snapshot's vehicle dicts
+        new (list): the new snapshot's vehicle dicts
+
+    Returns a dict of {rid: {'updated': [vehicle, ...], 'removed': [vid]}},
+    with only the routes that changed
+    """
+    before = {vehicle['vid']: vehicle for vehicle in old}
+    after = {vehicle['vid']: vehicle for vehicle in new}
+
+    diffs = {}
+
+    def route(rid):
+        return diffs.setdefault(rid, {'updated': [], 'removed': []})
+
+    for vid, vehicle in after.items():
+        previous = before.get(vid)
+        if previous == vehicle:
+            continue
+        route(vehicle['rid'])['updated'].append(vehicle)
+        if previous is not None and previous['rid'] != vehicle['rid']:
+            route(previous['rid'])['removed'].append(vid)
+
+    for vid, previous in before.items():
+        if vid not in after:
+            route(previous['rid'])['removed'].append(vid)
+
+    return diffs
+
+
+def diff_message(version, diffs):
+    """ Returns the JSON text of a feed message for some route diffs """
+    return dumps({'event': 'diff', 'version': version,
+                  'routes': diffs}).decode()
+
+
+def snapshot_message(version, vehicles):
+    """
+    Returns the JSON text of the first message a subscriber is sent, the
+    vehicles it subscribed to as of a snapshot version
+
+    Diff messages with a version up to this one are already included, and
+    are not sent after it.
+    """
+    return dumps({'event': 'snapshot', 'version': version,
+                  'vehicles': vehicles}).decode()
+
+
+def parse_routes(value):
+    """
+    Returns the set of route ids in a comma separated request argument, or
+    None (every route) if it is empty
+    """
+    if not value:
+        return None
+    routes = {route.strip() for route in value.split(',') if route.strip()}
+    return routes or None
+
+
+def sse_event(event, message):
+    """ Returns a feed message framed as a server-sent event """
+    return f'event: {event}\ndata: {message}\n\n'